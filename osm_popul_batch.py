@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+Batch runner for several regional extracts (Houston, Dallas, Austin, ...).
+The estimates are loaded once and shared, every region is processed in
+its own process with outputs under out_dir/<region>, and the per-region
+settlement tables are merged into one database with a region column.
+
+Usage:
+    python osm_popul_batch.py <estimates.csv>[,<estimates.csv>...] <out_dir> <workers> <region>=<file.osm> [...]
+
+Several comma separated estimates files are read as yearly vintages, and
+each place is cleaned against its most recent estimate.
+
+Regions are merged in the order given; a settlement found in overlapping
+extracts is kept for the first region holding it.
+"""
+
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+
+from osm_popul_estimates import load_estimates
+from osm_popul_sql import RegionMerger
+from osm_popul_wrangler import Popul
+
+REGION_DB = 'settlements.db'
+# Estimates shared by every region run in a worker process
+ESTIMATES = {}
+
+
+def init_worker(pop_est, est_index):
+    ESTIMATES['pop_est'] = pop_est
+    ESTIMATES['est_index'] = est_index
+
+
+def run_region(region, file_name, out_dir, options):
+    # Worker: process one extract into out_dir/<region>, with its printed
+    # output in process.log there. Returns a summary of the run.
+    region_dir = os.path.join(out_dir, region)
+    start = time.time()
+    popul = Popul(file_name, db_path=REGION_DB, out_dir=region_dir)
+    try:
+        popul.use_estimates(ESTIMATES['pop_est'], ESTIMATES['est_index'])
+        with open(os.path.join(region_dir, 'process.log'), 'w', encoding='utf8') as log:
+            with redirect_stdout(log):
+                popul.process_data(output=('csv', 'sqlite'), progress_every=None, **options)
+    finally:
+        popul.osm_file.close()
+    return {'region': region,
+            'file': file_name,
+            'db_path': popul.db_path,
+            'settlements': len(popul.settlements),
+            'secs': round(time.time() - start, 4)}
+
+
+def run_batch(regions, estimates_file, out_dir, workers=None, merged_db='merged.db', **options):
+    # Process regions, a list of (region, extract file name) pairs, and
+    # merge them into out_dir/merged_db. estimates_file is one estimates
+    # csv or a list of vintage files, as for load_estimates. options
+    # are passed on to process_data. Returns the per-region summaries
+    # with merge counts.
+    names = [region for region, __ in regions]
+    if len(set(names)) != len(names):
+        raise ValueError("Region names must be unique, got {}".format(names))
+    if not regions:
+        return []
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    shared = load_estimates(estimates_file)
+    workers = workers or min(len(regions), os.cpu_count() or 1)
+    if workers < 2:
+        init_worker(*shared)
+        results = [run_region(region, file_name, out_dir, options) for region, file_name in regions]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                 initargs=shared) as executor:
+            futures = [executor.submit(run_region, region, file_name, out_dir, options)
+                       for region, file_name in regions]
+            results = [future.result() for future in futures]
+    with RegionMerger(os.path.join(out_dir, merged_db)) as merger:
+        for result in results:
+            result['merged'], result['duplicates'] = merger.merge(result['region'], result['db_path'])
+    return results
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 5 or not all('=' in arg for arg in sys.argv[4:]):
+        print(__doc__)
+        sys.exit(1)
+    regions = [tuple(arg.split('=', 1)) for arg in sys.argv[4:]]
+    time_start = time.time()
+    estimates = sys.argv[1].split(',')
+    if len(estimates) == 1:
+        estimates = estimates[0]
+    for result in run_batch(regions, estimates, sys.argv[2], int(sys.argv[3])):
+        print("{region}: {settlements} settlements in {secs} secs, {merged} merged, "
+              "{duplicates} duplicates of earlier regions".format(**result))
+    print("Batch processed in {} secs".format(round(time.time() - time_start, 4)))
@@ -0,0 +1,384 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the Popul settlement pipeline.
+
+Usage:
+    python osm_popul_bench.py extract <file.osm> [repeat]
+    python osm_popul_bench.py parallel <file.osm> [workers] [chunk_mb]
+    python osm_popul_bench.py prefilter <file.osm>
+    python osm_popul_bench.py shape <file.osm> <estimates.csv> [repeat]
+    python osm_popul_bench.py pipeline <out_dir> [elements] [settlement_density]
+    python osm_popul_bench.py compare <old.json> <new.json>
+
+'pipeline' writes a synthetic extract and estimates csv to out_dir, times
+every stage and saves the results as bench_<time>.json in out_dir.
+"""
+
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+import xml.parsers.expat
+from xml.sax.saxutils import quoteattr
+
+from osm_popul_records import SettlementTable
+from osm_popul_report import SettlementReport
+from osm_popul_spatial import SettlementGrid
+from osm_popul_sql import SQLiteSink
+from osm_popul_wrangler import Popul
+from osm_popul_writer import SettlementWriter
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+PAGE_SIZE = resource.getpagesize() if resource is not None else 4096
+
+SPELLINGS = (('Saint ', 'St. '), ('Fort ', 'Ft. '), ('Mount ', 'Mt. '))
+
+
+def time_candidates(popul, method, repeat=3):
+    # Best wall-clock time and traced peak memory for one candidate source
+    best = None
+    for __ in range(repeat):
+        popul.osm_file.seek(0)
+        start = time.perf_counter()
+        candidates = list(method())
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    popul.osm_file.seek(0)
+    # Consume without keeping results so the peak reflects parser state only
+    tracemalloc.start()
+    for __ in method():
+        pass
+    __, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return candidates, best, peak
+
+
+def bench_tag_extraction(file_name, repeat=3):
+    # Compare the element.iter('tag') loop with the streaming TagExtractor
+    repeat = int(repeat)
+    popul = Popul(file_name)
+    results = {}
+    outputs = {}
+    for label, method in (('element_iter', popul.iter_element_candidates),
+                          ('tag_extractor', popul.iter_candidates)):
+        candidates, best, peak = time_candidates(popul, method, repeat)
+        outputs[label] = candidates
+        results[label] = {'secs': round(best, 4),
+                          'peak_mb': round(peak / 1e6, 2),
+                          'candidates': len(candidates)}
+    popul.osm_file.close()
+    results['identical'] = outputs['element_iter'] == outputs['tag_extractor']
+    results['speedup'] = round(results['element_iter']['secs'] /
+                               max(results['tag_extractor']['secs'], 1e-9), 2)
+    return results
+
+
+def bench_parallel(file_name, workers=4, chunk_mb=64):
+    # Time serial against process pool parsing and check that both produce
+    # the same candidates in the same order
+    workers = int(workers)
+    popul = Popul(file_name)
+    start = time.perf_counter()
+    serial = list(popul.iter_candidates())
+    serial_secs = time.perf_counter() - start
+    start = time.perf_counter()
+    parallel = list(popul.iter_candidates(workers, int(chunk_mb) << 20))
+    parallel_secs = time.perf_counter() - start
+    popul.osm_file.close()
+    return {'serial_secs': round(serial_secs, 4),
+            'parallel_secs': round(parallel_secs, 4),
+            'workers': workers,
+            'candidates': len(serial),
+            'identical': serial == parallel}
+
+
+def bench_prefilter(file_name):
+    # Time the full parse against the memory-mapped population pre-filter.
+    # Only population-tagged candidates are compared since those are all the
+    # pre-filter returns.
+    popul = Popul(file_name)
+    start = time.perf_counter()
+    serial = [c for c in popul.iter_candidates() if c.popul is not None]
+    serial_secs = time.perf_counter() - start
+    start = time.perf_counter()
+    scanned = list(popul.iter_candidates(prefilter=True))
+    scan_secs = time.perf_counter() - start
+    popul.osm_file.close()
+    results = {'serial_secs': round(serial_secs, 4),
+               'prefilter_secs': round(scan_secs, 4),
+               'identical': serial == scanned}
+    results.update(popul.scanner.stats())
+    return results
+
+
+def shape_table(popul, candidates, vectorized=False):
+    # Settlements cleaned from candidates by the per-row or batch engine
+    table = SettlementTable()
+    if vectorized:
+        for __ in popul.shape_batch(candidates, table):
+            pass
+    else:
+        for __ in popul.shape_rows(candidates, table):
+            pass
+    return table
+
+
+def bench_shape(file_name, estimates_file, repeat=3):
+    # Time per-row shape_data cleaning against the columnar batch engine
+    # and check both produce the same rows
+    repeat = int(repeat)
+    popul = Popul(file_name)
+    popul.get_popul_est(estimates_file)
+    candidates = list(popul.iter_candidates())
+    popul.osm_file.close()
+    results = {'candidates': len(candidates)}
+    outputs = {}
+    for label, method in (('shape_rows', lambda: list(shape_table(popul, candidates))),
+                          ('shape_batch', lambda: list(shape_table(popul, candidates, True)))):
+        best = None
+        for __ in range(repeat):
+            start = time.perf_counter()
+            outputs[label] = method()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results[label + '_secs'] = round(best, 4)
+    results['settlements'] = len(outputs['shape_rows'])
+    results['identical'] = outputs['shape_rows'] == outputs['shape_batch']
+    return results
+
+
+def place_names(places):
+    # Synthetic settlement names, some using words the estimates index has
+    # to normalize
+    prefixes = ('Saint ', 'Fort ', 'Mount ', 'Lake ', 'New ', '')
+    return ['{}Place {}'.format(prefixes[i % len(prefixes)], i) for i in range(places)]
+
+
+def write_synthetic_estimates(file_name, places=500, seed=0):
+    # Estimates csv in the layout get_popul_est reads: county, place,
+    # 2010 census, 2015 estimate, 1-1-2016 estimate
+    rng = random.Random(seed)
+    with open(file_name, 'w', encoding='utf8', newline='') as f:
+        f.write('county,place,census_2010,estimate_2015,estimate_2016\n')
+        for i, name in enumerate(place_names(places)):
+            census = int(rng.lognormvariate(7, 2)) + 1
+            f.write('County {},{},{},{},{}\n'.format(
+                i % 254, name, census, int(census * 1.05), int(census * rng.uniform(0.9, 1.3))))
+
+
+def write_synthetic_osm(file_name, elements=100000, settlement_density=0.01, places=500,
+                        seed=0):
+    # OSM XML extract with about elements nodes, ways and relations. A
+    # settlement_density share of the nodes are settlements with name, place
+    # and usually population tags; names come from place_names and are
+    # sometimes abbreviated or suffixed like real OSM data.
+    rng = random.Random(seed)
+    names = place_names(places)
+    n_nodes = int(elements * 0.85)
+    n_ways = int(elements * 0.14)
+    n_relations = max(elements - n_nodes - n_ways, 0)
+    with open(file_name, 'w', encoding='utf8') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6" generator="osm_popul_bench">\n')
+        f.write(' <bounds minlat="25.8" minlon="-106.6" maxlat="36.5" maxlon="-93.5"/>\n')
+        for node_id in range(1, n_nodes + 1):
+            uid = rng.randint(1, 500)
+            f.write(' <node id="{}" version="{}" timestamp="{}-0{}-1{}T12:00:00Z" uid="{}" user="user{}" '
+                    'lat="{:.7f}" lon="{:.7f}"'.format(node_id, rng.randint(1, 9), rng.randint(2008, 2017),
+                                                     rng.randint(1, 9), rng.randint(0, 9), uid, uid,
+                                                     rng.uniform(25.8, 36.5), rng.uniform(-106.6, -93.5)))
+            roll = rng.random()
+            if roll < settlement_density:
+                name = rng.choice(names)
+                if rng.random() < 0.1:
+                    for full, short in SPELLINGS:
+                        name = name.replace(full, short)
+                if rng.random() < 0.05:
+                    name += ' City'
+                f.write('>\n  <tag k="name" v={}/>\n  <tag k="place" v="{}"/>\n'.format(
+                    quoteattr(name), rng.choice(('hamlet', 'village', 'town', 'city'))))
+                if rng.random() < 0.8:
+                    f.write('  <tag k="population" v="{}"/>\n'.format(int(rng.lognormvariate(7, 2)) + 1))
+                if rng.random() < 0.3:
+                    f.write('  <tag k="source:population" v="US Census"/>\n')
+                f.write(' </node>\n')
+            elif roll < 0.1:
+                f.write('>\n  <tag k="highway" v="traffic_signals"/>\n </node>\n')
+            else:
+                f.write('/>\n')
+        for way_id in range(1, n_ways + 1):
+            f.write(' <way id="{}" version="1" timestamp="2015-06-01T00:00:00Z" uid="1" user="user1">\n'.format(way_id))
+            start = rng.randint(1, max(n_nodes - 10, 1))
+            for ref in range(start, start + rng.randint(2, 10)):
+                f.write('  <nd ref="{}"/>\n'.format(ref))
+            f.write('  <tag k="highway" v="residential"/>\n </way>\n')
+        for relation_id in range(1, n_relations + 1):
+            f.write(' <relation id="{}" version="1" timestamp="2016-01-01T00:00:00Z" uid="2" user="user2">\n'
+                    '  <member type="way" ref="{}" role="outer"/>\n'
+                    '  <tag k="type" v="multipolygon"/>\n </relation>\n'.format(
+                        relation_id, rng.randint(1, max(n_ways, 1))))
+        f.write('</osm>\n')
+    return n_nodes + n_ways + n_relations
+
+
+def peak_rss_mb():
+    # Peak resident set size of this process so far, None if unavailable
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    if sys.platform == 'darwin':
+        peak /= 1024.0
+    return round(peak / 1024.0, 2)
+
+
+def rss_mb():
+    # Current resident set size of this process, None without /proc
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+    return round(pages * PAGE_SIZE / 1048576.0, 2)
+
+
+def delta(before, after):
+    if before is None or after is None:
+        return None
+    return round(after - before, 2)
+
+
+def timed(results, stage, method, elements=None, size=None):
+    # Run method once, record its time and throughput under results[stage].
+    # Memory is reported as deltas over the stage, since the process peak
+    # is shared by every stage: rss_delta_mb is the change in resident
+    # memory (what the stage kept), peak_rss_growth_mb how far the stage
+    # raised the process peak (0 when an earlier stage peaked higher).
+    rss = rss_mb()
+    peak = peak_rss_mb()
+    start = time.perf_counter()
+    value = method()
+    secs = time.perf_counter() - start
+    entry = {'secs': round(secs, 4), 'rss_delta_mb': delta(rss, rss_mb()),
+             'peak_rss_growth_mb': delta(peak, peak_rss_mb())}
+    if elements is not None:
+        entry['elements_per_sec'] = round(elements / max(secs, 1e-9), 1)
+    if size is not None:
+        entry['mb_per_sec'] = round(size / 1e6 / max(secs, 1e-9), 2)
+    results['stages'][stage] = entry
+    return value
+
+
+def raw_parse(file_name):
+    # expat parse with no handlers, the floor for any XML extraction
+    parser = xml.parsers.expat.ParserCreate()
+    with open(file_name, 'rb') as f:
+        parser.ParseFile(f)
+
+
+def write_rows(sink, table):
+    with sink:
+        sink.write_records(table)
+
+
+def query_points(count, seed=0):
+    # Random points in the synthetic extract's bounds
+    rng = random.Random(seed)
+    return [(rng.uniform(25.8, 36.5), rng.uniform(-106.6, -93.5)) for __ in range(count)]
+
+
+def nearest_queries(grid, points):
+    for lat, lon in points:
+        grid.nearest(lat, lon)
+
+
+def bbox_queries(report, points, degrees=0.5):
+    for lat, lon in points:
+        report.in_bbox(lat, lon, lat + degrees, lon + degrees)
+
+
+def bench_pipeline(out_dir, elements=200000, settlement_density=0.01):
+    # Generate a synthetic extract in out_dir and time each pipeline stage:
+    # parse, tag extraction, shape_data (per-row and batch), csv and SQLite
+    # writes, the report queries and the spatial lookups. Results are
+    # saved as json in out_dir.
+    elements = int(elements)
+    settlement_density = float(settlement_density)
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    osm_name = os.path.join(out_dir, 'synthetic.osm')
+    est_name = os.path.join(out_dir, 'synthetic_est.csv')
+    db_name = os.path.join(out_dir, 'synthetic.db')
+    results = {'elements': elements, 'settlement_density': settlement_density,
+               'started': time.strftime('%Y-%m-%dT%H:%M:%S'), 'stages': {}}
+    total = timed(results, 'generate', lambda: write_synthetic_osm(osm_name, elements, settlement_density))
+    write_synthetic_estimates(est_name)
+    size = os.path.getsize(osm_name)
+    results['file_mb'] = round(size / 1e6, 2)
+
+    popul = Popul(osm_name, db_path=db_name)
+    timed(results, 'get_popul_est', lambda: popul.get_popul_est(est_name))
+    timed(results, 'parse', lambda: raw_parse(osm_name), total, size)
+    candidates = timed(results, 'tag_extraction', lambda: list(popul.iter_candidates()), total, size)
+    popul.osm_file.close()
+    rows = timed(results, 'shape_rows', lambda: shape_table(popul, candidates), len(candidates))
+    timed(results, 'shape_batch', lambda: shape_table(popul, candidates, True), len(candidates))
+    results['settlements'] = len(rows)
+    # Truncated, so repeated runs in out_dir time the same amount of output
+    writer = SettlementWriter(*[os.path.join(out_dir, name) for name in
+                                ('node_attribs.csv', 'place_data.csv', 'popul_data.csv')], mode='w')
+    timed(results, 'csv_write', lambda: write_rows(writer, rows), len(rows))
+    timed(results, 'sqlite_write', lambda: write_rows(SQLiteSink(db_name), rows), len(rows))
+    report = SettlementReport(db_name)
+    timed(results, 'report_queries', report.dashboard)
+    points = query_points(1000)
+    grid = timed(results, 'spatial_index', lambda: SettlementGrid(rows), len(rows))
+    timed(results, 'nearest_queries', lambda: nearest_queries(grid, points), len(points))
+    timed(results, 'rtree_bbox_queries', lambda: bbox_queries(report, points), len(points))
+    report.close()
+    results['peak_rss_mb'] = peak_rss_mb()
+
+    results_name = os.path.join(out_dir, 'bench_{}.json'.format(time.strftime('%Y%m%d_%H%M%S')))
+    with open(results_name, 'w', encoding='utf8') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    results['saved'] = results_name
+    return results
+
+
+def compare_results(old_name, new_name):
+    # Ratio of new to old time for each stage in two pipeline results
+    with open(old_name, encoding='utf8') as f:
+        old = json.load(f)
+    with open(new_name, encoding='utf8') as f:
+        new = json.load(f)
+    ratios = {}
+    for stage, entry in new['stages'].items():
+        if stage in old['stages']:
+            ratios[stage] = round(entry['secs'] / max(old['stages'][stage]['secs'], 1e-9), 3)
+    return ratios
+
+
+def print_results(results):
+    for key in sorted(results):
+        print("{} = {}".format(key, results[key]))
+
+
+COMMANDS = {'extract': bench_tag_extraction,
+            'parallel': bench_parallel,
+            'prefilter': bench_prefilter,
+            'shape': bench_shape,
+            'pipeline': bench_pipeline,
+            'compare': compare_results}
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3 or sys.argv[1] not in COMMANDS:
+        print(__doc__)
+        sys.exit(1)
+    print_results(COMMANDS[sys.argv[1]](*sys.argv[2:]))
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+Sidecar SQLite cache of the settlement candidates parsed from an OSM file,
+keyed by a hash of the file's contents and the extraction mode, so
+cleaning can be re-run without parsing the extract again.
+"""
+
+import hashlib
+import os
+import sqlite3
+
+from osm_popul_extract import Candidate
+
+# Bump when Candidate or the cache layout changes
+CACHE_VERSION = 2
+HASH_BLOCK = 1 << 20
+INSERT_BATCH = 10000
+# Extraction modes: every candidate, or only the population tagged ones
+# found by the pre-filter
+MODES = ('full', 'prefilter')
+
+CANDIDATES_SCHEMA = "CREATE TABLE IF NOT EXISTS candidates ({})".format(', '.join(Candidate._fields))
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS cache_meta (key TEXT PRIMARY KEY, value)",
+    CANDIDATES_SCHEMA,
+)
+
+
+def cache_file_name(file_name):
+    return file_name + '.candidates.db'
+
+
+def hash_file(file_name):
+    digest = hashlib.blake2b(digest_size=20)
+    with open(file_name, 'rb') as f:
+        while True:
+            block = f.read(HASH_BLOCK)
+            if not block:
+                break
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class CandidateCache(object):
+    # Candidates of one OSM file in file order, as extracted in one of
+    # MODES. The cache holds for the file whose content hash it was
+    # written for, and only for the same mode, as a pre-filter run misses
+    # the place-only candidates. The hash itself is remembered with the
+    # file's size and mtime, so an unchanged file is not read again to
+    # check it. record() rewrites the cache only when its candidate
+    # stream is read to the end.
+
+    def __init__(self, file_name, mode='full'):
+        if mode not in MODES:
+            raise ValueError("mode must be one of {}, got {}".format(MODES, mode))
+        self.file_name = file_name
+        self.mode = mode
+        self.cache_name = cache_file_name(file_name)
+        self.connect = None
+        self.digest = None
+        self.rows_read = 0
+        self.rows_written = 0
+
+    def open(self):
+        if self.connect is None:
+            self.connect = sqlite3.connect(self.cache_name, isolation_level=None)
+            for statement in SCHEMA:
+                self.connect.execute(statement)
+        return self.connect
+
+    def meta(self):
+        return dict(self.open().execute('SELECT key, value FROM cache_meta'))
+
+    def file_digest(self):
+        # Content hash of the input, reusing the stored one while the size
+        # and mtime match the ones it was computed for
+        if self.digest is not None:
+            return self.digest
+        stat = os.stat(self.file_name)
+        meta = self.meta()
+        if meta.get('size') == stat.st_size and meta.get('mtime_ns') == stat.st_mtime_ns:
+            self.digest = meta.get('hashed')
+        if self.digest is None:
+            self.digest = hash_file(self.file_name)
+            self.connect.executemany('INSERT OR REPLACE INTO cache_meta VALUES (?, ?)',
+                                     (('size', stat.st_size), ('mtime_ns', stat.st_mtime_ns),
+                                      ('hashed', self.digest)))
+        return self.digest
+
+    def is_valid(self):
+        # The file is only hashed once the rest of the cache matches
+        meta = self.meta()
+        return (meta.get('version') == CACHE_VERSION and meta.get('complete') == 1 and
+                meta.get('mode') == self.mode and meta.get('digest') == self.file_digest())
+
+    def load(self):
+        # Iterator over the cached candidates, or None without a valid cache
+        try:
+            if not self.is_valid():
+                return None
+        except sqlite3.Error:
+            return None
+        return self.iter_cached()
+
+    def iter_cached(self):
+        cur = self.open().execute('SELECT * FROM candidates ORDER BY rowid')
+        while True:
+            rows = cur.fetchmany(INSERT_BATCH)
+            if not rows:
+                break
+            self.rows_read += len(rows)
+            for row in rows:
+                yield Candidate._make(row)
+
+    def record(self, candidates):
+        # Pass candidates through, storing them as the new cache once the
+        # stream is exhausted. The cache is left as it was when the stream
+        # is abandoned or fails, and caching is dropped without failing
+        # the run when the cache cannot be written (a read only location,
+        # or another run holding the lock).
+        insert = 'INSERT INTO candidates VALUES ({})'.format(', '.join('?' * len(Candidate._fields)))
+        batch = []
+        connect = None
+        try:
+            connect = self.open()
+            digest = self.file_digest()
+            connect.execute('BEGIN')
+            connect.execute("DELETE FROM cache_meta WHERE key IN ('complete', 'digest', 'mode', 'version')")
+            # Recreated, as a cache of an older version has other columns
+            connect.execute('DROP TABLE candidates')
+            connect.execute(CANDIDATES_SCHEMA)
+        except sqlite3.Error:
+            connect = self.abandon(connect)
+        try:
+            for candidate in candidates:
+                yield candidate
+                if connect is None:
+                    continue
+                batch.append(candidate)
+                if len(batch) >= INSERT_BATCH:
+                    try:
+                        connect.executemany(insert, batch)
+                        self.rows_written += len(batch)
+                    except sqlite3.Error:
+                        connect = self.abandon(connect)
+                    batch = []
+            if connect is not None:
+                try:
+                    connect.executemany(insert, batch)
+                    self.rows_written += len(batch)
+                    connect.executemany('INSERT INTO cache_meta VALUES (?, ?)',
+                                        (('version', CACHE_VERSION), ('digest', digest),
+                                         ('mode', self.mode), ('complete', 1)))
+                    connect.execute('COMMIT')
+                    connect = None
+                except sqlite3.Error:
+                    connect = self.abandon(connect)
+        finally:
+            self.abandon(connect)
+
+    def abandon(self, connect):
+        # Roll back a cache rewrite in progress
+        if connect is not None and connect.in_transaction:
+            try:
+                connect.execute('ROLLBACK')
+            except sqlite3.Error:
+                pass
+        return None
+
+    def close(self):
+        if self.connect is not None:
+            self.connect.close()
+            self.connect = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming decompression of .bz2, .gz, .xz and .zst OSM extracts, so they
+can be parsed without writing the uncompressed file to disk. Multi-stream
+bz2 files (as written by pbzip2) are decompressed on a thread pool, one
+group of streams per task; ordinary single-stream bz2 files are streamed
+like the other formats.
+"""
+
+import bz2
+import gzip
+import lzma
+import mmap
+import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSIONS = {'.bz2': 'bz2', '.gz': 'gzip', '.xz': 'xz', '.zst': 'zstd'}
+# bz2 stream header followed by the first block's magic number
+BZ2_STREAM_START = re.compile(rb'BZh[1-9]1AY&SY')
+# Largest stream range decompressed whole, in chunk_bytes; a task holds
+# its range's uncompressed data in memory
+MAX_RANGE_CHUNKS = 2
+DECOMPRESS_ERRORS = (OSError, ValueError, EOFError)
+
+
+def compression_of(file_name):
+    # Compression named by the file suffix, or None
+    for suffix, compression in COMPRESSIONS.items():
+        if file_name.lower().endswith(suffix):
+            return compression
+    return None
+
+
+def strip_compression(file_name):
+    # planet.osm.bz2 -> planet.osm
+    for suffix in COMPRESSIONS:
+        if file_name.lower().endswith(suffix):
+            return file_name[:-len(suffix)]
+    return file_name
+
+
+def open_osm(file_name, workers=None):
+    # Binary file object over the uncompressed contents of an OSM file
+    if compression_of(file_name) is None:
+        return open(file_name, 'rb')
+    return DecompressingReader(file_name, workers)
+
+
+def split_bz2_streams(file_name, chunk_bytes=4 << 20):
+    # (start, end) byte ranges of roughly chunk_bytes, each holding whole
+    # bz2 streams. A single stream file gives one range.
+    with open(file_name, 'rb') as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty file
+            return []
+        try:
+            if not BZ2_STREAM_START.match(data):
+                raise ValueError("{} is not a bz2 file".format(file_name))
+            bounds = [0]
+            while True:
+                match = BZ2_STREAM_START.search(data, bounds[-1] + chunk_bytes)
+                if match is None:
+                    break
+                bounds.append(match.start())
+            bounds.append(len(data))
+        finally:
+            data.close()
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def decompress_range(file_name, start, end):
+    # Task: decompress the bz2 streams in one byte range of the file
+    with open(file_name, 'rb') as f:
+        f.seek(start)
+        return bz2.decompress(f.read(end - start))
+
+
+class DecompressingReader(object):
+    # Read-only binary file object over a compressed OSM file. With
+    # workers > 1, multi-stream bz2 files are decompressed in parallel
+    # with at most workers + 1 ranges in flight, and results read back in
+    # file order. A bz2 file with a single stream, or streams of more than
+    # MAX_RANGE_CHUNKS * chunk_bytes, is streamed instead, as a range is
+    # decompressed whole. compressed_tell() gives the compressed bytes consumed,
+    # for progress against the file size. seek(0) starts over.
+
+    def __init__(self, file_name, workers=None, chunk_bytes=4 << 20):
+        self.file_name = file_name
+        self.compression = compression_of(file_name)
+        self.workers = workers
+        self.chunk_bytes = chunk_bytes
+        self.raw = None
+        self.stream = None
+        self.chunks = None
+        self.open()
+
+    def open(self):
+        self.buffer = b''
+        self.offset = 0
+        self.position = 0
+        self.chunk_end = 0
+        compression = self.compression
+        if compression == 'bz2' and self.workers and self.workers > 1:
+            ranges = split_bz2_streams(self.file_name, self.chunk_bytes)
+            largest = self.chunk_bytes * MAX_RANGE_CHUNKS
+            if len(ranges) > 1 and all(end - start <= largest for start, end in ranges):
+                self.chunks = self.iter_bz2_chunks(ranges)
+                return
+        self.raw = open(self.file_name, 'rb')
+        if compression == 'bz2':
+            self.stream = bz2.BZ2File(self.raw)
+        elif compression == 'gzip':
+            self.stream = gzip.GzipFile(fileobj=self.raw, mode='rb')
+        elif compression == 'xz':
+            self.stream = lzma.LZMAFile(self.raw)
+        elif compression == 'zstd':
+            if zstandard is None:
+                self.raw.close()
+                raise ValueError("Reading .zst files needs the zstandard package")
+            self.stream = zstandard.ZstdDecompressor().stream_reader(self.raw, read_across_frames=True)
+        else:
+            self.raw.close()
+            raise ValueError("Unsupported compression for {}".format(self.file_name))
+
+    def iter_bz2_chunks(self, ranges):
+        # Decompressed data of each range of split_bz2_streams, in order
+        file_name = self.file_name
+        ranges = deque(ranges)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = deque()
+
+            def submit():
+                if ranges:
+                    start, end = ranges.popleft()
+                    pending.append((start, end, executor.submit(decompress_range, file_name, start, end)))
+
+            for __ in range(self.workers + 1):
+                submit()
+            while pending:
+                start, end, future = pending.popleft()
+                try:
+                    data = future.result()
+                except DECOMPRESS_ERRORS:
+                    # The stream header pattern also turned up inside
+                    # compressed data and split a stream; retry the range
+                    # joined with the ones after it
+                    while True:
+                        submit()
+                        if not pending:
+                            raise
+                        __, end, later = pending.popleft()
+                        later.cancel()
+                        try:
+                            data = decompress_range(file_name, start, end)
+                            break
+                        except DECOMPRESS_ERRORS:
+                            continue
+                submit()
+                self.chunk_end = end
+                yield data
+
+    def read(self, size=-1):
+        self.check_open()
+        if self.stream is not None:
+            data = self.stream.read(size)
+        else:
+            data = self.read_chunks(size)
+        self.position += len(data)
+        return data
+
+    def read_chunks(self, size):
+        parts = []
+        wanted = size if size is not None and size >= 0 else None
+        while wanted is None or wanted > 0:
+            if self.offset >= len(self.buffer):
+                self.buffer = next(self.chunks, b'')
+                self.offset = 0
+                if not self.buffer:
+                    break
+            stop = len(self.buffer) if wanted is None else min(len(self.buffer), self.offset + wanted)
+            parts.append(self.buffer[self.offset:stop])
+            if wanted is not None:
+                wanted -= stop - self.offset
+            self.offset = stop
+        return b''.join(parts)
+
+    def tell(self):
+        # Uncompressed bytes read
+        return self.position
+
+    def compressed_tell(self):
+        if self.raw is not None:
+            return self.raw.tell()
+        return self.chunk_end
+
+    def seek(self, offset, whence=0):
+        # Only rewinding is supported, by reopening the file
+        if offset != 0 or whence != 0:
+            raise ValueError("Compressed input can only seek to the start")
+        self.close()
+        self.open()
+        return 0
+
+    def check_open(self):
+        if self.stream is None and self.chunks is None:
+            raise ValueError("I/O operation on closed file")
+
+    @property
+    def closed(self):
+        return self.stream is None and self.chunks is None
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+        if self.raw is not None:
+            self.raw.close()
+            self.raw = None
+        if self.chunks is not None:
+            self.chunks.close()
+            self.chunks = None
+        self.buffer = b''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+Reader for OsmChange (.osc) replication diffs, yielding the settlement
+tags of every created, modified or deleted element.
+"""
+
+import gzip
+import os
+import re
+import xml.parsers.expat
+
+from osm_popul_extract import Candidate, ELEMENTS, SOURCE_PREFIX, TAG_KEYS, attr_dict
+
+ACTIONS = frozenset(('create', 'modify', 'delete'))
+SEQUENCE_LINE = re.compile(r'^sequenceNumber=(\d+)\s*$', re.M)
+
+
+def open_osc(file_name):
+    # Replication diffs are usually gzipped
+    if file_name.endswith('.gz'):
+        return gzip.open(file_name, 'rb')
+    return open(file_name, 'rb')
+
+
+def state_file_name(osc_name):
+    # 123.osc.gz -> 123.state.txt, the layout of replication directories
+    base = osc_name
+    for suffix in ('.gz', '.osc'):
+        if base.endswith(suffix):
+            base = base[:-len(suffix)]
+    return base + '.state.txt'
+
+
+def read_sequence(osc_name):
+    # Sequence number from the state file next to a diff, or None
+    state_name = state_file_name(osc_name)
+    if not os.path.exists(state_name):
+        return None
+    with open(state_name, encoding='utf8') as f:
+        match = SEQUENCE_LINE.search(f.read())
+    return int(match.group(1)) if match else None
+
+
+def iter_changes(osc_file, chunk_size=1 << 16):
+    # Yield (action, candidate) for every element of an open .osc file.
+    # Unlike TagExtractor every element is emitted, since a modify that
+    # drops the population tag or a delete still changes the stored tables.
+    found = []
+    # [action, kind, ordered attributes, tags]
+    state = [None, None, None, None]
+
+    def start(tag, attrs):
+        if tag == 'tag':
+            tags = state[3]
+            if tags is None:
+                return
+            attrs = attr_dict(attrs)
+            key = attrs.get('k', '')
+            if key in TAG_KEYS:
+                tags[key] = attrs.get('v')
+            elif key.startswith(SOURCE_PREFIX):
+                tags['source'] = attrs.get('v')
+        elif tag in ELEMENTS:
+            if state[0] is not None:
+                state[1] = tag
+                state[2] = attrs
+                state[3] = {}
+        elif tag in ACTIONS:
+            state[0] = tag
+
+    def end(tag):
+        if tag == state[1]:
+            attrs = attr_dict(state[2])
+            tags = state[3]
+            found.append((state[0], Candidate(tag, attrs.get('id'), attrs.get('user'),
+                                              attrs.get('uid'), attrs.get('timestamp'),
+                                              tags.get('name'), tags.get('place'),
+                                              tags.get('population'), tags.get('source'),
+                                              attrs.get('lat'), attrs.get('lon'))))
+            state[1] = state[2] = state[3] = None
+        elif tag in ACTIONS:
+            state[0] = None
+
+    parser = xml.parsers.expat.ParserCreate()
+    parser.ordered_attributes = True
+    parser.StartElementHandler = start
+    parser.EndElementHandler = end
+    while True:
+        chunk = osc_file.read(chunk_size)
+        if not chunk:
+            break
+        parser.Parse(chunk, False)
+        for change in found:
+            yield change
+        del found[:]
+    parser.Parse(b'', True)
+    for change in found:
+        yield change
@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+"""
+Normalized lookup index over the Texas population estimates csv, with a
+cached fuzzy fallback for names that miss the exact lookup, and a place x
+year series of many estimate vintages loaded in parallel.
+"""
+
+import csv
+import difflib
+import os
+import pickle
+import re
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+import numpy as np
+
+INDEX_VERSION = 2
+ABBREVIATIONS = {'st': 'saint', 'ste': 'sainte', 'ft': 'fort', 'mt': 'mount',
+                 'pt': 'point', 'n': 'north', 's': 'south', 'e': 'east', 'w': 'west'}
+SUFFIXES = frozenset(('city', 'town', 'village', 'cdp'))
+PUNCTUATION = re.compile(r"[^\w\s]+")
+YEAR = re.compile(r'(?<!\d)(?:19|20)\d\d(?!\d)')
+# A vintage file's estimates are for January 1st of the following year,
+# as in 2015_txpopest_place.csv holding the 1-1-2016 estimates
+ESTIMATE_YEAR_OFFSET = 1
+# Matrix value of a place missing from a vintage
+MISSING = -1
+
+
+def canonical_name(name):
+    # Lower case, drop punctuation and expand abbreviations
+    words = PUNCTUATION.sub(' ', name.lower()).split()
+    return ' '.join(ABBREVIATIONS.get(word, word) for word in words)
+
+
+def normalize_name(name):
+    # canonical_name, also stripping a trailing city/town/village/CDP
+    # unless it is the whole name
+    words = canonical_name(name).split()
+    while len(words) > 1 and words[-1] in SUFFIXES:
+        words.pop()
+    return ' '.join(words)
+
+
+def parse_count(value):
+    return int(value.replace(',', '').strip())
+
+
+def read_estimates(file_name):
+    # (key, place, 2010 census, estimate) for each row of an estimates
+    # csv. row[0] = county, row[1] = place, row[2] = 2010 US Census
+    # figure, row[4] = Texas estimate; rows without figures (header,
+    # notes) are skipped. key is (canonical name, normalized county), so
+    # "Lakeside" and "Lakeside City" stay apart.
+    rows = []
+    with open(file_name, encoding='utf8', newline='') as f:
+        for row in csv.reader(f):
+            if len(row) < 5:
+                continue
+            try:
+                census = parse_count(row[2])
+                estimate = parse_count(row[4])
+            except ValueError:
+                continue
+            rows.append(((canonical_name(row[1]), normalize_name(row[0])), row[1], census, estimate))
+    return rows
+
+
+def vintage_year(file_name):
+    # Year of the estimates in a vintage file, from the first year in its
+    # name: 2015_txpopest_place.csv -> 2016
+    match = YEAR.search(os.path.basename(file_name))
+    if match is None:
+        raise ValueError("No year in estimates file name {}".format(file_name))
+    return int(match.group()) + ESTIMATE_YEAR_OFFSET
+
+
+class EstimateIndex(object):
+    # Estimates keyed by (canonical name, normalized county). Each entry is
+    # (place name as in the csv, 2010 census, 2016 estimate). by_raw maps
+    # a csv place name, and by_name a normalized one, to every key holding
+    # it in csv order. A name held by more than one place is ambiguous and
+    # matches none of them, rather than the last row winning.
+
+    def __init__(self, entries=None, fuzzy_cutoff=0.9):
+        self.entries = entries or {}
+        self.fuzzy_cutoff = fuzzy_cutoff
+        self.by_raw = {}
+        self.by_name = {}
+        for key, entry in self.entries.items():
+            self.by_raw.setdefault(entry[0], []).append(key)
+            self.by_name.setdefault(normalize_name(key[0]), []).append(key)
+        self.names = sorted(self.by_name)
+        self.fuzzy = lru_cache(maxsize=4096)(self.fuzzy_match)
+
+    @classmethod
+    def from_csv(cls, file_name):
+        # Index of one estimates csv, see read_estimates
+        entries = {}
+        for key, name, census, estimate in read_estimates(file_name):
+            entries[key] = (name, census, estimate)
+        return cls(entries)
+
+    @classmethod
+    def load(cls, file_name):
+        # Index for an estimates csv, read from the binary .idx file next to
+        # it while that still matches the csv's size and mtime
+        stat = os.stat(file_name)
+        stamp = (INDEX_VERSION, stat.st_size, stat.st_mtime_ns)
+        index_name = file_name + '.idx'
+        try:
+            with open(index_name, 'rb') as f:
+                saved_stamp, entries = pickle.load(f)
+            if saved_stamp == stamp:
+                return cls(entries)
+        except (IOError, OSError, ValueError, EOFError, pickle.UnpicklingError):
+            pass
+        index = cls.from_csv(file_name)
+        try:
+            with open(index_name, 'wb') as f:
+                pickle.dump((stamp, index.entries), f, pickle.HIGHEST_PROTOCOL)
+        except (IOError, OSError):
+            # Read only location, rebuild next time
+            pass
+        return index
+
+    def __getstate__(self):
+        # The fuzzy cache is per process and not picklable
+        return (self.entries, self.fuzzy_cutoff)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def fuzzy_match(self, norm):
+        matches = difflib.get_close_matches(norm, self.names, n=1, cutoff=self.fuzzy_cutoff)
+        return self.by_name[matches[0]] if matches else None
+
+    def unique(self, keys, name):
+        # The one key of keys, or the one whose canonical name is name's;
+        # None when there is none or the match is ambiguous
+        if keys and len(keys) > 1:
+            canonical = canonical_name(name)
+            keys = [key for key in keys if key[0] == canonical]
+        return keys[0] if keys and len(keys) == 1 else None
+
+    def lookup(self, name, county=None, fuzzy=True):
+        # Entry for an OSM settlement name, or None. The (name, county) key
+        # is tried first when county is given, then the csv name, the
+        # normalized name and the fuzzy fallback.
+        if not name:
+            return None
+        if county is not None:
+            entry = self.entries.get((canonical_name(name), normalize_name(county)))
+            if entry is not None:
+                return entry
+        keys = self.by_raw.get(name)
+        if keys is not None:
+            key = self.unique(keys, name)
+            return self.entries[key] if key is not None else None
+        norm = normalize_name(name)
+        keys = self.by_name.get(norm)
+        if keys is None and fuzzy:
+            keys = self.fuzzy(norm)
+        key = self.unique(keys, name)
+        return self.entries[key] if key is not None else None
+
+    def is_ambiguous(self, name):
+        # Whether name matches more than one place
+        keys = self.by_raw.get(name) or self.by_name.get(normalize_name(name))
+        return keys is not None and len(keys) > 1 and self.unique(keys, name) is None
+
+    def match_rates(self, names):
+        # Share of names found by exact csv name, normalized key and fuzzy
+        # fallback, and of names left unmatched as ambiguous
+        total = exact = normalized = fuzzy = ambiguous = 0
+        for name in names:
+            total += 1
+            if name in self.by_raw:
+                exact += 1
+            if self.is_ambiguous(name):
+                ambiguous += 1
+            if self.lookup(name, fuzzy=False) is not None:
+                normalized += 1
+            if self.lookup(name) is not None:
+                fuzzy += 1
+        return {'names': total, 'exact': exact, 'normalized': normalized, 'fuzzy': fuzzy,
+                'ambiguous': ambiguous}
+
+
+class EstimateSeries(object):
+    # Estimates of many vintages as a place x year int32 matrix, values,
+    # with MISSING where a vintage lacks a place. Places are rows keyed by
+    # (canonical name, normalized county) as in EstimateIndex, years are
+    # columns in increasing order; both are found through dicts, so a
+    # lookup is O(1). names holds each place's csv name and census its
+    # 2010 census figure, both from the latest vintage listing it.
+
+    def __init__(self, keys, names, census, years, values):
+        self.keys = keys
+        self.names = names
+        self.census = census
+        self.years = years
+        self.values = values
+        self.rows = dict((key, row) for row, key in enumerate(keys))
+        self.columns = dict((year, column) for column, year in enumerate(years.tolist()))
+        # Column of each place's latest estimate
+        known = values != MISSING
+        self.latest_column = values.shape[1] - 1 - np.argmax(known[:, ::-1], axis=1)
+        self.latest_column[~known.any(axis=1)] = MISSING
+
+    @classmethod
+    def from_vintages(cls, vintages, workers=None):
+        # Series of vintage estimates files, given as file names (see
+        # vintage_year) or (year, file name) pairs, read on up to workers
+        # processes. Later vintages win for a place's name and census.
+        vintages = sorted((vintage_year(vintage), vintage) if isinstance(vintage, str) else tuple(vintage)
+                          for vintage in vintages)
+        years = [year for year, __ in vintages]
+        if len(set(years)) != len(years):
+            raise ValueError("More than one estimates file for a year: {}".format(vintages))
+        file_names = [file_name for __, file_name in vintages]
+        workers = workers or min(len(file_names), os.cpu_count() or 1)
+        if workers < 2:
+            tables = [read_estimates(file_name) for file_name in file_names]
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                tables = list(executor.map(read_estimates, file_names))
+        rows = {}
+        keys = []
+        names = []
+        census = []
+        cells = []
+        for column, table in enumerate(tables):
+            for key, name, place_census, estimate in table:
+                row = rows.get(key)
+                if row is None:
+                    row = rows[key] = len(keys)
+                    keys.append(key)
+                    names.append(name)
+                    census.append(place_census)
+                else:
+                    names[row] = name
+                    census[row] = place_census
+                cells.append((row, column, estimate))
+        values = np.full((len(keys), len(years)), MISSING, dtype=np.int32)
+        if cells:
+            cells = np.array(cells, dtype=np.int64)
+            values[cells[:, 0], cells[:, 1]] = cells[:, 2]
+        return cls(keys, names, np.array(census, dtype=np.int32), np.array(years, dtype=np.int32),
+                   values)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def value(self, key, year):
+        # Estimate of a vintage year, or None
+        row = self.rows.get(key)
+        column = self.columns.get(year)
+        if row is None or column is None or self.values[row, column] == MISSING:
+            return None
+        return int(self.values[row, column])
+
+    def latest(self, key):
+        # (year, estimate) of a place's most recent vintage, or None
+        row = self.rows.get(key)
+        if row is None or self.latest_column[row] == MISSING:
+            return None
+        column = self.latest_column[row]
+        return int(self.years[column]), int(self.values[row, column])
+
+    def interpolate(self, key, year):
+        # Estimate for year, linear between the vintages around it and
+        # the nearest vintage's outside them, or None
+        row = self.rows.get(key)
+        if row is None:
+            return None
+        values = self.values[row]
+        known = values != MISSING
+        if not known.any():
+            return None
+        column = self.columns.get(year)
+        if column is not None and known[column]:
+            return int(values[column])
+        return int(round(float(np.interp(year, self.years[known], values[known]))))
+
+    def estimate(self, key, year=None):
+        # Latest estimate, or the one interpolated to year
+        if year is None:
+            latest = self.latest(key)
+            return latest[1] if latest is not None else None
+        return self.interpolate(key, year)
+
+    def estimate_index(self, year=None, fuzzy_cutoff=0.9):
+        # EstimateIndex over every place, holding estimate(key, year)
+        entries = {}
+        for row, key in enumerate(self.keys):
+            estimate = self.estimate(key, year)
+            if estimate is not None:
+                entries[key] = (self.names[row], int(self.census[row]), estimate)
+        return EstimateIndex(entries, fuzzy_cutoff)
+
+    def pop_est(self, year=None):
+        # Plain {csv place name: [census, estimate]} dict, like the one
+        # get_popul_est builds, for exact name lookups
+        pop_est = {}
+        for name, census, estimate in self.estimate_index(year).entries.values():
+            pop_est[name] = [census, estimate]
+        return pop_est
+
+
+def read_pop_est(file_name):
+    # Plain {csv place name: [2010 census, 1-1-2016 estimate]} dict of an
+    # estimates csv, with the figures as written in the csv
+    pop_est = {}
+    with open(file_name, encoding='utf8', newline='') as f:
+        for row in csv.reader(f):
+            if len(row) >= 5:
+                pop_est[row[1]] = [row[2], row[4]]
+    return pop_est
+
+
+def load_estimates(estimates, year=None, workers=None):
+    # (pop_est, est_index) for Popul.use_estimates, read without an OSM
+    # file. estimates is one estimates csv, or a list of vintage files
+    # (see EstimateSeries.from_vintages) whose latest estimates, or ones
+    # interpolated to year, are used.
+    if isinstance(estimates, str):
+        return read_pop_est(estimates), EstimateIndex.load(estimates)
+    series = EstimateSeries.from_vintages(estimates, workers)
+    return series.pop_est(year), series.estimate_index(year)
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+"""
+Export of the cleaned settlements as OsmChange (.osc) edits. The original
+extract is streamed once; every element whose population, place or
+source:population tags differ from the cleaned values is written back as
+a <modify> with its version, nodes or members and other tags unchanged.
+Output is split into one file per changeset of changeset_size elements.
+
+The API rejects a modify without the element's current version, so the
+extract must carry metadata: PBF files written with it (osmium's
+add_metadata, the default for planet and Geofabrik extracts) or XML with
+version attributes. Elements without a version are counted and left out.
+"""
+
+import glob
+import json
+import os
+import sqlite3
+import xml.parsers.expat
+from collections import namedtuple
+from xml.sax.saxutils import quoteattr
+
+from osm_popul_compress import open_osm
+from osm_popul_extract import ELEMENTS, attr_dict
+from osm_popul_pbf import PBFReader
+
+# Attributes kept on exported elements; user, uid, timestamp and the old
+# changeset are set by the server on upload
+KEEP_ATTRIBUTES = ('id', 'version', 'lat', 'lon')
+SOURCE_KEY = 'source:population'
+DEFAULT_SOURCE = 'Texas Demographic Center population estimates'
+DEFAULT_COMMENT = 'Update settlement populations and place classes from Texas population estimates'
+
+# Cleaned values for one settlement. osm_population and name identify the
+# original element; place is None when the place class is unchanged.
+Edit = namedtuple('Edit', ('elem_id', 'name', 'osm_population', 'population', 'place', 'kind'))
+
+EDITS_QUERY = """
+    SELECT places.kind, places.node_id, places.name, popul.osm_population, popul.pop_2016,
+           CASE WHEN places.place_change THEN places.place END
+    FROM settlement_places AS places
+    JOIN settlement_popul AS popul ON popul.node_id = places.node_id AND popul.kind = places.kind
+        AND popul.name = places.name"""
+
+
+def edits_from_table(table):
+    # {(kind, element id string): Edit} for the settlements of a
+    # SettlementTable
+    edits = {}
+    for kind, elem_id, name, place, place_change, osm_population, population in zip(
+            table.column('kind'), table.node_id, table.column('name'), table.column('place'),
+            table.column('place_change'), table.column('osm_population'), table.pop_2016):
+        edits[(kind, str(elem_id))] = Edit(str(elem_id), name, osm_population, population,
+                                           place if place_change else None, kind)
+    return edits
+
+
+def edits_from_sqlite(db_path):
+    # {(kind, element id string): Edit} for the settlement tables in db_path
+    connect = sqlite3.connect(db_path)
+    try:
+        rows = connect.execute(EDITS_QUERY).fetchall()
+    finally:
+        connect.close()
+    return dict(((kind, str(elem_id)), Edit(str(elem_id), name, str(osm_population), population, place, kind))
+                for kind, elem_id, name, osm_population, population, place in rows)
+
+
+def revised_tags(tags, edit, source):
+    # New (key, value) tag list for an element, or None when the element
+    # is not the edit's settlement or nothing changes. tags is a list of
+    # (key, value) pairs in their original order.
+    current = dict(tags)
+    if current.get('name') != edit.name or current.get('population') != edit.osm_population:
+        # Edited since the cleaning run
+        return None
+    changes = {}
+    if str(edit.population) != edit.osm_population:
+        changes['population'] = str(edit.population)
+        if source and current.get(SOURCE_KEY) != source:
+            changes[SOURCE_KEY] = source
+    if edit.place is not None and current.get('place') != edit.place:
+        changes['place'] = edit.place
+    if not changes:
+        return None
+    revised = [(key, changes.pop(key, value)) for key, value in tags]
+    revised.extend(sorted(changes.items()))
+    return revised
+
+
+def element_xml(kind, attrs, tags, children):
+    # OsmChange text of one element. attrs are (name, value) pairs,
+    # children the nd or member elements as (tag, attribute pairs).
+    lines = ['  <{} {}>\n'.format(kind, ' '.join('{}={}'.format(name, quoteattr(value))
+                                                  for name, value in attrs
+                                                  if name in KEEP_ATTRIBUTES))]
+    for tag, child_attrs in children:
+        lines.append('    <{} {}/>\n'.format(tag, ' '.join('{}={}'.format(name, quoteattr(value))
+                                                         for name, value in child_attrs)))
+    for key, value in tags:
+        lines.append('    <tag k={} v={}/>\n'.format(quoteattr(key), quoteattr(value)))
+    lines.append('  </{}>\n'.format(kind))
+    return ''.join(lines)
+
+
+class ChangesetWriter(object):
+    # Writes <modify> elements to <out_dir>/<prefix>_<n>.osc files of at
+    # most changeset_size elements each, one file per changeset to upload.
+    # Files are written under a temporary name and moved into place on
+    # close, replacing the files of an earlier export, with a
+    # <prefix>.json summary of the files and the changeset tags to use.
+
+    def __init__(self, out_dir, changeset_size=1000, prefix='settlements', tags=None):
+        if changeset_size < 1:
+            raise ValueError("changeset_size must be at least 1, got {}".format(changeset_size))
+        if not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+        self.out_dir = out_dir
+        self.changeset_size = changeset_size
+        self.prefix = prefix
+        self.tags = tags or {}
+        self.files = []
+        self.out_file = None
+        self.in_file = 0
+        self.elements = dict((kind, 0) for kind in ('node', 'way', 'relation'))
+
+    def file_name(self, number):
+        return os.path.join(self.out_dir, '{}_{:04d}.osc'.format(self.prefix, number))
+
+    def write(self, kind, text):
+        if self.out_file is None:
+            self.files.append({'file': self.file_name(len(self.files) + 1), 'elements': 0})
+            self.out_file = open(self.files[-1]['file'] + '.tmp', 'w', encoding='utf8')
+            self.out_file.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                                '<osmChange version="0.6" generator="osm_popul_export">\n <modify>\n')
+        self.out_file.write(text)
+        self.files[-1]['elements'] += 1
+        self.elements[kind] += 1
+        if self.files[-1]['elements'] >= self.changeset_size:
+            self.end_file()
+
+    def end_file(self):
+        if self.out_file is not None:
+            self.out_file.write(' </modify>\n</osmChange>\n')
+            self.out_file.close()
+            self.out_file = None
+
+    def close(self):
+        self.end_file()
+        names = set(entry['file'] for entry in self.files)
+        for stale in glob.glob(os.path.join(self.out_dir, '{}_[0-9][0-9][0-9][0-9].osc'.format(self.prefix))):
+            if stale not in names:
+                os.remove(stale)
+        for entry in self.files:
+            os.replace(entry['file'] + '.tmp', entry['file'])
+        with open(os.path.join(self.out_dir, self.prefix + '.json'), 'w', encoding='utf8') as f:
+            json.dump(self.stats(), f, indent=2, sort_keys=True)
+
+    def abort(self):
+        if self.out_file is not None:
+            self.out_file.close()
+            self.out_file = None
+        for entry in self.files:
+            if os.path.exists(entry['file'] + '.tmp'):
+                os.remove(entry['file'] + '.tmp')
+
+    def stats(self):
+        return {'changesets': self.files,
+                'changeset_tags': self.tags,
+                'elements': dict(self.elements)}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+
+class ChangeExporter(object):
+    # One streaming pass over an OSM file writing the edits, a dict of
+    # (kind, element id string) -> Edit, as OsmChange files. Only the
+    # element being read is held in memory; children are kept only for
+    # elements with an edit. Elements are also matched on name and
+    # original population, so an element edited since the cleaning run
+    # is left alone.
+
+    def __init__(self, file_name, edits, source=DEFAULT_SOURCE, chunk_size=1 << 16):
+        self.file_name = file_name
+        self.edits = edits
+        self.source = source
+        self.chunk_size = chunk_size
+        self.modified = 0
+        # Elements with an edit that were edited since, or had nothing to
+        # change
+        self.skipped = 0
+        # Elements with an edit but no version, from an extract written
+        # without metadata
+        self.unversioned = 0
+
+    def export(self, writer):
+        if self.file_name.lower().endswith('.pbf'):
+            self.export_pbf(writer)
+        else:
+            self.export_xml(writer)
+        return writer.stats()
+
+    def write_element(self, writer, kind, elem_id, attrs, tags, children):
+        if dict(attrs).get('version') is None:
+            self.unversioned += 1
+            return
+        tags = revised_tags(tags, self.edits[(kind, elem_id)], self.source)
+        if tags is None:
+            self.skipped += 1
+            return
+        self.modified += 1
+        writer.write(kind, element_xml(kind, attrs, tags, children))
+
+    def export_pbf(self, writer):
+        edits = self.edits
+        for kind, elem_id, info, tags, lat, lon, members in PBFReader(self.file_name).iter_primitives(members=True):
+            if (kind, elem_id) not in edits:
+                continue
+            attrs = [('id', elem_id), ('version', info.get('version'))]
+            children = []
+            if kind == 'node':
+                attrs.extend((('lat', lat), ('lon', lon)))
+            elif kind == 'way':
+                children = [('nd', (('ref', str(ref)),)) for ref in members]
+            else:
+                children = [('member', (('type', member_type), ('ref', str(ref)), ('role', role)))
+                            for member_type, ref, role in members]
+            self.write_element(writer, kind, elem_id, attrs, list(tags.items()), children)
+
+    def export_xml(self, writer):
+        edits = self.edits
+        # Open element with an edit as [kind, id, attribute pairs, tags, children]
+        state = [None, None, None, None, None]
+
+        def start(tag, attrs):
+            if state[0] is not None:
+                if tag == 'tag':
+                    attrs = attr_dict(attrs)
+                    state[3].append((attrs.get('k', ''), attrs.get('v', '')))
+                elif tag in ('nd', 'member'):
+                    state[4].append((tag, list(zip(attrs[::2], attrs[1::2]))))
+            elif tag in ELEMENTS:
+                elem_id = attrs[1] if attrs[0] == 'id' else attr_dict(attrs).get('id')
+                if (tag, elem_id) in edits:
+                    state[0] = tag
+                    state[1] = elem_id
+                    state[2] = list(zip(attrs[::2], attrs[1::2]))
+                    state[3] = []
+                    state[4] = []
+
+        def end(tag):
+            if tag == state[0]:
+                self.write_element(writer, *state)
+                state[0] = state[1] = state[2] = state[3] = state[4] = None
+
+        parser = xml.parsers.expat.ParserCreate()
+        parser.ordered_attributes = True
+        parser.StartElementHandler = start
+        parser.EndElementHandler = end
+        with open_osm(self.file_name) as osm_file:
+            while True:
+                chunk = osm_file.read(self.chunk_size)
+                if not chunk:
+                    break
+                parser.Parse(chunk, False)
+            parser.Parse(b'', True)
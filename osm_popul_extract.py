@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming extraction of settlement tags from OSM XML. Tags are collected
+from expat start events as the file is read, so no element trees are
+built for the nodes, ways and relations that carry no settlement data.
+"""
+
+import mmap
+import re
+import xml.parsers.expat
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from osm_popul_stats import OSMStats
+
+ELEMENTS = frozenset(('node', 'way', 'relation'))
+TAG_KEYS = frozenset(('name', 'place', 'population'))
+SOURCE_PREFIX = 'source:population'
+# Start of a top level element; '<' only occurs unescaped at tag starts
+ELEMENT_START = re.compile(rb'<(?:node|way|relation)[\s/>]')
+POPULATION_KEY = re.compile(rb'k=["\']population["\']')
+
+# One element carrying a place and/or population tag; lat and lon are
+# None for ways and relations
+Candidate = namedtuple('Candidate', ('kind', 'elem_id', 'user', 'uid', 'timestamp',
+                                     'name', 'place', 'popul', 'source', 'lat', 'lon'))
+
+
+def attr_dict(attrs):
+    # expat ordered attributes [k1, v1, k2, v2, ...] as a dict
+    return dict(zip(attrs[::2], attrs[1::2]))
+
+
+class TagExtractor(object):
+    # State machine over expat start/end events. A start event for a node,
+    # way or relation opens an element, start events for its tags fill in
+    # only the keys in TAG_KEYS and source:population*, and the matching end
+    # event emits a Candidate if a place or population tag was seen. No
+    # element objects are built, so untagged nodes and the nd/member
+    # children of ways and relations cost a single callback each. Given an
+    # OSMStats, every element and tag key is also counted into it.
+
+    def __init__(self, chunk_size=1 << 16, stats=None):
+        self.chunk_size = chunk_size
+        self.stats = stats
+        self.elements = 0
+        self.candidates = 0
+        self.found = []
+
+    def make_parser(self):
+        found = self.found
+        # Open element as [kind, ordered attributes, tags]
+        state = [None, None, None]
+        elements = ELEMENTS
+        keys = TAG_KEYS
+        stats = self.stats
+        tag_keys = counts = users = years = None
+        if stats is not None:
+            # Counted inline, this runs for every element in the file
+            tag_keys = stats.tag_keys
+            counts = stats.elements
+            users = stats.users
+            years = stats.years
+
+        def start(tag, attrs):
+            if tag == 'tag':
+                tags = state[2]
+                if tags is None:
+                    return
+                if len(attrs) == 4 and attrs[0] == 'k' and attrs[2] == 'v':
+                    key = attrs[1]
+                    value = attrs[3]
+                else:
+                    attrs = attr_dict(attrs)
+                    key = attrs.get('k', '')
+                    value = attrs.get('v')
+                if tag_keys is not None:
+                    tag_keys[key] = tag_keys.get(key, 0) + 1
+                if key in keys:
+                    tags[key] = value
+                elif key.startswith(SOURCE_PREFIX):
+                    tags['source'] = value
+            elif tag in elements:
+                state[0] = tag
+                state[1] = attrs
+                state[2] = {}
+
+        def end(tag):
+            if tag != state[0]:
+                return
+            self.elements += 1
+            tags = state[2]
+            attrs = None
+            if counts is not None:
+                attrs = attr_dict(state[1])
+                counts[tag] = counts.get(tag, 0) + 1
+                user = attrs.get('user')
+                users[user] = users.get(user, 0) + 1
+                year = (attrs.get('timestamp') or '')[:4]
+                years[year] = years.get(year, 0) + 1
+            if 'population' in tags or 'place' in tags:
+                if attrs is None:
+                    attrs = attr_dict(state[1])
+                self.candidates += 1
+                found.append(Candidate(tag, attrs.get('id'), attrs.get('user'),
+                                       attrs.get('uid'), attrs.get('timestamp'),
+                                       tags.get('name'), tags.get('place'),
+                                       tags.get('population'), tags.get('source'),
+                                       attrs.get('lat'), attrs.get('lon')))
+            state[0] = state[1] = state[2] = None
+
+        parser = xml.parsers.expat.ParserCreate()
+        parser.ordered_attributes = True
+        parser.StartElementHandler = start
+        parser.EndElementHandler = end
+        return parser
+
+    def iter_file(self, osm_file):
+        # Yield candidates from an open OSM file, reading chunk_size bytes
+        # (or characters for text mode files) at a time
+        parser = self.make_parser()
+        found = self.found
+        while True:
+            chunk = osm_file.read(self.chunk_size)
+            if not chunk:
+                break
+            parser.Parse(chunk, False)
+            if found:
+                for candidate in found:
+                    yield candidate
+                del found[:]
+        parser.Parse(b'', True)
+        for candidate in found:
+            yield candidate
+        del found[:]
+
+    def parse_bytes(self, data):
+        # Return candidates from a self-contained block of XML bytes
+        parser = self.make_parser()
+        parser.Parse(data, True)
+        found = list(self.found)
+        del self.found[:]
+        return found
+
+
+class PopulationScanner(object):
+    # Pre-filter for OSM files. The file is memory-mapped and searched at
+    # byte level for population keys; only the enclosing elements are passed
+    # (as memoryview slices of the map) to the expat state machine, and the
+    # rest of the file is never decoded.
+
+    def __init__(self, window=1 << 16):
+        self.window = window
+        self.bytes_total = 0
+        self.bytes_parsed = 0
+        self.position = 0
+        self.elements_parsed = 0
+        self.candidates = 0
+
+    def element_start(self, data, lower, pos):
+        # Last element start tag in data[lower:pos], searching backwards in
+        # growing windows
+        window = self.window
+        while True:
+            begin = max(lower, pos - window)
+            match = None
+            for match in ELEMENT_START.finditer(data, begin, pos):
+                pass
+            if match is not None or begin == lower:
+                return match
+            window *= 2
+
+    def iter_file(self, file_name):
+        # Yield candidates for every element holding a population tag
+        extractor = TagExtractor()
+        parser = extractor.make_parser()
+        found = extractor.found
+        with open(file_name, 'rb') as f:
+            try:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # Empty file
+                return
+            view = memoryview(data)
+            try:
+                self.bytes_total = len(data)
+                parser.Parse(b'<osm>', False)
+                last_end = 0
+                for match in POPULATION_KEY.finditer(data):
+                    pos = match.start()
+                    if pos < last_end:
+                        # Another population tag of the element just parsed
+                        continue
+                    start = self.element_start(data, last_end, pos)
+                    if start is None:
+                        continue
+                    kind = start.group()[1:-1]
+                    end = data.find(b'</' + kind + b'>', pos)
+                    if end < 0:
+                        continue
+                    end += len(kind) + 3
+                    parser.Parse(view[start.start():end], False)
+                    self.bytes_parsed += end - start.start()
+                    self.elements_parsed += 1
+                    last_end = self.position = end
+                    if found:
+                        self.candidates += len(found)
+                        for candidate in found:
+                            yield candidate
+                        del found[:]
+                parser.Parse(b'</osm>', True)
+                self.position = self.bytes_total
+            finally:
+                view.release()
+                data.close()
+
+    def stats(self):
+        return {'bytes_total': self.bytes_total,
+                'bytes_parsed': self.bytes_parsed,
+                'bytes_skipped': self.bytes_total - self.bytes_parsed,
+                'elements_parsed': self.elements_parsed,
+                'candidates': self.candidates}
+
+
+def split_ranges(file_name, chunk_bytes=64 << 20):
+    # Split an OSM file into (start, end) byte ranges of roughly chunk_bytes
+    # each. Every range starts at a <node, <way or <relation tag, and the
+    # ranges together cover all top level elements up to </osm>.
+    with open(file_name, 'rb') as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty file
+            return []
+        try:
+            first = ELEMENT_START.search(data)
+            if first is None:
+                return []
+            end = data.rfind(b'</osm>')
+            if end < first.start():
+                end = len(data)
+            bounds = [first.start()]
+            while True:
+                match = ELEMENT_START.search(data, bounds[-1] + chunk_bytes, end)
+                if match is None:
+                    break
+                bounds.append(match.start())
+            bounds.append(end)
+        finally:
+            data.close()
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def extract_range(file_name, start, end, collect_stats=False):
+    # Worker: (candidates, OSMStats or None) for the elements in one byte
+    # range of the file
+    with open(file_name, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    stats = OSMStats() if collect_stats else None
+    found = TagExtractor(stats=stats).parse_bytes(b'<osm>' + data + b'</osm>')
+    return found, stats
+
+
+def iter_parallel(file_name, workers, chunk_bytes=64 << 20, stats=None):
+    # Yield candidates from a process pool, one task per byte range. Results
+    # come back in file order, so callers see the same sequence as a serial
+    # parse. Each range's counts are merged into stats when given.
+    ranges = split_ranges(file_name, chunk_bytes)
+    if not ranges:
+        return
+    starts = [start for start, __ in ranges]
+    ends = [end for __, end in ranges]
+    collect = [stats is not None] * len(ranges)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for found, range_stats in executor.map(extract_range, [file_name] * len(ranges),
+                                               starts, ends, collect):
+            if range_stats is not None:
+                stats.merge(range_stats)
+            for candidate in found:
+                yield candidate
@@ -0,0 +1,487 @@
+# -*- coding: utf-8 -*-
+"""
+Bounded-memory node location store and the resolution of way and
+relation settlements to a single location. Node locations are kept on
+disk as two memory-mapped arrays sorted by node id, so member nodes are
+found by binary search instead of a dict of every node in the file.
+"""
+
+import json
+import os
+import xml.parsers.expat
+
+import numpy as np
+
+from osm_popul_compress import open_osm
+from osm_popul_extract import attr_dict
+from osm_popul_pbf import PBFReader, PrimitiveBlock, decode_blob
+from osm_popul_stats import file_stamp
+
+STORE_VERSION = 1
+# Stored coordinates are integers in units of 1e-7 degrees, as in PBF
+COORD_SCALE = 10 ** 7
+AREA_KEYS = frozenset(('place', 'population'))
+# Relation member roles naming the settlement's own node
+LABEL_ROLES = ('label', 'admin_centre')
+
+
+def store_file_name(file_name):
+    return file_name + '.nodes'
+
+
+class NodeLocationWriter(object):
+    # Builds the files of a NodeLocationStore from nodes given in any
+    # order, holding at most chunk_nodes of them in memory. Each chunk is
+    # sorted and appended to <base_name>.ids.tmp and .coords.tmp as a run;
+    # extracts sorted by id (the usual case) give a single sorted run that
+    # only needs renaming, anything else is merged run by run on close.
+
+    def __init__(self, base_name, chunk_nodes=1 << 22):
+        self.base_name = base_name
+        self.chunk_nodes = chunk_nodes
+        self.ids_file = open(base_name + '.ids.tmp', 'wb')
+        self.coords_file = open(base_name + '.coords.tmp', 'wb')
+        self.pending = []
+        self.pending_count = 0
+        self.runs = []
+        self.count = 0
+        self.last_id = None
+        self.in_order = True
+
+    def add(self, ids, lats, lons):
+        # Nodes as sequences of ids and lat and lon in 1e-7 degrees
+        ids = np.asarray(ids, dtype=np.int64)
+        if not len(ids):
+            return
+        coords = np.empty((len(ids), 2), dtype=np.int32)
+        coords[:, 0] = lats
+        coords[:, 1] = lons
+        self.pending.append((ids, coords))
+        self.pending_count += len(ids)
+        if self.pending_count >= self.chunk_nodes:
+            self.write_run()
+
+    def write_run(self):
+        if not self.pending:
+            return
+        ids = np.concatenate([ids for ids, __ in self.pending])
+        coords = np.concatenate([coords for __, coords in self.pending])
+        self.pending = []
+        self.pending_count = 0
+        if np.any(ids[1:] < ids[:-1]):
+            order = np.argsort(ids, kind='stable')
+            ids = ids[order]
+            coords = coords[order]
+        if self.last_id is not None and ids[0] < self.last_id:
+            self.in_order = False
+        self.last_id = ids[-1]
+        self.ids_file.write(ids.tobytes())
+        self.coords_file.write(coords.tobytes())
+        self.runs.append((self.count, self.count + len(ids)))
+        self.count += len(ids)
+
+    def close(self):
+        # Finish the store files; returns the number of nodes
+        try:
+            self.write_run()
+        finally:
+            self.ids_file.close()
+            self.coords_file.close()
+        base_name = self.base_name
+        if self.in_order or len(self.runs) < 2:
+            os.replace(base_name + '.ids.tmp', base_name + '.ids')
+            os.replace(base_name + '.coords.tmp', base_name + '.coords')
+        else:
+            try:
+                self.merge_runs()
+            finally:
+                os.remove(base_name + '.ids.tmp')
+                os.remove(base_name + '.coords.tmp')
+        return self.count
+
+    def abort(self):
+        self.pending = []
+        for f in (self.ids_file, self.coords_file):
+            f.close()
+            if os.path.exists(f.name):
+                os.remove(f.name)
+
+    def merge_runs(self):
+        # k-way merge of the sorted runs, a block of each at a time. Every
+        # round takes from each run the nodes up to the smallest of the
+        # blocks' last ids, so the run holding it always advances a block.
+        base_name = self.base_name
+        ids = np.memmap(base_name + '.ids.tmp', dtype=np.int64, mode='r')
+        coords = np.memmap(base_name + '.coords.tmp', dtype=np.int32, mode='r').reshape(-1, 2)
+        block = max(self.chunk_nodes // len(self.runs), 1024)
+        positions = [start for start, __ in self.runs]
+        with open(base_name + '.ids', 'wb') as ids_out, open(base_name + '.coords', 'wb') as coords_out:
+            while True:
+                heads = [(run, position, min(position + block, end))
+                         for run, (position, (__, end)) in enumerate(zip(positions, self.runs))
+                         if position < end]
+                if not heads:
+                    break
+                cutoff = min(ids[stop - 1] for __, __, stop in heads)
+                taken_ids = []
+                taken_coords = []
+                for run, position, stop in heads:
+                    take = position + int(np.searchsorted(ids[position:stop], cutoff, side='right'))
+                    taken_ids.append(ids[position:take])
+                    taken_coords.append(coords[position:take])
+                    positions[run] = take
+                merged_ids = np.concatenate(taken_ids)
+                order = np.argsort(merged_ids, kind='stable')
+                ids_out.write(merged_ids[order].tobytes())
+                coords_out.write(np.concatenate(taken_coords)[order].tobytes())
+        del ids, coords
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+
+class NodeLocationStore(object):
+    # Read side of the store: ids (int64) and coords (int32 lat, lon
+    # pairs in 1e-7 degrees) memory-mapped from <base_name>.ids and
+    # .coords, sorted by id. Only the pages a lookup touches are read, so
+    # memory use does not grow with the number of nodes.
+
+    def __init__(self, base_name):
+        self.base_name = base_name
+        if os.path.getsize(base_name + '.ids'):
+            self.ids = np.memmap(base_name + '.ids', dtype=np.int64, mode='r')
+            self.coords = np.memmap(base_name + '.coords', dtype=np.int32, mode='r').reshape(-1, 2)
+        else:
+            # mmap cannot map an empty file
+            self.ids = np.empty(0, dtype=np.int64)
+            self.coords = np.empty((0, 2), dtype=np.int32)
+
+    @classmethod
+    def load(cls, file_name, base_name=None):
+        # Store built for file_name, or None unless one was finished for
+        # the file at its current size and mtime
+        base_name = base_name or store_file_name(file_name)
+        try:
+            with open(base_name + '.json', encoding='utf8') as f:
+                meta = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if meta.get('version') != STORE_VERSION or meta.get('stamp') != file_stamp(file_name):
+            return None
+        try:
+            return cls(base_name)
+        except (IOError, OSError, ValueError):
+            return None
+
+    @staticmethod
+    def save_meta(file_name, base_name, count):
+        with open(base_name + '.json', 'w', encoding='utf8') as f:
+            json.dump({'version': STORE_VERSION, 'stamp': file_stamp(file_name), 'nodes': count}, f)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def lookup(self, node_ids):
+        # {node id: (lat, lon)} in degrees for the node_ids in the store
+        node_ids = np.unique(np.asarray(list(node_ids), dtype=np.int64))
+        if not len(node_ids) or not len(self.ids):
+            return {}
+        rows = np.searchsorted(self.ids, node_ids)
+        rows[rows == len(self.ids)] = 0
+        found = self.ids[rows] == node_ids
+        coords = self.coords[rows[found]] / float(COORD_SCALE)
+        return dict(zip(node_ids[found].tolist(), map(tuple, coords.tolist())))
+
+    def get(self, node_id):
+        # (lat, lon) of one node, or None
+        return self.lookup((node_id,)).get(node_id)
+
+    def close(self):
+        self.ids = self.coords = None
+
+
+def vertex_centroid(points):
+    # Mean of (lat, lon) points
+    return (sum(lat for lat, __ in points) / len(points),
+            sum(lon for __, lon in points) / len(points))
+
+
+def ring_centroid(points):
+    # (signed area, (lat, lon) centroid) of a closed ring of points, in
+    # plain degree units; good enough for areas the size of a settlement
+    area = lat_sum = lon_sum = 0.0
+    for (lat1, lon1), (lat2, lon2) in zip(points, points[1:]):
+        cross = lon1 * lat2 - lon2 * lat1
+        area += cross
+        lon_sum += (lon1 + lon2) * cross
+        lat_sum += (lat1 + lat2) * cross
+    area /= 2.0
+    if area == 0.0:
+        return 0.0, None
+    return area, (lat_sum / (6.0 * area), lon_sum / (6.0 * area))
+
+
+def way_points(refs, locations):
+    # Located points of a way, or None when a node is missing
+    points = [locations.get(ref) for ref in refs]
+    if not points or None in points:
+        return None
+    return points
+
+
+def way_location(refs, locations):
+    # Area centroid of a closed way, or the mean of its nodes otherwise
+    points = way_points(refs, locations)
+    if points is None:
+        points = [locations[ref] for ref in refs if ref in locations]
+        return vertex_centroid(points) if points else None
+    if len(refs) >= 4 and refs[0] == refs[-1]:
+        area, centroid = ring_centroid(points)
+        if centroid is not None:
+            return centroid
+        points = points[:-1]
+    return vertex_centroid(points)
+
+
+def relation_location(members, way_refs, locations):
+    # A label or admin_centre member node when there is one, otherwise
+    # the area weighted centroid of the closed member ways with inner
+    # rings subtracted, otherwise the mean of every located member node.
+    # Rings split over several ways are not assembled, so those fall
+    # back to the node mean.
+    for member_type, ref, role in members:
+        if member_type == 'node' and role in LABEL_ROLES and ref in locations:
+            return locations[ref]
+    total = lat_sum = lon_sum = 0.0
+    points = []
+    for member_type, ref, role in members:
+        if member_type == 'node' and ref in locations:
+            points.append(locations[ref])
+        elif member_type == 'way' and ref in way_refs:
+            refs = way_refs[ref]
+            points.extend(locations[node] for node in refs if node in locations)
+            ring = way_points(refs, locations)
+            if ring is None or len(refs) < 4 or refs[0] != refs[-1]:
+                continue
+            area, centroid = ring_centroid(ring)
+            if centroid is None:
+                continue
+            weight = -abs(area) if role == 'inner' else abs(area)
+            total += weight
+            lat_sum += weight * centroid[0]
+            lon_sum += weight * centroid[1]
+    if total > 0.0:
+        return lat_sum / total, lon_sum / total
+    return vertex_centroid(points) if points else None
+
+
+class StopParsing(Exception):
+    pass
+
+
+class AreaResolver(object):
+    # Locates the way and relation settlements of an OSM file, those with
+    # a place or population tag, in at most two streaming passes:
+    #   1. every node location goes to a NodeLocationStore (unless one is
+    #      already saved for the file), and the node ids of settlement
+    #      ways and the members of settlement relations are kept;
+    #   2. the node ids of the ways those relations are made of are read.
+    # Only settlement ways, relations and their member ways are held in
+    # memory; node locations stay on disk.
+
+    def __init__(self, file_name, store_name=None, chunk_nodes=1 << 22):
+        self.file_name = file_name
+        self.store_name = store_name or store_file_name(file_name)
+        self.chunk_nodes = chunk_nodes
+        self.is_pbf = file_name.lower().endswith('.pbf')
+        # settlement way id -> node ids, settlement relation id -> members
+        self.way_refs = {}
+        self.relation_members = {}
+        # node ids of other ways needed by settlement relations
+        self.member_way_refs = {}
+        self.stats = {'passes': 0, 'nodes_stored': 0, 'store_reused': False}
+
+    def resolve(self):
+        # {(kind, element id string): (lat, lon)} for every way and
+        # relation settlement that could be located
+        store = NodeLocationStore.load(self.file_name, self.store_name)
+        self.stats['store_reused'] = store is not None
+        if store is None:
+            writer = NodeLocationWriter(self.store_name, self.chunk_nodes)
+            with writer:
+                self.scan(writer)
+            NodeLocationStore.save_meta(self.file_name, self.store_name, writer.count)
+            store = NodeLocationStore(self.store_name)
+        else:
+            self.scan(None)
+        try:
+            wanted = set()
+            for members in self.relation_members.values():
+                wanted.update(ref for member_type, ref, __ in members
+                              if member_type == 'way' and ref not in self.way_refs)
+            if wanted:
+                self.scan_ways(wanted)
+            self.stats['nodes_stored'] = len(store)
+            return self.locate(store)
+        finally:
+            store.close()
+
+    def locate(self, store):
+        way_refs = dict(self.member_way_refs)
+        way_refs.update(self.way_refs)
+        node_ids = set()
+        for refs in way_refs.values():
+            node_ids.update(refs)
+        for members in self.relation_members.values():
+            node_ids.update(ref for member_type, ref, __ in members if member_type == 'node')
+        locations = store.lookup(node_ids)
+        found = {}
+        for way_id, refs in self.way_refs.items():
+            location = way_location(refs, locations)
+            if location is not None:
+                found[('way', str(way_id))] = location
+        for relation_id, members in self.relation_members.items():
+            location = relation_location(members, way_refs, locations)
+            if location is not None:
+                found[('relation', str(relation_id))] = location
+        self.stats['areas'] = len(self.way_refs) + len(self.relation_members)
+        self.stats['located'] = len(found)
+        return found
+
+    def scan(self, writer):
+        self.stats['passes'] += 1
+        if self.is_pbf:
+            self.scan_pbf(writer)
+        else:
+            self.scan_xml(writer)
+
+    def scan_pbf(self, writer):
+        for blob in PBFReader(self.file_name).iter_data_blobs():
+            block = PrimitiveBlock(decode_blob(blob), members=True)
+            if writer is not None:
+                writer.add(*block.node_locations())
+            for kind, elem_id, __, tags, __, __, members in block.iter_primitives(('way', 'relation')):
+                if AREA_KEYS.isdisjoint(tags):
+                    continue
+                if kind == 'way':
+                    self.way_refs[int(elem_id)] = members
+                else:
+                    self.relation_members[int(elem_id)] = members
+
+    def scan_xml(self, writer):
+        # Node locations are buffered as attribute strings only for one
+        # parse chunk, then converted in bulk and held by the writer as
+        # arrays until it has chunk_nodes of them
+        ids = []
+        lats = []
+        lons = []
+        # Open way or relation as [kind, id, node ids or members, tagged]
+        state = [None, None, None, False]
+
+        def add_nodes():
+            if ids:
+                writer.add(np.array(ids, dtype=np.int64),
+                           np.rint(np.array(lats, dtype=np.float64) * COORD_SCALE),
+                           np.rint(np.array(lons, dtype=np.float64) * COORD_SCALE))
+                del ids[:], lats[:], lons[:]
+
+        def start(tag, attrs):
+            if tag == 'nd':
+                if state[0] == 'way':
+                    state[2].append(attrs[1] if attrs[0] == 'ref' else attr_dict(attrs)['ref'])
+            elif tag == 'node':
+                if writer is not None:
+                    attrs = attr_dict(attrs)
+                    if 'lat' not in attrs:
+                        # Deleted node in a history file
+                        return
+                    ids.append(attrs['id'])
+                    lats.append(attrs['lat'])
+                    lons.append(attrs['lon'])
+            elif tag == 'tag':
+                if state[0] is not None:
+                    key = attrs[1] if attrs[0] == 'k' else attr_dict(attrs).get('k')
+                    if key in AREA_KEYS:
+                        state[3] = True
+            elif tag == 'member':
+                if state[0] == 'relation':
+                    attrs = attr_dict(attrs)
+                    state[2].append((attrs.get('type'), int(attrs['ref']), attrs.get('role', '')))
+            elif tag in ('way', 'relation'):
+                state[0] = tag
+                state[1] = int(attr_dict(attrs)['id'])
+                state[2] = []
+                state[3] = False
+
+        def end(tag):
+            if tag == state[0]:
+                if state[3]:
+                    if tag == 'way':
+                        self.way_refs[state[1]] = [int(ref) for ref in state[2]]
+                    else:
+                        self.relation_members[state[1]] = state[2]
+                state[0] = state[1] = state[2] = None
+                state[3] = False
+
+        self.parse_xml(start, end, after_chunk=add_nodes if writer is not None else None)
+        if writer is not None:
+            add_nodes()
+
+    def scan_ways(self, wanted):
+        # Second pass: node ids of the ways in wanted
+        self.stats['passes'] += 1
+        found = self.member_way_refs
+        if self.is_pbf:
+            for kind, elem_id, __, __, __, __, refs in PBFReader(self.file_name).iter_primitives(('way',), True):
+                if int(elem_id) in wanted:
+                    found[int(elem_id)] = refs
+            return
+        # Open way as [id, node ids]
+        state = [None, None]
+
+        def start(tag, attrs):
+            if tag == 'nd':
+                if state[1] is not None:
+                    state[1].append(int(attrs[1] if attrs[0] == 'ref' else attr_dict(attrs)['ref']))
+            elif tag == 'way':
+                way_id = int(attr_dict(attrs)['id'])
+                if way_id in wanted:
+                    state[0] = way_id
+                    state[1] = []
+            elif tag == 'relation':
+                # Ways come before relations
+                raise StopParsing()
+
+        def end(tag):
+            if tag == 'way' and state[1] is not None:
+                found[state[0]] = state[1]
+                state[0] = state[1] = None
+
+        self.parse_xml(start, end)
+
+    def parse_xml(self, start, end, chunk_size=1 << 16, after_chunk=None):
+        # Parse the file with expat handlers, calling after_chunk after
+        # each chunk_size bytes
+        parser = xml.parsers.expat.ParserCreate()
+        parser.ordered_attributes = True
+        parser.StartElementHandler = start
+        parser.EndElementHandler = end
+        with open_osm(self.file_name) as osm_file:
+            try:
+                while True:
+                    chunk = osm_file.read(chunk_size)
+                    if not chunk:
+                        break
+                    parser.Parse(chunk, False)
+                    if after_chunk is not None:
+                        after_chunk()
+                parser.Parse(b'', True)
+            except StopParsing:
+                pass
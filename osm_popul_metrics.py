@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+Counters, stage timers and live progress for Popul.process_data, exported
+as a dict or in Prometheus text format.
+"""
+
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+
+class Metrics(object):
+    # Per-run instrumentation. Stage timers accumulate seconds and calls,
+    # counters accumulate totals, and progress() prints a throughput line
+    # (and rewrites metrics_file in Prometheus format) at most every
+    # progress_every seconds.
+
+    def __init__(self, total_bytes=None, progress_every=10.0, metrics_file=None,
+                 out=sys.stdout):
+        self.total_bytes = total_bytes
+        self.progress_every = progress_every
+        self.metrics_file = metrics_file
+        self.out = out
+        self.started = time.time()
+        self.last_report = self.started
+        self.bytes_done = 0
+        self.counters = {}
+        self.timers = {}
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def add_time(self, name, secs):
+        timer = self.timers.get(name)
+        if timer is None:
+            timer = self.timers[name] = [0.0, 0]
+        timer[0] += secs
+        timer[1] += 1
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def wrap(self, name, iterable, position=None):
+        # Time each next() of iterable under name and count the items.
+        # position() returns bytes consumed so far for the progress readout.
+        # Once iterable is exhausted the input counts as read up to its
+        # final position, or to total_bytes without a position.
+        iterator = iter(iterable)
+        clock = time.perf_counter
+        while True:
+            start = clock()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add_time(name, clock() - start)
+                if position is not None:
+                    self.bytes_done = position()
+                elif self.total_bytes is not None:
+                    self.bytes_done = self.total_bytes
+                break
+            self.add_time(name, clock() - start)
+            self.count(name + '_items')
+            self.progress(position() if position is not None else None)
+            yield item
+
+    def progress(self, bytes_done=None):
+        if bytes_done is not None:
+            self.bytes_done = bytes_done
+        now = time.time()
+        if self.progress_every is None or now - self.last_report < self.progress_every:
+            return
+        self.last_report = now
+        self.report_progress(now)
+        if self.metrics_file:
+            self.write_prometheus(self.metrics_file)
+
+    def report_progress(self, now=None):
+        elapsed = max((now or time.time()) - self.started, 1e-9)
+        mb_done = self.bytes_done / 1e6
+        line = "{:.1f} MB read, {:.2f} MB/sec".format(mb_done, mb_done / elapsed)
+        if self.total_bytes:
+            share = float(self.bytes_done) / self.total_bytes
+            line = "{:.1f}% of {:.1f} MB, ".format(100 * share, self.total_bytes / 1e6) + line
+            if share > 0:
+                line += ", {:.0f} secs left".format(elapsed / share - elapsed)
+        line += ", {} settlements".format(self.counters.get('settlements', 0))
+        print(line, file=self.out)
+
+    def as_dict(self):
+        elapsed = time.time() - self.started
+        return {'elapsed_secs': round(elapsed, 4),
+                'bytes_done': self.bytes_done,
+                'total_bytes': self.total_bytes,
+                'mb_per_sec': round(self.bytes_done / 1e6 / max(elapsed, 1e-9), 3),
+                'counters': dict(self.counters),
+                'stages': dict((name, {'secs': round(secs, 4), 'calls': calls})
+                               for name, (secs, calls) in self.timers.items())}
+
+    def prometheus(self, prefix='osm_popul'):
+        # Prometheus text exposition format
+        lines = ['# TYPE {}_elapsed_seconds gauge'.format(prefix),
+                 '{}_elapsed_seconds {:.4f}'.format(prefix, time.time() - self.started),
+                 '# TYPE {}_bytes_read gauge'.format(prefix),
+                 '{}_bytes_read {}'.format(prefix, self.bytes_done)]
+        if self.total_bytes:
+            lines += ['# TYPE {}_bytes_total gauge'.format(prefix),
+                      '{}_bytes_total {}'.format(prefix, self.total_bytes)]
+        lines.append('# TYPE {}_count counter'.format(prefix))
+        for name in sorted(self.counters):
+            lines.append('{}_count{{name="{}"}} {}'.format(prefix, name, self.counters[name]))
+        lines.append('# TYPE {}_stage_seconds counter'.format(prefix))
+        for name in sorted(self.timers):
+            lines.append('{}_stage_seconds{{stage="{}"}} {:.6f}'.format(prefix, name, self.timers[name][0]))
+        lines.append('# TYPE {}_stage_calls counter'.format(prefix))
+        for name in sorted(self.timers):
+            lines.append('{}_stage_calls{{stage="{}"}} {}'.format(prefix, name, self.timers[name][1]))
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, file_name):
+        # Replace the file atomically so scrapers never read half a file
+        tmp_name = file_name + '.tmp'
+        with open(tmp_name, 'w', encoding='utf8') as f:
+            f.write(self.prometheus())
+        os.replace(tmp_name, file_name)
@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar export of the settlement tables as Parquet, written as record
+batches during Popul.process_data, and a report layer reading them back as
+memory-mapped Arrow tables. Needs the optional pyarrow package, imported
+on first use so that importing this module (and Popul) does not load it.
+"""
+
+import os
+
+import numpy as np
+
+from osm_popul_records import NO_UID, SettlementTable
+from osm_popul_report import PlaceChange, PopChange, SourceCount, Summary, YearCount
+from osm_popul_sql import TABLES
+
+# pyarrow, pyarrow.compute and pyarrow.parquet, set by require_pyarrow
+pa = pc = pq = None
+
+
+def require_pyarrow():
+    global pa, pc, pq
+    if pa is None:
+        try:
+            import pyarrow
+            import pyarrow.compute
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("Parquet output needs the pyarrow package")
+        pa, pc, pq = pyarrow, pyarrow.compute, pyarrow.parquet
+
+
+def schemas():
+    # Explicit table schemas matching the SQLite column types; repeated
+    # strings are dictionary encoded. timestamp holds the edit year.
+    require_pyarrow()
+    words = pa.dictionary(pa.int32(), pa.string())
+    return {'settlement_nodes': pa.schema([('node_id', pa.int64()), ('user', words),
+                                           ('uid', pa.int64()), ('timestamp', pa.int16()),
+                                           ('lat', pa.float64()), ('lon', pa.float64()),
+                                           ('kind', words)]),
+            'settlement_places': pa.schema([('node_id', pa.int64()), ('name', pa.string()),
+                                            ('place', words), ('place_change', pa.bool_()),
+                                            ('est_name', pa.string()), ('kind', words)]),
+            'settlement_popul': pa.schema([('node_id', pa.int64()), ('name', pa.string()),
+                                           ('osm_population', pa.int64()), ('pop_2016', pa.int64()),
+                                           ('source', words), ('kind', words)])}
+
+
+def int_array(values):
+    # typed array.array slice to an Arrow array without copying
+    return pa.array(np.frombuffer(values, dtype='i{}'.format(values.itemsize)).astype(np.int64, copy=False))
+
+
+def dictionary_array(table, column, start, stop):
+    # Dictionary array straight from a SettlementTable's pooled string
+    # ids; the dictionary holds only the strings used in the batch
+    ids = getattr(table, column)[start:stop]
+    ids = np.frombuffer(ids, dtype='i{}'.format(ids.itemsize))
+    used, indices = np.unique(ids, return_inverse=True)
+    # Pool id 0 is None, which goes in the validity mask instead
+    missing = ids == 0
+    if len(used) and used[0] == 0:
+        used = used[1:]
+        indices = np.maximum(indices - 1, 0)
+    strings = table.strings.strings
+    dictionary = pa.array([strings[string_id] for string_id in used.tolist()], type=pa.string())
+    return pa.DictionaryArray.from_arrays(pa.array(indices.astype(np.int32), mask=missing),
+                                          dictionary)
+
+
+def record_batches(table, start=0, stop=None, schema=None):
+    # {table name: RecordBatch} for rows start:stop of a SettlementTable
+    schema = schema or schemas()
+    if stop is None:
+        stop = len(table)
+    node_id = int_array(table.node_id[start:stop])
+    uids = np.frombuffer(table.uid[start:stop], dtype=np.int64)
+    uid = pa.array(uids, mask=uids == NO_UID)
+    name = pa.array(table.column('name', start, stop), type=pa.string())
+    change = pa.array(np.frombuffer(table.place_change[start:stop], dtype=np.int8).astype(bool))
+    years = pa.array([int(year) if year else None for year in table.column('year', start, stop)],
+                     type=pa.int16())
+    # NaN coordinates are missing
+    lats = np.frombuffer(table.lat[start:stop], dtype=np.float64)
+    lons = np.frombuffer(table.lon[start:stop], dtype=np.float64)
+    osm_population = pa.array([int(pop) for pop in table.column('osm_population', start, stop)],
+                              type=pa.int64())
+    kind = dictionary_array(table, 'kind', start, stop)
+    return {'settlement_nodes': pa.RecordBatch.from_arrays(
+                [node_id, dictionary_array(table, 'user', start, stop), uid, years,
+                 pa.array(lats, mask=np.isnan(lats)), pa.array(lons, mask=np.isnan(lons)), kind],
+                schema=schema['settlement_nodes']),
+            'settlement_places': pa.RecordBatch.from_arrays(
+                [node_id, name, dictionary_array(table, 'place', start, stop), change,
+                 pa.array(table.column('est_name', start, stop), type=pa.string()), kind],
+                schema=schema['settlement_places']),
+            'settlement_popul': pa.RecordBatch.from_arrays(
+                [node_id, name, osm_population, int_array(table.pop_2016[start:stop]),
+                 dictionary_array(table, 'source', start, stop), kind], schema=schema['settlement_popul'])}
+
+
+def parquet_paths(out_dir):
+    return dict((table, os.path.join(out_dir, table + '.parquet')) for table in TABLES)
+
+
+class ParquetSink(object):
+    # Writes the settlement tables as <table>.parquet files in out_dir.
+    # Record batches are collected and written as one row group every
+    # batch_size settlements. Files are written under a temporary name
+    # and moved into place on close, or removed if the run fails.
+
+    def __init__(self, out_dir, batch_size=50000, compression='snappy'):
+        require_pyarrow()
+        if not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+        self.out_dir = out_dir
+        self.batch_size = batch_size
+        self.schemas = schemas()
+        self.paths = parquet_paths(out_dir)
+        self.writers = dict((table, pq.ParquetWriter(self.paths[table] + '.tmp', self.schemas[table],
+                                                     compression=compression))
+                            for table in TABLES)
+        self.batches = dict((table, []) for table in TABLES)
+        self.pending = 0
+        self.rows_written = dict((table, 0) for table in TABLES)
+        # Rows given one at a time through write()
+        self.rows = SettlementTable()
+
+    def write(self, node_row, place_row, popul_row):
+        # One settlement's rows, as for the csv and SQLite sinks
+        node_id, user, uid, year, lat, lon, kind = node_row
+        __, name, place, place_change, est_name = place_row
+        __, osm_population, pop_2016, source = popul_row
+        self.rows.append(node_id, user, uid, year, name, place, place_change,
+                         osm_population, pop_2016, source, est_name, lat, lon, kind)
+        if len(self.rows) >= self.batch_size:
+            self.write_rows()
+
+    def write_rows(self):
+        rows = self.rows
+        if len(rows):
+            self.rows = SettlementTable()
+            self.write_records(rows)
+
+    def write_records(self, table, start=0, stop=None):
+        # Rows start:stop of a SettlementTable
+        batches = record_batches(table, start, stop, self.schemas)
+        for name, batch in batches.items():
+            self.batches[name].append(batch)
+        self.pending += batches['settlement_nodes'].num_rows
+        if self.pending >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        for table in TABLES:
+            batches = self.batches[table]
+            if batches:
+                self.writers[table].write_table(pa.Table.from_batches(batches, self.schemas[table]))
+                self.rows_written[table] += sum(batch.num_rows for batch in batches)
+                self.batches[table] = []
+        self.pending = 0
+
+    def close(self):
+        if self.writers is None:
+            return
+        try:
+            self.write_rows()
+            self.flush()
+        except Exception:
+            self.abort()
+            raise
+        writers = self.writers
+        self.writers = None
+        for writer in writers.values():
+            writer.close()
+        for table, path in self.paths.items():
+            os.replace(path + '.tmp', path)
+
+    def abort(self):
+        if self.writers is None:
+            return
+        writers = self.writers
+        self.writers = None
+        for table, writer in writers.items():
+            writer.close()
+            os.remove(self.paths[table] + '.tmp')
+
+    def stats(self):
+        return dict(('parquet:' + table, {'rows_written': self.rows_written[table],
+                                          'file': self.paths[table]}) for table in TABLES)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+
+def read_tables(out_dir):
+    # {table name: pyarrow Table} read through memory maps of the files
+    require_pyarrow()
+    return dict((table, pq.read_table(path, memory_map=True))
+                for table, path in parquet_paths(out_dir).items())
+
+
+class ArrowReport(object):
+    # SettlementReport's queries answered from the Parquet tables in
+    # out_dir, loaded once as Arrow tables
+
+    def __init__(self, out_dir):
+        self.out_dir = out_dir
+        self.tables = None
+
+    def load(self):
+        if self.tables is None:
+            if not os.path.exists(parquet_paths(self.out_dir)['settlement_popul']):
+                raise IOError("No settlement Parquet files in {}".format(self.out_dir))
+            self.tables = read_tables(self.out_dir)
+        return self.tables
+
+    def proportions(self, popul, digits):
+        # (pop_2016 - osm_population) / osm_population rounded like SQLite,
+        # null where the OSM population is 0
+        increase = pc.subtract(popul['pop_2016'], popul['osm_population'])
+        osm_population = pc.cast(popul['osm_population'], pa.float64())
+        osm_population = pc.if_else(pc.equal(osm_population, 0.0), None, osm_population)
+        return increase, pc.round(pc.divide(pc.cast(increase, pa.float64()), osm_population),
+                                  digits, round_mode='half_towards_infinity')
+
+    def summary(self):
+        tables = self.load()
+        places = tables['settlement_places']
+        popul = tables['settlement_popul']
+        increase, proportion = self.proportions(popul, 4)
+        mean_increase = pc.mean(increase).as_py()
+        return Summary(pc.count(places['name']).as_py(),
+                       pc.sum(pc.cast(places['place_change'], pa.int64())).as_py() or 0,
+                       popul.num_rows,
+                       round(mean_increase, 2) if mean_increase is not None else None,
+                       pc.mean(proportion).as_py())
+
+    def pop_changes(self):
+        popul = self.load()['settlement_popul']
+        increase, proportion = self.proportions(popul, 3)
+        # Nulls sort first, as in SQLite
+        order = pc.sort_indices(pc.fill_null(proportion, float('-inf')))
+        return [PopChange(*row) for row in zip(pc.take(popul['name'], order).to_pylist(),
+                                               pc.take(increase, order).to_pylist(),
+                                               pc.take(proportion, order).to_pylist())]
+
+    def designation_changes(self):
+        places = self.load()['settlement_places']
+        changed = places.filter(places['place_change'])
+        return [PlaceChange(*row) for row in zip(changed['name'].to_pylist(),
+                                                 changed['place'].to_pylist())]
+
+    def counts(self, table, column, row_type):
+        # Rows per value of column, most common first
+        counted = table.group_by(column).aggregate([([], 'count_all')])
+        counted = counted.take(pc.sort_indices(counted, sort_keys=[('count_all', 'descending')]))
+        return [row_type(*row) for row in zip(counted[column].to_pylist(),
+                                              counted['count_all'].to_pylist())]
+
+    def sources(self):
+        return self.counts(self.load()['settlement_popul'], 'source', SourceCount)
+
+    def timestamps(self):
+        return self.counts(self.load()['settlement_nodes'], 'timestamp', YearCount)
+
+    def dashboard(self):
+        return {'summary': self.summary(),
+                'pop_changes': self.pop_changes(),
+                'designation_changes': self.designation_changes(),
+                'sources': self.sources(),
+                'timestamps': self.timestamps()}
+
+    def close(self):
+        self.tables = None
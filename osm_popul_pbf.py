@@ -0,0 +1,480 @@
+# -*- coding: utf-8 -*-
+"""
+Pure Python reader for OSM PBF (.osm.pbf) files. Decodes the protobuf
+wire format directly, without generated protobuf classes, and supports
+PrimitiveBlocks holding plain nodes, DenseNodes, ways and relations.
+"""
+
+import struct
+import time
+import xml.etree.cElementTree as ET
+import zlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from osm_popul_extract import Candidate, SOURCE_PREFIX
+from osm_popul_stats import OSMStats
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+MAX_HEADER_SIZE = 64 * 1024
+MAX_BLOB_SIZE = 32 * 1024 * 1024
+KINDS = ('node', 'way', 'relation')
+# Relation member types by their protobuf enum value
+MEMBER_TYPES = ('node', 'way', 'relation')
+
+
+def read_varint(buf, pos):
+    # Decode one base 128 varint from buf at pos, returns (value, new pos)
+    result = 0
+    shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def signed64(value):
+    # Two's complement reading of a decoded int32/int64 varint
+    if value >= 1 << 63:
+        value -= 1 << 64
+    return value
+
+
+def zigzag(value):
+    # sint32/sint64 varint to Python int
+    return (value >> 1) ^ -(value & 1)
+
+
+def iter_fields(buf):
+    # Yield (field number, wire type, value) for every field in a message.
+    # Length delimited values are returned as bytes.
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        key, pos = read_varint(buf, pos)
+        number = key >> 3
+        wire_type = key & 7
+        if wire_type == 0:
+            value, pos = read_varint(buf, pos)
+        elif wire_type == 2:
+            size, pos = read_varint(buf, pos)
+            value = buf[pos:pos + size]
+            pos += size
+        elif wire_type == 1:
+            value = struct.unpack_from('<Q', buf, pos)[0]
+            pos += 8
+        elif wire_type == 5:
+            value = struct.unpack_from('<I', buf, pos)[0]
+            pos += 4
+        else:
+            raise ValueError("Unsupported protobuf wire type {}".format(wire_type))
+        yield number, wire_type, value
+
+
+def packed_varints(buf):
+    # Decode a packed repeated varint field
+    values = []
+    append = values.append
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        result = 0
+        shift = 0
+        while True:
+            byte = buf[pos]
+            pos += 1
+            result |= (byte & 0x7f) << shift
+            if not byte & 0x80:
+                break
+            shift += 7
+        append(result)
+    return values
+
+
+def packed_delta(buf):
+    # Packed sint64 field stored as deltas
+    values = []
+    last = 0
+    for v in packed_varints(buf):
+        last += (v >> 1) ^ -(v & 1)
+        values.append(last)
+    return values
+
+
+def iter_blobs(pbf_file):
+    # Yield (blob type, raw Blob message bytes) from an open binary file
+    while True:
+        size_bytes = pbf_file.read(4)
+        if not size_bytes:
+            return
+        if len(size_bytes) < 4:
+            raise ValueError("Truncated PBF blob header length")
+        header_size = struct.unpack('>I', size_bytes)[0]
+        if header_size > MAX_HEADER_SIZE:
+            raise ValueError("PBF blob header too large: {} bytes".format(header_size))
+        blob_type = None
+        data_size = 0
+        for number, __, value in iter_fields(pbf_file.read(header_size)):
+            if number == 1:
+                blob_type = value.decode('utf8')
+            elif number == 3:
+                data_size = value
+        if data_size > MAX_BLOB_SIZE:
+            raise ValueError("PBF blob too large: {} bytes".format(data_size))
+        blob = pbf_file.read(data_size)
+        if len(blob) < data_size:
+            raise ValueError("Truncated PBF blob")
+        yield blob_type, blob
+
+
+def decode_blob(blob):
+    # Decompress a Blob message into the contained block bytes
+    raw_size = None
+    for number, __, value in iter_fields(blob):
+        if number == 1:
+            return value
+        elif number == 2:
+            raw_size = value
+        elif number == 3:
+            data = zlib.decompress(value)
+            if raw_size is not None and len(data) != raw_size:
+                raise ValueError("PBF blob size mismatch")
+            return data
+        elif number == 4:
+            if lzma is None:
+                raise ValueError("lzma compressed PBF blob but lzma is unavailable")
+            return lzma.decompress(value)
+    raise ValueError("Unsupported PBF blob compression")
+
+
+def format_timestamp(millis):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(millis // 1000))
+
+
+class PrimitiveBlock(object):
+    # Decoder for one PrimitiveBlock. iter_primitives yields
+    # (kind, id, info, tags, lat, lon, members) with info a dict of
+    # version, timestamp, uid and user, as strings like the XML
+    # attributes; user is left out for user string id 0 (the empty
+    # string), as the XML leaves out the user of anonymous edits. With
+    # members, ways carry their node ids and relations their
+    # (type, id, role) members in members, otherwise it is None.
+
+    def __init__(self, data, members=False):
+        self.members = members
+        self.strings = []
+        self.groups = []
+        self.granularity = 100
+        self.lat_offset = 0
+        self.lon_offset = 0
+        self.date_granularity = 1000
+        for number, __, value in iter_fields(data):
+            if number == 1:
+                self.strings = [s.decode('utf8') for n, __, s in iter_fields(value) if n == 1]
+            elif number == 2:
+                self.groups.append(value)
+            elif number == 17:
+                self.granularity = value
+            elif number == 18:
+                self.date_granularity = value
+            elif number == 19:
+                self.lat_offset = signed64(value)
+            elif number == 20:
+                self.lon_offset = signed64(value)
+
+    def coord(self, value, offset):
+        return '{:.7f}'.format(1e-9 * (offset + self.granularity * value))
+
+    def info(self, buf):
+        info = {}
+        for number, __, value in iter_fields(buf):
+            if number == 1:
+                info['version'] = str(value)
+            elif number == 2:
+                info['timestamp'] = format_timestamp(signed64(value) * self.date_granularity)
+            elif number == 4:
+                info['uid'] = str(signed64(value))
+            elif number == 5 and value:
+                info['user'] = self.strings[value]
+        return info
+
+    def tags(self, keys, vals):
+        strings = self.strings
+        return dict((strings[k], strings[v]) for k, v in zip(keys, vals))
+
+    def iter_primitives(self, kinds=KINDS):
+        # Primitives of the given kinds; nodes are not decoded without
+        # 'node' in kinds
+        nodes = 'node' in kinds
+        ways = 'way' in kinds
+        relations = 'relation' in kinds
+        for group in self.groups:
+            for number, __, value in iter_fields(group):
+                if number == 1 and nodes:
+                    yield self.decode_node(value)
+                elif number == 2 and nodes:
+                    for primitive in self.decode_dense(value):
+                        yield primitive
+                elif number == 3 and ways:
+                    yield self.decode_member('way', value)
+                elif number == 4 and relations:
+                    yield self.decode_member('relation', value)
+
+    def node_locations(self):
+        # (ids, lats, lons) int64 arrays of every node in the block, with
+        # coordinates in units of 1e-7 degrees
+        ids = []
+        lats = []
+        lons = []
+        for group in self.groups:
+            for number, __, value in iter_fields(group):
+                if number == 1:
+                    elem_id = lat = lon = 0
+                    for field_number, __, field_value in iter_fields(value):
+                        if field_number == 1:
+                            elem_id = zigzag(field_value)
+                        elif field_number == 8:
+                            lat = zigzag(field_value)
+                        elif field_number == 9:
+                            lon = zigzag(field_value)
+                    ids.append(elem_id)
+                    lats.append(lat)
+                    lons.append(lon)
+                elif number == 2:
+                    for field_number, __, field_value in iter_fields(value):
+                        if field_number == 1:
+                            ids.extend(packed_delta(field_value))
+                        elif field_number == 8:
+                            lats.extend(packed_delta(field_value))
+                        elif field_number == 9:
+                            lons.extend(packed_delta(field_value))
+        # Nanodegrees are offset + granularity * value
+        lats = (self.lat_offset + self.granularity * np.array(lats, dtype=np.int64)) // 100
+        lons = (self.lon_offset + self.granularity * np.array(lons, dtype=np.int64)) // 100
+        return np.array(ids, dtype=np.int64), lats, lons
+
+    def decode_node(self, buf):
+        elem_id = lat = lon = 0
+        keys = vals = ()
+        info = {}
+        for number, __, value in iter_fields(buf):
+            if number == 1:
+                elem_id = zigzag(value)
+            elif number == 2:
+                keys = packed_varints(value)
+            elif number == 3:
+                vals = packed_varints(value)
+            elif number == 4:
+                info = self.info(value)
+            elif number == 8:
+                lat = zigzag(value)
+            elif number == 9:
+                lon = zigzag(value)
+        return ('node', str(elem_id), info, self.tags(keys, vals),
+                self.coord(lat, self.lat_offset), self.coord(lon, self.lon_offset), None)
+
+    def decode_dense(self, buf):
+        ids = lats = lons = keys_vals = ()
+        dense_info = None
+        for number, __, value in iter_fields(buf):
+            if number == 1:
+                ids = packed_delta(value)
+            elif number == 5:
+                dense_info = value
+            elif number == 8:
+                lats = packed_delta(value)
+            elif number == 9:
+                lons = packed_delta(value)
+            elif number == 10:
+                keys_vals = packed_varints(value)
+        infos = self.dense_infos(dense_info, len(ids))
+        strings = self.strings
+        kv_pos = 0
+        for i, elem_id in enumerate(ids):
+            tags = {}
+            while kv_pos < len(keys_vals):
+                key = keys_vals[kv_pos]
+                kv_pos += 1
+                if key == 0:
+                    break
+                tags[strings[key]] = strings[keys_vals[kv_pos]]
+                kv_pos += 1
+            yield ('node', str(elem_id), infos[i], tags,
+                   self.coord(lats[i], self.lat_offset), self.coord(lons[i], self.lon_offset), None)
+
+    def dense_infos(self, buf, count):
+        if buf is None:
+            return [{}] * count
+        versions = timestamps = uids = user_sids = ()
+        for number, __, value in iter_fields(buf):
+            if number == 1:
+                versions = packed_varints(value)
+            elif number == 2:
+                timestamps = packed_delta(value)
+            elif number == 4:
+                uids = packed_delta(value)
+            elif number == 5:
+                user_sids = packed_delta(value)
+        infos = []
+        for i in range(count):
+            info = {}
+            if versions:
+                info['version'] = str(versions[i])
+            if timestamps:
+                info['timestamp'] = format_timestamp(timestamps[i] * self.date_granularity)
+            if uids:
+                info['uid'] = str(uids[i])
+            if user_sids and user_sids[i]:
+                info['user'] = self.strings[user_sids[i]]
+            infos.append(info)
+        return infos
+
+    def decode_member(self, kind, buf):
+        # A way or relation
+        elem_id = 0
+        keys = vals = ()
+        info = {}
+        refs = roles = types = ()
+        for number, __, value in iter_fields(buf):
+            if number == 1:
+                elem_id = signed64(value)
+            elif number == 2:
+                keys = packed_varints(value)
+            elif number == 3:
+                vals = packed_varints(value)
+            elif number == 4:
+                info = self.info(value)
+            elif not self.members:
+                continue
+            elif kind == 'way' and number == 8:
+                refs = packed_delta(value)
+            elif kind == 'relation' and number == 8:
+                roles = packed_varints(value)
+            elif kind == 'relation' and number == 9:
+                refs = packed_delta(value)
+            elif kind == 'relation' and number == 10:
+                types = packed_varints(value)
+        members = None
+        if self.members and kind == 'way':
+            members = refs
+        elif self.members:
+            strings = self.strings
+            members = [(MEMBER_TYPES[member_type], ref, strings[role])
+                       for member_type, ref, role in zip(types, refs, roles)]
+        return (kind, str(elem_id), info, self.tags(keys, vals), None, None, members)
+
+
+def primitive_candidate(primitive):
+    # Candidate for a decoded primitive with place or population tags
+    kind, elem_id, info, tags, lat, lon, __ = primitive
+    if 'population' not in tags and 'place' not in tags:
+        return None
+    source = None
+    for key in tags:
+        if key.startswith(SOURCE_PREFIX):
+            source = tags[key]
+    return Candidate(kind, elem_id, info.get('user'), info.get('uid'), info.get('timestamp'),
+                     tags.get('name'), tags.get('place'), tags.get('population'), source, lat, lon)
+
+
+def blob_candidates(blob, collect_stats=False):
+    # Worker: decompress and decode one OSMData blob into
+    # (candidates, OSMStats or None)
+    found = []
+    stats = OSMStats() if collect_stats else None
+    for primitive in PrimitiveBlock(decode_blob(blob)).iter_primitives():
+        if stats is not None:
+            kind, __, info, tags, __, __, __ = primitive
+            stats.add_element(kind, info.get('user'), info.get('timestamp'), tags)
+        candidate = primitive_candidate(primitive)
+        if candidate is not None:
+            found.append(candidate)
+    return found, stats
+
+
+class PBFReader(object):
+    # Streams primitives or settlement candidates from a .osm.pbf file.
+    # Blobs are independent, so with workers > 1 they are decompressed and
+    # decoded on a process pool, with at most workers * 4 in flight.
+
+    def __init__(self, file_name, workers=None):
+        self.file_name = file_name
+        self.workers = workers
+        self.blobs = 0
+
+    def iter_data_blobs(self):
+        with open(self.file_name, 'rb') as f:
+            for blob_type, blob in iter_blobs(f):
+                if blob_type == 'OSMHeader':
+                    self.check_header(decode_blob(blob))
+                elif blob_type == 'OSMData':
+                    self.blobs += 1
+                    yield blob
+
+    def check_header(self, data):
+        # Refuse files needing features this reader does not implement
+        supported = ('OsmSchema-V0.6', 'DenseNodes')
+        for number, __, value in iter_fields(data):
+            if number == 4 and value.decode('utf8') not in supported:
+                raise ValueError("Unsupported PBF feature {}".format(value.decode('utf8')))
+
+    def iter_primitives(self, kinds=KINDS, members=False):
+        for blob in self.iter_data_blobs():
+            for primitive in PrimitiveBlock(decode_blob(blob), members).iter_primitives(kinds):
+                yield primitive
+
+    def iter_candidates(self, stats=None):
+        # Candidates in file order; every primitive is also counted into
+        # stats when given
+        collect = stats is not None
+        if not self.workers or self.workers < 2:
+            for blob in self.iter_data_blobs():
+                found, blob_stats = blob_candidates(blob, collect)
+                if collect:
+                    stats.merge(blob_stats)
+                for candidate in found:
+                    yield candidate
+            return
+        window = self.workers * 4
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            pending = deque()
+            for blob in self.iter_data_blobs():
+                pending.append(executor.submit(blob_candidates, blob, collect))
+                if len(pending) >= window:
+                    found, blob_stats = pending.popleft().result()
+                    if collect:
+                        stats.merge(blob_stats)
+                    for candidate in found:
+                        yield candidate
+            while pending:
+                found, blob_stats = pending.popleft().result()
+                if collect:
+                    stats.merge(blob_stats)
+                for candidate in found:
+                    yield candidate
+
+    def iter_elements(self, tags=KINDS):
+        # Element objects shaped like the XML ones, for get_element
+        for kind, elem_id, info, elem_tags, lat, lon, members in self.iter_primitives(tags, True):
+            element = ET.Element(kind, id=elem_id, **info)
+            if lat is not None:
+                element.set('lat', lat)
+                element.set('lon', lon)
+            if kind == 'way':
+                for ref in members:
+                    ET.SubElement(element, 'nd', ref=str(ref))
+            elif kind == 'relation':
+                for member_type, ref, role in members:
+                    ET.SubElement(element, 'member', type=member_type, ref=str(ref), role=role)
+            for key, value in elem_tags.items():
+                ET.SubElement(element, 'tag', k=key, v=value)
+            yield element
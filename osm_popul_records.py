@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+"""
+Compact in-memory storage for cleaned settlements. Columns are typed
+arrays, and repeated strings (users, years, places, sources) are interned
+once in a pool and stored as integer ids.
+"""
+
+import math
+import sys
+from array import array
+
+import pandas as pd
+
+COLUMNS = ('node_id', 'user', 'uid', 'year', 'name', 'place', 'place_change',
+           'osm_population', 'pop_2016', 'source', 'est_name', 'lat', 'lon', 'kind')
+# Columns held as ids into the table's StringPool
+STRING_COLUMNS = ('user', 'year', 'name', 'place', 'osm_population', 'source', 'est_name', 'kind')
+# uid of elements without one (anonymous edits in old history)
+NO_UID = -1
+# Coordinates of settlements without a location (ways and relations)
+NO_COORD = float('nan')
+
+
+def coord(value):
+    # lat or lon as a float, NO_COORD for None
+    return NO_COORD if value is None else float(value)
+
+
+class StringPool(object):
+    # Interned strings numbered in order of first use; id 0 is None
+
+    __slots__ = ('strings', 'ids')
+
+    def __init__(self):
+        self.strings = [None]
+        self.ids = {None: 0}
+
+    def __len__(self):
+        return len(self.strings)
+
+    def id(self, value):
+        string_id = self.ids.get(value)
+        if string_id is None:
+            value = sys.intern(value)
+            string_id = self.ids[value] = len(self.strings)
+            self.strings.append(value)
+        return string_id
+
+    def get(self, value):
+        # id of value, or None if it was never added
+        return self.ids.get(value)
+
+    def id_list(self, values):
+        # ids of a batch of values, adding the new ones
+        ids = self.ids
+        found = [ids.get(value) for value in values]
+        if None in found:
+            add = self.id
+            found = [add(value) if string_id is None else string_id
+                     for value, string_id in zip(values, found)]
+        return found
+
+
+class Settlement(object):
+    # One row of a SettlementTable. node_id is the id of the node, way or
+    # relation named by kind; ids are only unique per kind.
+
+    __slots__ = COLUMNS
+
+    def __init__(self, node_id, user, uid, year, name, place, place_change,
+                 osm_population, pop_2016, source, est_name, lat=None, lon=None, kind='node'):
+        self.node_id = node_id
+        self.user = user
+        self.uid = uid
+        self.year = year
+        self.name = name
+        self.place = place
+        self.place_change = place_change
+        self.osm_population = osm_population
+        self.pop_2016 = pop_2016
+        self.source = source
+        self.est_name = est_name
+        self.lat = lat
+        self.lon = lon
+        self.kind = kind
+
+    def rows(self):
+        # (node, place, popul) rows as written to the csv files
+        return ((self.node_id, self.user, self.uid, self.year, self.lat, self.lon, self.kind),
+                (self.node_id, self.name, self.place, self.place_change, self.est_name),
+                (self.name, self.osm_population, self.pop_2016, self.source))
+
+    def __eq__(self, other):
+        return isinstance(other, Settlement) and all(
+            getattr(self, column) == getattr(other, column) for column in COLUMNS)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'Settlement({})'.format(', '.join(
+            '{}={!r}'.format(column, getattr(self, column)) for column in COLUMNS))
+
+
+class SettlementTable(object):
+    # Struct-of-arrays store of cleaned settlements in the order they were
+    # added. est_name is the estimates place a settlement was matched to;
+    # each estimates place is held at most once, by the first settlement
+    # matched to it. lat and lon are NaN for settlements without a
+    # location, and None when read back. kind is the element kind of
+    # node_id, so a settlement is identified by (kind, node_id).
+
+    def __init__(self):
+        self.strings = StringPool()
+        self.node_id = array('q')
+        self.uid = array('q')
+        self.place_change = array('b')
+        self.pop_2016 = array('q')
+        self.user = array('l')
+        self.year = array('l')
+        self.name = array('l')
+        self.place = array('l')
+        self.osm_population = array('l')
+        self.source = array('l')
+        self.est_name = array('l')
+        self.lat = array('d')
+        self.lon = array('d')
+        self.kind = array('l')
+        # est_name id -> row
+        self.matched = {}
+        # name id -> first row, built on demand by find
+        self.by_name = None
+
+    def __len__(self):
+        return len(self.node_id)
+
+    def has_match(self, est_name):
+        string_id = self.strings.get(est_name)
+        return string_id is not None and string_id in self.matched
+
+    def matched_names(self):
+        strings = self.strings.strings
+        return set(strings[string_id] for string_id in self.matched)
+
+    def append(self, node_id, user, uid, year, name, place, place_change,
+               osm_population, pop_2016, source, est_name, lat=None, lon=None, kind='node'):
+        # Add one settlement; node_id, uid, pop_2016, lat and lon are
+        # numbers or their decimal strings
+        pool = self.strings.id
+        row = len(self.node_id)
+        self.node_id.append(int(node_id))
+        self.uid.append(NO_UID if uid is None else int(uid))
+        self.place_change.append(1 if place_change else 0)
+        self.pop_2016.append(int(pop_2016))
+        self.user.append(pool(user))
+        self.year.append(pool(year))
+        self.name.append(pool(name))
+        self.place.append(pool(place))
+        self.osm_population.append(pool(osm_population))
+        self.source.append(pool(source))
+        est_id = pool(est_name)
+        self.est_name.append(est_id)
+        self.lat.append(coord(lat))
+        self.lon.append(coord(lon))
+        self.kind.append(pool(kind))
+        self.matched.setdefault(est_id, row)
+        self.by_name = None
+
+    def extend(self, node_ids, users, uids, years, names, places, place_changes,
+               osm_populations, pops_2016, sources, est_names, lats=None, lons=None, kinds=None):
+        # Add a batch of settlements given as one sequence per column;
+        # without kinds they are all nodes
+        pool = self.strings.id_list
+        start = len(self.node_id)
+        self.node_id.extend(map(int, node_ids))
+        self.uid.extend(NO_UID if uid is None else int(uid) for uid in uids)
+        self.place_change.extend(1 if change else 0 for change in place_changes)
+        self.pop_2016.extend(map(int, pops_2016))
+        added = len(self.node_id) - start
+        for column, values in (('lat', lats), ('lon', lons)):
+            if values is None:
+                getattr(self, column).extend([NO_COORD] * added)
+            else:
+                getattr(self, column).extend(map(coord, values))
+        self.kind.extend(pool(['node'] * added if kinds is None else list(kinds)))
+        for column, values in (('user', users), ('year', years), ('name', names),
+                               ('place', places), ('osm_population', osm_populations),
+                               ('source', sources)):
+            getattr(self, column).extend(pool(list(values)))
+        est_ids = pool(list(est_names))
+        self.est_name.extend(est_ids)
+        for row, est_id in enumerate(est_ids, start):
+            self.matched.setdefault(est_id, row)
+        self.by_name = None
+
+    def __getitem__(self, row):
+        strings = self.strings.strings
+        uid = self.uid[row]
+        return Settlement(self.node_id[row], strings[self.user[row]],
+                          None if uid == NO_UID else uid, strings[self.year[row]],
+                          strings[self.name[row]], strings[self.place[row]],
+                          bool(self.place_change[row]), strings[self.osm_population[row]],
+                          self.pop_2016[row], strings[self.source[row]],
+                          strings[self.est_name[row]], self.location(row, self.lat),
+                          self.location(row, self.lon), strings[self.kind[row]])
+
+    def location(self, row, column):
+        value = column[row]
+        return None if math.isnan(value) else value
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield self[row]
+
+    def column(self, name, start=0, stop=None):
+        # Decoded values of one column for rows start:stop
+        values = getattr(self, name)[start:stop]
+        if name in STRING_COLUMNS:
+            strings = self.strings.strings
+            return [strings[string_id] for string_id in values]
+        if name == 'uid':
+            return [None if uid == NO_UID else uid for uid in values]
+        if name == 'place_change':
+            return [bool(change) for change in values]
+        if name in ('lat', 'lon'):
+            return [None if math.isnan(value) else value for value in values]
+        return values.tolist()
+
+    def node_rows(self, start=0, stop=None):
+        column = self.column
+        return zip(self.node_id[start:stop], column('user', start, stop),
+                   column('uid', start, stop), column('year', start, stop),
+                   column('lat', start, stop), column('lon', start, stop),
+                   column('kind', start, stop))
+
+    def place_rows(self, start=0, stop=None):
+        column = self.column
+        return zip(self.node_id[start:stop], column('name', start, stop),
+                   column('place', start, stop), column('place_change', start, stop),
+                   column('est_name', start, stop))
+
+    def popul_rows(self, start=0, stop=None):
+        column = self.column
+        return zip(column('name', start, stop), column('osm_population', start, stop),
+                   self.pop_2016[start:stop], column('source', start, stop))
+
+    def rows(self, start=0, stop=None):
+        # (node, place, popul) row tuples for rows start:stop
+        return zip(self.node_rows(start, stop), self.place_rows(start, stop),
+                   self.popul_rows(start, stop))
+
+    def find(self, name):
+        # First settlement with an OSM name, or None
+        if self.by_name is None:
+            self.by_name = {}
+            for row, string_id in enumerate(self.name):
+                self.by_name.setdefault(string_id, row)
+        row = self.by_name.get(self.strings.get(name))
+        return self[row] if row is not None else None
+
+    def where(self, **equals):
+        # Settlements whose columns equal the given values, for example
+        # where(place='town', place_change=True)
+        wanted = []
+        for name, value in equals.items():
+            if name not in COLUMNS:
+                raise ValueError("Unknown settlement column {}".format(name))
+            if name in STRING_COLUMNS:
+                value = self.strings.get(value)
+                if value is None:
+                    return []
+            elif name == 'place_change':
+                value = 1 if value else 0
+            elif name == 'uid' and value is None:
+                value = NO_UID
+            wanted.append((getattr(self, name), value))
+        return [self[row] for row in range(len(self))
+                if all(column[row] == value for column, value in wanted)]
+
+    def to_frame(self):
+        # DataFrame of all settlements, with categorical string columns
+        # sharing the pool's codes
+        strings = self.strings.strings
+        categories = pd.Index(strings[1:], dtype=object)
+        data = {}
+        for name in COLUMNS:
+            if name in STRING_COLUMNS:
+                # Pool id 0 (None) becomes code -1 (missing)
+                codes = pd.array(getattr(self, name), dtype='int64') - 1
+                data[name] = pd.Categorical.from_codes(codes.to_numpy(), categories=categories)
+            else:
+                data[name] = self.column(name)
+        return pd.DataFrame(data, columns=COLUMNS)
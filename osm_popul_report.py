@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+Reporting queries over the settlement tables. SettlementReport owns a
+lazily opened, read-only SQLite connection (or a small pool of them for
+threaded callers) and returns structured results instead of printing.
+"""
+
+import os
+import queue
+import sqlite3
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+from urllib.parse import quote
+
+from osm_popul_spatial import Nearby, bbox_around, haversine_km, nearest_by_radius, split_bbox
+
+Summary = namedtuple('Summary', ('revised', 'place_changes', 'settlements',
+                                 'mean_increase', 'mean_proportion'))
+PopChange = namedtuple('PopChange', ('name', 'increase', 'proportion'))
+PlaceChange = namedtuple('PlaceChange', ('name', 'place'))
+SourceCount = namedtuple('SourceCount', ('source', 'count'))
+YearCount = namedtuple('YearCount', ('year', 'count'))
+# node_id is the id of a node, way or relation as given by kind
+LocatedSettlement = namedtuple('LocatedSettlement', ('node_id', 'name', 'place', 'place_change',
+                                                     'osm_population', 'pop_2016', 'lat', 'lon',
+                                                     'kind'))
+
+# All summary statistics in one pass over each table
+SUMMARY_QUERY = """
+    SELECT places.revised, places.place_changes, popul.settlements,
+           popul.mean_increase, popul.mean_proportion
+    FROM (SELECT COUNT(name) AS revised,
+                 COALESCE(SUM(place_change), 0) AS place_changes
+          FROM settlement_places) AS places,
+         (SELECT COUNT(*) AS settlements,
+                 round(avg(pop_2016 - osm_population), 2) AS mean_increase,
+                 avg(1.0 * round(((pop_2016 - osm_population)/(1.0 * osm_population)), 4)) AS mean_proportion
+          FROM settlement_popul) AS popul"""
+
+POP_CHANGE_QUERY = """
+    SELECT name, pop_2016 - osm_population,
+           round(((pop_2016 - osm_population)/(osm_population*1.0)), 3) AS proportion
+    FROM settlement_popul
+    ORDER BY proportion"""
+
+PLACE_CHANGE_QUERY = "SELECT name, place FROM settlement_places WHERE place_change = 1"
+
+SOURCE_QUERY = """
+    SELECT source, COUNT(*) AS count FROM settlement_popul
+    GROUP BY source ORDER BY count DESC"""
+
+TIMESTAMP_QUERY = """
+    SELECT timestamp, COUNT(*) AS count FROM settlement_nodes
+    GROUP BY timestamp ORDER BY count DESC"""
+
+LOCATED_COLUMNS = """
+    SELECT n.node_id, places.name, places.place, places.place_change,
+           popul.osm_population, popul.pop_2016, n.lat, n.lon, n.kind"""
+
+LOCATED_JOINS = """
+    JOIN settlement_places AS places ON places.node_id = n.node_id AND places.kind = n.kind
+    JOIN settlement_popul AS popul ON popul.node_id = n.node_id AND popul.kind = n.kind"""
+
+# The R*Tree holds 32 bit float boxes rounded outwards, so matches are
+# checked against the stored coordinates too. Its ids are element keys,
+# node_id * 4 plus the code of the kind.
+BBOX_QUERY = LOCATED_COLUMNS + """
+    FROM settlement_rtree AS r
+    JOIN settlement_nodes AS n ON n.node_id = r.element_key / 4
+        AND n.kind = CASE r.element_key % 4 WHEN 1 THEN 'way' WHEN 2 THEN 'relation' ELSE 'node' END""" + LOCATED_JOINS + """
+    WHERE r.min_lat <= :max_lat AND r.max_lat >= :min_lat
+      AND r.min_lon <= :max_lon AND r.max_lon >= :min_lon
+      AND n.lat BETWEEN :min_lat AND :max_lat AND n.lon BETWEEN :min_lon AND :max_lon"""
+
+# Same without the R*Tree, for databases without one
+BBOX_SCAN_QUERY = LOCATED_COLUMNS + """
+    FROM settlement_nodes AS n""" + LOCATED_JOINS + """
+    WHERE n.lat BETWEEN :min_lat AND :max_lat AND n.lon BETWEEN :min_lon AND :max_lon"""
+
+RTREE_EXISTS_QUERY = "SELECT 1 FROM sqlite_master WHERE name = 'settlement_rtree'"
+
+
+class ConnectionPool(object):
+    # Up to size read-only connections, opened on first use. Each caller
+    # checks out its own connection, so threads never share one at a time.
+
+    def __init__(self, db_path, size=1):
+        self.db_path = db_path
+        self.size = size
+        self.opened = 0
+        self.idle = queue.LifoQueue()
+        self.lock = threading.Lock()
+
+    def open(self):
+        if not os.path.exists(self.db_path):
+            raise IOError("No settlement database at {}".format(self.db_path))
+        uri = 'file:{}?mode=ro'.format(quote(os.path.abspath(self.db_path)))
+        return sqlite3.connect(uri, uri=True, check_same_thread=False)
+
+    @contextmanager
+    def connection(self):
+        connect = None
+        with self.lock:
+            if self.idle.empty() and self.opened < self.size:
+                connect = self.open()
+                self.opened += 1
+        if connect is None:
+            connect = self.idle.get()
+        try:
+            yield connect
+        finally:
+            self.idle.put(connect)
+
+    def close(self):
+        # Close idle connections; checked out ones close when returned
+        with self.lock:
+            while True:
+                try:
+                    self.idle.get_nowait().close()
+                except queue.Empty:
+                    break
+                self.opened -= 1
+
+
+class SettlementReport(object):
+    # Structured report queries over the settlement tables in db_path
+
+    def __init__(self, db_path, pool_size=1):
+        self.pool = ConnectionPool(db_path, pool_size)
+        self.bbox_query = None
+
+    def fetch(self, query, row_type=None, params=()):
+        with self.pool.connection() as connect:
+            rows = connect.execute(query, params).fetchall()
+        if row_type is None:
+            return rows
+        return [row_type(*row) for row in rows]
+
+    def summary(self):
+        return self.fetch(SUMMARY_QUERY, Summary)[0]
+
+    def pop_changes(self):
+        return self.fetch(POP_CHANGE_QUERY, PopChange)
+
+    def designation_changes(self):
+        return self.fetch(PLACE_CHANGE_QUERY, PlaceChange)
+
+    def sources(self):
+        return self.fetch(SOURCE_QUERY, SourceCount)
+
+    def timestamps(self):
+        return self.fetch(TIMESTAMP_QUERY, YearCount)
+
+    def dashboard(self):
+        # Every report from a single connection checkout
+        with self.pool.connection() as connect:
+            return {'summary': Summary(*connect.execute(SUMMARY_QUERY).fetchone()),
+                    'pop_changes': [PopChange(*row) for row in connect.execute(POP_CHANGE_QUERY)],
+                    'designation_changes': [PlaceChange(*row) for row in connect.execute(PLACE_CHANGE_QUERY)],
+                    'sources': [SourceCount(*row) for row in connect.execute(SOURCE_QUERY)],
+                    'timestamps': [YearCount(*row) for row in connect.execute(TIMESTAMP_QUERY)]}
+
+    def in_bbox(self, min_lat, min_lon, max_lat, max_lon):
+        # LocatedSettlements inside the box, by node id and kind; min_lon > max_lon
+        # crosses the antimeridian
+        if self.bbox_query is None:
+            with self.pool.connection() as connect:
+                has_rtree = connect.execute(RTREE_EXISTS_QUERY).fetchone() is not None
+            self.bbox_query = BBOX_QUERY if has_rtree else BBOX_SCAN_QUERY
+        found = []
+        for box in split_bbox(min_lat, min_lon, max_lat, max_lon):
+            params = dict(zip(('min_lat', 'min_lon', 'max_lat', 'max_lon'), box))
+            found.extend(self.fetch(self.bbox_query, LocatedSettlement, params))
+        found.sort(key=lambda settlement: (settlement.node_id, settlement.kind))
+        return found
+
+    def within_radius(self, lat, lon, km):
+        # Nearby LocatedSettlements within km of lat, lon, nearest first
+        found = []
+        for settlement in self.in_bbox(*bbox_around(lat, lon, km)):
+            distance = haversine_km(lat, lon, settlement.lat, settlement.lon)
+            if distance <= km:
+                found.append(Nearby(distance, settlement))
+        found.sort(key=lambda nearby: nearby.distance_km)
+        return found
+
+    def nearest(self, lat, lon, k=1, max_km=None):
+        # Up to k Nearby LocatedSettlements closest to lat, lon
+        return nearest_by_radius(self.within_radius, lat, lon, k, max_km=max_km)
+
+    def close(self):
+        self.pool.close()
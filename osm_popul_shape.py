@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar version of Popul.shape_data. Cleans settlement candidates a chunk
+at a time: each distinct name is looked up once, and the revised
+population, place class and place_change flag of a chunk's settlements are
+computed as arrays before the chunk is added to the table in one extend.
+"""
+
+import numpy as np
+
+# Upper population bounds (exclusive) for hamlet, village and town
+PLACE_THRESHOLDS = np.array([100, 10000, 100000])
+PLACE_TYPES = np.array(['hamlet', 'village', 'town', 'city'], dtype=object)
+
+
+def classify_places(populations):
+    # Place type for each population, using the shape_data thresholds
+    return PLACE_TYPES[np.searchsorted(PLACE_THRESHOLDS, populations, side='right')]
+
+
+def shape_chunk(table, candidates, est_names, estimates):
+    # Append new settlements to table: candidates with their matched
+    # estimates place names and integer estimates, in the same order
+    (kinds, elem_ids, users, uids, timestamps, names, places, populs,
+     sources, lats, lons) = zip(*candidates)
+    osm_pop = np.array([int(popul) for popul in populs], dtype=np.int64)
+    pop_2016 = np.array(estimates, dtype=np.int64)
+    classes = classify_places(pop_2016)
+    osm_place = np.array(places, dtype=object)
+    place_change = (pop_2016 != osm_pop) & (classes != osm_place)
+    place = np.where(place_change, classes, osm_place)
+    years = [(stamp or '')[:4] for stamp in timestamps]
+    table.extend(elem_ids, users, uids, years, names, place.tolist(), place_change.tolist(),
+                 populs, estimates, sources, est_names, lats, lons, kinds)
+
+
+def shape_batch(candidates, table, lookup, exact_names=(), stats=None, chunk_size=1000):
+    # Clean candidates into a SettlementTable, yielding the number of
+    # settlements added after each chunk of up to chunk_size of them.
+    # lookup is Popul.lookup_estimate; exact_names (the plain pop_est
+    # dict) only feeds the exact match count. Places the table already
+    # holds are skipped, so the first occurrence of a place wins as in
+    # shape_rows, and the rows match those shape_rows would add. Match
+    # counts are added to stats when given.
+    if stats is None:
+        stats = {}
+    for key in ('population_tags', 'exact', 'matched'):
+        stats.setdefault(key, 0)
+    # name -> (estimates place name, estimate), or None without a match
+    matches = {}
+    taken = table.matched_names()
+    pending = []
+    est_names = []
+    estimates = []
+    for candidate in candidates:
+        if not candidate.popul:
+            continue
+        stats['population_tags'] += 1
+        name = candidate.name
+        if name in exact_names:
+            stats['exact'] += 1
+        match = matches.get(name, False)
+        if match is False:
+            est_name, est = lookup(name)
+            match = matches[name] = (est_name, int(est[1])) if est is not None else None
+        if match is None:
+            continue
+        stats['matched'] += 1
+        est_name = match[0]
+        if est_name in taken:
+            continue
+        taken.add(est_name)
+        pending.append(candidate)
+        est_names.append(est_name)
+        estimates.append(match[1])
+        if len(pending) >= chunk_size:
+            shape_chunk(table, pending, est_names, estimates)
+            yield len(pending)
+            pending = []
+            est_names = []
+            estimates = []
+    if pending:
+        shape_chunk(table, pending, est_names, estimates)
+        yield len(pending)
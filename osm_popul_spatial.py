@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+Spatial lookups over cleaned settlements: an in-memory grid index over the
+coordinates of a SettlementTable answering bounding box, radius and
+nearest settlement queries, and the great-circle helpers shared with the
+R*Tree queries of SettlementReport.
+"""
+
+import math
+from collections import namedtuple
+
+EARTH_RADIUS_KM = 6371.0088
+# Farthest any two points can be apart
+MAX_DISTANCE_KM = math.pi * EARTH_RADIUS_KM
+
+# A settlement found by a radius or nearest query
+Nearby = namedtuple('Nearby', ('distance_km', 'settlement'))
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    # Great-circle distance between two points in degrees
+    lat1 = math.radians(lat1)
+    lat2 = math.radians(lat2)
+    a = (math.sin((lat2 - lat1) / 2) ** 2 +
+         math.cos(lat1) * math.cos(lat2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def bbox_around(lat, lon, km):
+    # (min_lat, min_lon, max_lat, max_lon) holding every point within km
+    # of lat, lon. min_lon > max_lon when the box crosses the antimeridian.
+    angle = km / EARTH_RADIUS_KM
+    min_lat = lat - math.degrees(angle)
+    max_lat = lat + math.degrees(angle)
+    if min_lat <= -90.0 or max_lat >= 90.0 or angle >= math.pi / 2:
+        # Takes in a pole, so every longitude
+        return max(min_lat, -90.0), -180.0, min(max_lat, 90.0), 180.0
+    ratio = math.sin(angle) / math.cos(math.radians(lat))
+    if ratio >= 1.0:
+        return min_lat, -180.0, max_lat, 180.0
+    spread = math.degrees(math.asin(ratio))
+    min_lon = lon - spread
+    max_lon = lon + spread
+    if min_lon < -180.0:
+        min_lon += 360.0
+    if max_lon > 180.0:
+        max_lon -= 360.0
+    return min_lat, min_lon, max_lat, max_lon
+
+
+def split_bbox(min_lat, min_lon, max_lat, max_lon):
+    # A box as one or two boxes that do not cross the antimeridian
+    if min_lon <= max_lon:
+        return [(min_lat, min_lon, max_lat, max_lon)]
+    return [(min_lat, min_lon, max_lat, 180.0), (min_lat, -180.0, max_lat, max_lon)]
+
+
+def nearest_by_radius(radius, lat, lon, k=1, start_km=10.0, max_km=None):
+    # The k nearest of radius(lat, lon, km), a query returning Nearby
+    # results sorted by distance, widening km from start_km until k are
+    # found or max_km is searched
+    limit = MAX_DISTANCE_KM if max_km is None else max_km
+    km = min(start_km, limit)
+    while True:
+        found = radius(lat, lon, km)
+        if len(found) >= k or km >= limit:
+            return found[:k]
+        km = min(km * 4, limit)
+
+
+class SettlementGrid(object):
+    # Uniform grid of cell_degrees square cells over the located rows of a
+    # SettlementTable, as {(lat cell, lon cell): [rows]}. Queries first
+    # pick the cells overlapping the search box, then check the exact
+    # coordinates. Rows added to the table after the grid was built are
+    # indexed on the next query.
+
+    def __init__(self, table, cell_degrees=0.1):
+        self.table = table
+        self.cell_degrees = cell_degrees
+        self.cells = {}
+        self.indexed = 0
+        self.located = 0
+        self.update()
+
+    def cell(self, lat, lon):
+        size = self.cell_degrees
+        return int(math.floor(lat / size)), int(math.floor(lon / size))
+
+    def update(self):
+        # Index rows added since the last update
+        table = self.table
+        lats = table.lat
+        lons = table.lon
+        cells = self.cells
+        for row in range(self.indexed, len(table)):
+            lat = lats[row]
+            lon = lons[row]
+            if math.isnan(lat) or math.isnan(lon):
+                continue
+            cells.setdefault(self.cell(lat, lon), []).append(row)
+            self.located += 1
+        self.indexed = len(table)
+
+    def __len__(self):
+        # Located settlements indexed
+        self.update()
+        return self.located
+
+    def rows_in_bbox(self, min_lat, min_lon, max_lat, max_lon):
+        # Table rows inside the box, edges included, in row order
+        self.update()
+        lats = self.table.lat
+        lons = self.table.lon
+        found = []
+        for box in split_bbox(min_lat, min_lon, max_lat, max_lon):
+            low_lat, low_lon, high_lat, high_lon = box
+            lat_start, lon_start = self.cell(low_lat, low_lon)
+            lat_stop, lon_stop = self.cell(high_lat, high_lon)
+            if (lat_stop - lat_start + 1) * (lon_stop - lon_start + 1) > len(self.cells):
+                # Box larger than the data; visit the filled cells instead
+                rows = [rows for (lat_cell, lon_cell), rows in self.cells.items()
+                        if lat_start <= lat_cell <= lat_stop and lon_start <= lon_cell <= lon_stop]
+            else:
+                rows = [self.cells.get((lat_cell, lon_cell), ())
+                        for lat_cell in range(lat_start, lat_stop + 1)
+                        for lon_cell in range(lon_start, lon_stop + 1)]
+            for cell_rows in rows:
+                for row in cell_rows:
+                    if low_lat <= lats[row] <= high_lat and low_lon <= lons[row] <= high_lon:
+                        found.append(row)
+        found.sort()
+        return found
+
+    def bbox(self, min_lat, min_lon, max_lat, max_lon):
+        # Settlements inside the box; min_lon > max_lon crosses the
+        # antimeridian
+        table = self.table
+        return [table[row] for row in self.rows_in_bbox(min_lat, min_lon, max_lat, max_lon)]
+
+    def radius(self, lat, lon, km):
+        # Nearby settlements within km of lat, lon, nearest first
+        lats = self.table.lat
+        lons = self.table.lon
+        found = []
+        for row in self.rows_in_bbox(*bbox_around(lat, lon, km)):
+            distance = haversine_km(lat, lon, lats[row], lons[row])
+            if distance <= km:
+                found.append((distance, row))
+        found.sort()
+        table = self.table
+        return [Nearby(distance, table[row]) for distance, row in found]
+
+    def nearest(self, lat, lon, k=1, max_km=None):
+        # Up to k Nearby settlements closest to lat, lon, nearest first
+        return nearest_by_radius(self.radius, lat, lon, k, 2 * 111.2 * self.cell_degrees, max_km)
+
+    def nearest_join(self, points, max_km=None):
+        # Nearest settlement for each (lat, lon) of points, as
+        # (point, Nearby or None) pairs
+        for point in points:
+            found = self.nearest(point[0], point[1], 1, max_km)
+            yield point, found[0] if found else None
@@ -0,0 +1,424 @@
+# -*- coding: utf-8 -*-
+"""
+SQLite sink streaming cleaned settlement rows from Popul.process_data
+straight into typed settlement tables, plus the incremental updater used
+for replication diffs and the merge of per-region databases. Settlements
+are nodes, ways or relations, whose ids are only unique per kind, so rows
+are keyed on (node_id, kind). Located settlements are also kept in an
+R*Tree index, settlement_rtree, for bounding box queries.
+"""
+
+import sqlite3
+
+TABLES = ('settlement_nodes', 'settlement_places', 'settlement_popul')
+
+SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS settlement_nodes (
+           node_id INTEGER NOT NULL,
+           user TEXT,
+           uid INTEGER,
+           timestamp INTEGER,
+           lat REAL,
+           lon REAL,
+           kind TEXT NOT NULL DEFAULT 'node')""",
+    """CREATE TABLE IF NOT EXISTS settlement_places (
+           node_id INTEGER NOT NULL,
+           name TEXT NOT NULL,
+           place TEXT,
+           place_change INTEGER NOT NULL DEFAULT 0,
+           est_name TEXT,
+           kind TEXT NOT NULL DEFAULT 'node')""",
+    """CREATE TABLE IF NOT EXISTS settlement_popul (
+           node_id INTEGER NOT NULL,
+           name TEXT NOT NULL,
+           osm_population INTEGER,
+           pop_2016 INTEGER,
+           source TEXT,
+           kind TEXT NOT NULL DEFAULT 'node')""",
+)
+
+INDEXES = (
+    "CREATE INDEX IF NOT EXISTS settlement_nodes_node_id ON settlement_nodes (node_id)",
+    "CREATE INDEX IF NOT EXISTS settlement_places_node_id ON settlement_places (node_id)",
+    "CREATE INDEX IF NOT EXISTS settlement_places_name ON settlement_places (name)",
+    "CREATE INDEX IF NOT EXISTS settlement_places_est_name ON settlement_places (est_name)",
+    "CREATE INDEX IF NOT EXISTS settlement_popul_node_id ON settlement_popul (node_id)",
+    "CREATE INDEX IF NOT EXISTS settlement_popul_name ON settlement_popul (name)",
+)
+
+# Columns added since the first schema, for tables created before them;
+# rows stored before kind was added are all nodes
+KIND_COLUMN = ('kind', "TEXT NOT NULL DEFAULT 'node'")
+ADDED_COLUMNS = {'settlement_nodes': (('lat', 'REAL'), ('lon', 'REAL'), KIND_COLUMN),
+                 'settlement_places': (('est_name', 'TEXT'), KIND_COLUMN),
+                 'settlement_popul': (KIND_COLUMN,)}
+
+# Element kinds in the order of their code in an element key
+KINDS = ('node', 'way', 'relation')
+
+# element_key() in SQL, for a table or alias prefix such as 'n.'
+ELEMENT_KEY_SQL = ("({0}node_id * 4 + CASE {0}kind WHEN 'way' THEN 1 "
+                   "WHEN 'relation' THEN 2 ELSE 0 END)")
+
+# Point boxes of settlement_nodes rows with a location. An R*Tree row has
+# a single integer id, so it holds the element key of (node_id, kind).
+RTREE_SCHEMA = """CREATE VIRTUAL TABLE IF NOT EXISTS settlement_rtree
+           USING rtree(element_key, min_lat, max_lat, min_lon, max_lon)"""
+
+RTREE_FILL = """INSERT OR REPLACE INTO settlement_rtree
+           SELECT {}, lat, lat, lon, lon FROM settlement_nodes
+           WHERE lat IS NOT NULL AND lon IS NOT NULL""".format(ELEMENT_KEY_SQL.format(''))
+
+STATE_SCHEMA = """CREATE TABLE IF NOT EXISTS replication_state (
+           id INTEGER PRIMARY KEY CHECK (id = 1),
+           sequence INTEGER NOT NULL,
+           applied TEXT NOT NULL)"""
+
+COLUMNS = {
+    'settlement_nodes': ('node_id', 'user', 'uid', 'timestamp', 'lat', 'lon', 'kind'),
+    'settlement_places': ('node_id', 'name', 'place', 'place_change', 'est_name', 'kind'),
+    'settlement_popul': ('node_id', 'name', 'osm_population', 'pop_2016', 'source', 'kind'),
+}
+
+# Columns are named, as upgraded tables can hold them in another order
+INSERTS = dict((table, "INSERT INTO {} ({}) VALUES ({})".format(
+    table, ', '.join(columns), ', '.join('?' * len(columns)))) for table, columns in COLUMNS.items())
+
+RTREE_INSERT = "INSERT OR REPLACE INTO settlement_rtree VALUES (?, ?, ?, ?, ?)"
+
+# Rows of one stored settlement
+MATCH_ELEMENT = 'node_id = ? AND kind = ?'
+
+
+def element_key(kind, node_id):
+    # Single integer id of an element, unique across kinds
+    return int(node_id) * 4 + KINDS.index(kind)
+
+
+def add_columns(connect, table, columns):
+    # Add the (name, type) columns table is missing; returns their names
+    existing = [row[1] for row in connect.execute('PRAGMA table_info({})'.format(table))]
+    added = []
+    for name, column_type in columns:
+        if name not in existing:
+            connect.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(table, name, column_type))
+            added.append(name)
+    return added
+
+
+def create_tables(connect):
+    # Create or upgrade the settlement tables. Returns whether the R*Tree
+    # index is available; SQLite can be built without the rtree module.
+    cur = connect.cursor()
+    for statement in SCHEMA:
+        cur.execute(statement)
+    for table, columns in ADDED_COLUMNS.items():
+        if 'est_name' in add_columns(connect, table, columns):
+            # Best guess for settlements stored without their estimates
+            # place: the exact name match
+            cur.execute('UPDATE settlement_places SET est_name = name')
+    for statement in INDEXES:
+        cur.execute(statement)
+    try:
+        cur.execute(RTREE_SCHEMA)
+    except sqlite3.OperationalError:
+        return False
+    if [row[1] for row in cur.execute('PRAGMA table_info(settlement_rtree)')][0] != 'element_key':
+        # Index from before ways and relations were stored, keyed on the
+        # bare node id
+        cur.execute('DROP TABLE settlement_rtree')
+        cur.execute(RTREE_SCHEMA)
+        cur.execute(RTREE_FILL)
+    return True
+
+
+def rtree_rows(node_rows):
+    # settlement_rtree rows for the node rows with a location
+    return [(element_key(row[6], row[0]), float(row[4]), float(row[4]), float(row[5]), float(row[5]))
+            for row in node_rows if row[4] is not None and row[5] is not None]
+
+
+class SQLiteSink(object):
+    # Bulk loader for the settlement tables. Rows are buffered and inserted
+    # with executemany every batch_size settlements inside one transaction
+    # per load, with WAL journaling and synchronous=OFF while loading; the
+    # database's own journal mode is put back on close. A fresh load
+    # empties the tables but keeps their schema and indexes. On an
+    # exception the whole load is rolled back.
+
+    def __init__(self, db_path, batch_size=50000, replace=True):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.connect = sqlite3.connect(db_path, isolation_level=None)
+        self.journal_mode = None
+        try:
+            self.journal_mode = self.connect.execute('PRAGMA journal_mode').fetchone()[0]
+            self.connect.execute('PRAGMA journal_mode=WAL')
+            self.connect.execute('PRAGMA synchronous=OFF')
+            self.rtree = create_tables(self.connect)
+            self.connect.execute('BEGIN')
+            if replace:
+                for table in TABLES:
+                    self.connect.execute('DELETE FROM {}'.format(table))
+                if self.rtree:
+                    self.connect.execute('DELETE FROM settlement_rtree')
+        except Exception:
+            self.release()
+            raise
+        self.rows = dict((table, []) for table in TABLES)
+        self.rows_written = dict((table, 0) for table in TABLES)
+
+    def write(self, node_row, place_row, popul_row):
+        # One settlement; place_row and popul_row are keyed by the node id
+        # and kind of node_row
+        rows = self.rows
+        rows['settlement_nodes'].append(node_row)
+        rows['settlement_places'].append(tuple(place_row) + (node_row[6],))
+        rows['settlement_popul'].append((node_row[0],) + tuple(popul_row) + (node_row[6],))
+        if len(rows['settlement_nodes']) >= self.batch_size:
+            self.flush()
+
+    def write_records(self, table, start=0, stop=None):
+        # Rows start:stop of a SettlementTable
+        rows = self.rows
+        rows['settlement_nodes'].extend(table.node_rows(start, stop))
+        kinds = table.column('kind', start, stop)
+        rows['settlement_places'].extend(row + (kind,) for row, kind in
+                                         zip(table.place_rows(start, stop), kinds))
+        node_ids = table.node_id[start:stop]
+        rows['settlement_popul'].extend((node_id,) + row + (kind,) for node_id, row, kind in
+                                        zip(node_ids, table.popul_rows(start, stop), kinds))
+        if len(rows['settlement_nodes']) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        cur = self.connect.cursor()
+        for table in TABLES:
+            rows = self.rows[table]
+            if rows:
+                cur.executemany(INSERTS[table], rows)
+                if table == 'settlement_nodes' and self.rtree:
+                    cur.executemany(RTREE_INSERT, rtree_rows(rows))
+                self.rows_written[table] += len(rows)
+                self.rows[table] = []
+
+    def close(self):
+        if self.connect is None:
+            return
+        try:
+            self.flush()
+            self.connect.execute('COMMIT')
+        finally:
+            self.release()
+
+    def abort(self):
+        if self.connect is not None:
+            self.release()
+
+    def release(self):
+        # Roll back an unfinished load, restore the journal mode the
+        # database had before the load and close the connection
+        connect = self.connect
+        self.connect = None
+        try:
+            if connect.in_transaction:
+                connect.execute('ROLLBACK')
+            if self.journal_mode is not None:
+                try:
+                    connect.execute('PRAGMA journal_mode={}'.format(self.journal_mode))
+                except sqlite3.OperationalError:
+                    # Another connection still has the database open; it
+                    # stays in WAL mode
+                    pass
+        finally:
+            connect.close()
+
+    def stats(self):
+        return dict((table, {'rows_written': self.rows_written[table]}) for table in TABLES)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+
+class SQLiteUpdater(object):
+    # Applies per-settlement upserts and deletes to existing settlement
+    # tables inside a single transaction, and tracks the last replication
+    # sequence number applied. The load is rolled back on an exception.
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.connect = sqlite3.connect(db_path, isolation_level=None)
+        self.rtree = create_tables(self.connect)
+        self.connect.execute(STATE_SCHEMA)
+        self.connect.execute('BEGIN')
+        self.upserted = 0
+        self.deleted = 0
+
+    def last_sequence(self):
+        row = self.connect.execute('SELECT sequence FROM replication_state').fetchone()
+        return row[0] if row else None
+
+    def set_sequence(self, sequence):
+        self.connect.execute("INSERT OR REPLACE INTO replication_state VALUES (1, ?, datetime('now'))",
+                             (sequence,))
+
+    def name_owner(self, est_name):
+        # (kind, node id) of the element currently holding an estimates
+        # place, if any
+        row = self.connect.execute('SELECT kind, node_id FROM settlement_places WHERE est_name = ?',
+                                   (est_name,)).fetchone()
+        return tuple(row) if row else None
+
+    def holds(self, kind, node_id):
+        return self.connect.execute('SELECT 1 FROM settlement_nodes WHERE {} LIMIT 1'.format(MATCH_ELEMENT),
+                                    (node_id, kind)).fetchone() is not None
+
+    def remove(self, cur, kind, node_id):
+        # Rows of one element in every table; returns the rows removed
+        removed = 0
+        for table in TABLES:
+            cur.execute('DELETE FROM {} WHERE {}'.format(table, MATCH_ELEMENT), (node_id, kind))
+            removed = max(removed, cur.rowcount)
+        if self.rtree:
+            cur.execute('DELETE FROM settlement_rtree WHERE element_key = ?',
+                        (element_key(kind, node_id),))
+        return removed
+
+    def delete(self, kind, node_id):
+        # Remove a stored settlement; one indexed lookup for elements
+        # that never were one, as most elements in a diff
+        if not self.holds(kind, node_id):
+            return 0
+        removed = self.remove(self.connect.cursor(), kind, node_id)
+        self.deleted += removed
+        return removed
+
+    def upsert(self, node_row, place_row, popul_row):
+        # Replace one settlement's rows. Ways and relations in a diff come
+        # without a location, so one already stored is kept.
+        cur = self.connect.cursor()
+        node_id, kind = node_row[0], node_row[6]
+        if node_row[4] is None or node_row[5] is None:
+            location = cur.execute('SELECT lat, lon FROM settlement_nodes WHERE {}'.format(MATCH_ELEMENT),
+                                   (node_id, kind)).fetchone()
+            if location is not None:
+                node_row = tuple(node_row[:4]) + tuple(location) + (kind,)
+        self.remove(cur, kind, node_id)
+        cur.execute(INSERTS['settlement_nodes'], node_row)
+        if self.rtree:
+            cur.executemany(RTREE_INSERT, rtree_rows([node_row]))
+        cur.execute(INSERTS['settlement_places'], tuple(place_row) + (kind,))
+        cur.execute(INSERTS['settlement_popul'], (node_id,) + tuple(popul_row) + (kind,))
+        self.upserted += 1
+
+    def close(self):
+        if self.connect is None:
+            return
+        try:
+            self.connect.execute('COMMIT')
+        finally:
+            self.connect.close()
+            self.connect = None
+
+    def abort(self):
+        if self.connect is None:
+            return
+        try:
+            self.connect.execute('ROLLBACK')
+        finally:
+            self.connect.close()
+            self.connect = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+
+def add_region_column(connect):
+    # Settlement tables of a merged database name their source region
+    for table in TABLES:
+        add_columns(connect, table, (('region', 'TEXT'),))
+
+
+class RegionMerger(object):
+    # Merges settlement databases of several regional extracts into one,
+    # with each row tagged with its region. Extracts can overlap, so a
+    # settlement is skipped when a region merged before it already holds
+    # the same element (node id and kind) or estimates place. Each region
+    # is merged in its own transaction.
+
+    def __init__(self, db_path, replace=True):
+        self.db_path = db_path
+        self.connect = sqlite3.connect(db_path, isolation_level=None)
+        self.rtree = create_tables(self.connect)
+        add_region_column(self.connect)
+        if replace:
+            self.connect.execute('BEGIN')
+            for table in TABLES:
+                self.connect.execute('DELETE FROM {}'.format(table))
+            if self.rtree:
+                self.connect.execute('DELETE FROM settlement_rtree')
+            self.connect.execute('COMMIT')
+        self.merged = {}
+
+    def merge(self, region, source_path):
+        # Copy one region's settlements; returns (added, skipped)
+        cur = self.connect.cursor()
+        cur.execute('ATTACH DATABASE ? AS region_db', (source_path,))
+        try:
+            cur.execute('BEGIN')
+            try:
+                cur.execute('DROP TABLE IF EXISTS temp.merge_keep')
+                cur.execute("""CREATE TEMP TABLE merge_keep AS
+                                   SELECT node_id, kind FROM region_db.settlement_places AS p
+                                   WHERE NOT EXISTS (
+                                       SELECT 1 FROM main.settlement_places AS m
+                                       WHERE (m.node_id = p.node_id AND m.kind = p.kind)
+                                           OR m.est_name = p.est_name)""")
+                for table in TABLES:
+                    columns = ', '.join(COLUMNS[table])
+                    cur.execute("""INSERT INTO main.{0} ({1}, region)
+                                       SELECT {1}, ? FROM region_db.{0}
+                                       WHERE (node_id, kind) IN (SELECT node_id, kind FROM temp.merge_keep)""".format(table, columns),
+                                (region,))
+                if self.rtree:
+                    cur.execute("""INSERT OR REPLACE INTO main.settlement_rtree
+                                       SELECT {}, lat, lat, lon, lon FROM region_db.settlement_nodes
+                                       WHERE (node_id, kind) IN (SELECT node_id, kind FROM temp.merge_keep)
+                                           AND lat IS NOT NULL AND lon IS NOT NULL""".format(ELEMENT_KEY_SQL.format('')))
+                added = cur.execute('SELECT COUNT(*) FROM temp.merge_keep').fetchone()[0]
+                total = cur.execute('SELECT COUNT(*) FROM region_db.settlement_places').fetchone()[0]
+                cur.execute('DROP TABLE temp.merge_keep')
+                cur.execute('COMMIT')
+            except Exception:
+                cur.execute('ROLLBACK')
+                raise
+        finally:
+            cur.execute('DETACH DATABASE region_db')
+        self.merged[region] = (added, total - added)
+        return self.merged[region]
+
+    def close(self):
+        if self.connect is not None:
+            self.connect.close()
+            self.connect = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+Whole-file statistics for an OSM extract (element counts, tag key
+histogram, edits per user, timestamp years), collected during the
+settlement parse and cached next to the input file.
+"""
+
+import json
+import os
+
+STATS_VERSION = 1
+
+
+def stats_file_name(file_name):
+    return file_name + '.stats.json'
+
+
+def file_stamp(file_name):
+    # Cache key: a changed size or mtime means a different extract
+    stat = os.stat(file_name)
+    return [STATS_VERSION, stat.st_size, stat.st_mtime_ns]
+
+
+def add_counts(counts, other):
+    for key, n in other.items():
+        counts[key] = counts.get(key, 0) + n
+
+
+class OSMStats(object):
+    # Counters filled in by the parsers. elements counts nodes, ways and
+    # relations, tag_keys counts every tag key on them, users counts
+    # elements per last editing user and years elements per timestamp year.
+
+    def __init__(self, elements=None, tag_keys=None, users=None, years=None, size=None):
+        self.elements = elements or {'node': 0, 'way': 0, 'relation': 0}
+        self.tag_keys = tag_keys or {}
+        self.users = users or {}
+        self.years = years or {}
+        self.size = size
+
+    def add_element(self, kind, user, timestamp, keys=()):
+        # Count one element; keys are its tag keys, when not counted
+        # separately through tag_keys
+        self.elements[kind] = self.elements.get(kind, 0) + 1
+        users = self.users
+        users[user] = users.get(user, 0) + 1
+        year = (timestamp or '')[:4]
+        self.years[year] = self.years.get(year, 0) + 1
+        tag_keys = self.tag_keys
+        for key in keys:
+            tag_keys[key] = tag_keys.get(key, 0) + 1
+
+    def merge(self, other):
+        # Add counts from another part of the same file
+        add_counts(self.elements, other.elements)
+        add_counts(self.tag_keys, other.tag_keys)
+        add_counts(self.users, other.users)
+        add_counts(self.years, other.years)
+        return self
+
+    def top(self, counts, n=10):
+        return sorted(counts.items(), key=lambda item: (-item[1], item[0]))[:n]
+
+    def as_dict(self):
+        return {'elements': self.elements, 'tag_keys': self.tag_keys,
+                'users': self.users, 'years': self.years, 'size': self.size}
+
+    @classmethod
+    def load(cls, file_name):
+        # Cached stats for an OSM file, or None when there are none for
+        # the file as it is now
+        try:
+            with open(stats_file_name(file_name), encoding='utf8') as f:
+                saved = json.load(f)
+            if saved.get('stamp') == file_stamp(file_name):
+                data = saved['stats']
+                # Elements without a user were saved under ''
+                users = dict((user or None, n) for user, n in data['users'].items())
+                return cls(data['elements'], data['tag_keys'], users,
+                           data['years'], data['size'])
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+        return None
+
+    def save(self, file_name):
+        stamp = file_stamp(file_name)
+        self.size = stamp[1]
+        try:
+            with open(stats_file_name(file_name), 'w', encoding='utf8') as f:
+                # None (no user attribute) is not a valid JSON key
+                data = self.as_dict()
+                data['users'] = dict((user or '', n) for user, n in self.users.items())
+                json.dump({'stamp': stamp, 'stats': data}, f)
+        except (IOError, OSError):
+            # Read only location, collect again next time
+            pass
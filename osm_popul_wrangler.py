@@ -4,38 +4,100 @@ Class for auditing and cleaning population data for settlements in OSM files
 within Texas, USA.
 """
 
+import cProfile
 import csv
 import os
+import pstats
 import pandas as pd
-import sqlite3
 import time
+import tracemalloc
 import xml.etree.cElementTree as ET
+from contextlib import ExitStack
+
+from osm_popul_cache import CandidateCache
+from osm_popul_compress import compression_of, open_osm
+from osm_popul_diff import iter_changes, open_osc, read_sequence
+from osm_popul_estimates import EstimateSeries, load_estimates
+from osm_popul_export import (ChangeExporter, ChangesetWriter, DEFAULT_COMMENT, DEFAULT_SOURCE,
+                              edits_from_sqlite, edits_from_table)
+from osm_popul_extract import (Candidate, PopulationScanner, SOURCE_PREFIX, TagExtractor,
+                               iter_parallel)
+from osm_popul_locations import AreaResolver
+from osm_popul_metrics import Metrics
+from osm_popul_parquet import ArrowReport, ParquetSink
+from osm_popul_pbf import PBFReader
+from osm_popul_records import SettlementTable
+from osm_popul_report import SettlementReport
+from osm_popul_shape import shape_batch
+from osm_popul_spatial import SettlementGrid
+from osm_popul_sql import SQLiteSink, SQLiteUpdater
+from osm_popul_stats import OSMStats
+from osm_popul_writer import SettlementWriter
 
 class Popul(object):
     
-    def __init__(self, file_name=None, url=None):
+    def __init__(self, file_name=None, url=None, db_path='p3_osm.db', out_dir=None):
         self.file_name = file_name
-        self.osm_file = open(file_name, 'r', encoding="utf8")
+        self.file_format = 'pbf' if file_name.lower().endswith('.pbf') else 'xml'
+        # .bz2, .gz, .xz and .zst extracts are decompressed as they are read
+        self.compression = compression_of(file_name)
+        # Binary mode lets the parsers decode the XML themselves
+        self.osm_file = open_osm(file_name)
         self.pop_est = {}
+        self.est_index = None
+        # Multi-year estimates loaded by get_popul_series
+        self.est_series = None
+        self.match_stats = {}
         self.node_data = []
         self.tag_data = []
+        # Cleaned settlements of the last process_data run, and a grid
+        # index over their coordinates built on first use
+        self.settlements = SettlementTable()
+        self.spatial_index = None
+        # csv files and a relative db_path go to out_dir when given, so
+        # runs over different extracts do not overwrite each other
+        self.out_dir = out_dir
+        if out_dir and not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+        self.node_file_name = self.output_path('node_attribs.csv')
+        self.place_file_name = self.output_path('place_data.csv')
+        self.popul_file_name = self.output_path('popul_data.csv')
+        self.db_path = self.output_path(db_path)
+        self.parquet_dir = self.output_path('settlements_parquet')
+        self.changes_dir = self.output_path('osm_changes')
+        # Reports read the SQLite tables, or the Parquet ones after a run
+        # writing only those
+        self.report_source = 'sqlite'
+        self.report = None
+        self.writer = None
+        self.sinks = []
+        self.write_stats = {}
+        self.scanner = None
+        self.scan_stats = {}
+        self.osm_stats = None
+        # Way and relation settlement locations found by resolve_areas
+        self.area_locations = None
+        self.area_stats = {}
+        # Replaced per process_data run; this one never prints
+        self.metrics = Metrics(progress_every=None)
+        self.profile_stats = None
+
+    def output_path(self, name):
+        return os.path.join(self.out_dir, name) if self.out_dir else name
 
     def initialize_csvs(self):
         # Initialize csv files for later writing and export into SQL
-        self.node_file_name = 'node_attribs.csv'
         self.node_csv = open(self.node_file_name, 'w')
         self.write_node_csv = csv.writer(self.node_csv)
         
-        self.place_file_name = 'place_data.csv'
         self.place_csv = open(self.place_file_name, 'w')
         self.write_place_csv = csv.writer(self.place_csv)
         
-        self.popul_file_name = 'popul_data.csv'
         self.popul_csv = open(self.popul_file_name, 'w')
         self.write_popul_csv = csv.writer(self.popul_csv)
         
-        self.write_node_csv.writerow(('node_id', 'user', 'uid', 'timestamp'))
-        self.write_place_csv.writerow(('node_id', 'name', 'place', 'place_change'))
+        self.write_node_csv.writerow(('node_id', 'user', 'uid', 'timestamp', 'lat', 'lon', 'kind'))
+        self.write_place_csv.writerow(('node_id', 'name', 'place', 'place_change', 'est_name'))
         self.write_popul_csv.writerow(('name', 'osm_population', 'pop_2016', 'source'))
         
         self.node_csv.close()
@@ -45,6 +107,11 @@ class Popul(object):
     
     def get_element(self, tags=('node', 'way', 'relation')):
         # Element iterator for parsing and counting nodes, borrowed from lessons
+        if self.file_format == 'pbf':
+            for elem in PBFReader(self.file_name).iter_elements(tags):
+                yield elem
+            return
+        self.osm_file.seek(0)
         context = ET.iterparse(self.osm_file, events=('start', 'end'))
         __, root = next(context)
         for event, elem in context:
@@ -52,25 +119,98 @@ class Popul(object):
                 yield elem
                 root.clear()
         
+    def iter_candidates(self, workers=None, chunk_bytes=64 << 20, prefilter=False, stats=None):
+        # Stream settlement candidates (elements with place or population
+        # tags) from the OSM file without building element trees. With
+        # workers > 1 the file is split into chunk_bytes ranges parsed on a
+        # process pool; candidates still arrive in file order. prefilter
+        # memory-maps the file and parses only elements with a population
+        # tag, recording byte counts in self.scanner. PBF input is decoded
+        # by PBFReader, with workers > 1 decompressing blobs in parallel.
+        # Every element is counted into stats (an OSMStats) when given,
+        # which the pre-filter cannot do as it skips most of the file.
+        # Compressed XML is parsed as it is decompressed, with workers > 1
+        # decompressing multi-stream bz2 files in parallel.
+        if self.file_format == 'pbf':
+            if prefilter:
+                raise ValueError("prefilter only applies to XML input")
+            return PBFReader(self.file_name, workers).iter_candidates(stats)
+        if self.compression is not None:
+            if prefilter:
+                raise ValueError("prefilter needs an uncompressed file")
+            self.osm_file.close()
+            self.osm_file = open_osm(self.file_name, workers)
+            return TagExtractor(stats=stats).iter_file(self.osm_file)
+        if prefilter:
+            if workers and workers > 1:
+                raise ValueError("prefilter scans serially, drop workers={}".format(workers))
+            if stats is not None:
+                raise ValueError("prefilter skips elements, stats cannot be collected")
+            self.scanner = PopulationScanner()
+            return self.scanner.iter_file(self.file_name)
+        if workers and workers > 1:
+            return iter_parallel(self.file_name, workers, chunk_bytes, stats)
+        # Each pass reads the shared handle from the start
+        self.osm_file.seek(0)
+        return TagExtractor(stats=stats).iter_file(self.osm_file)
+
+    def iter_element_candidates(self):
+        # Element tree equivalent of iter_candidates, kept for comparison
+        for element in self.get_element():
+            name = None
+            place = None
+            popul = None
+            source = None
+            for tag in element.iter('tag'):
+                if tag.attrib['k'] == 'name':
+                    name = tag.get('v')
+                if tag.attrib['k'] == 'place':
+                    place = tag.get('v')
+                if tag.attrib['k'] == 'population':
+                    popul = tag.get('v')
+                if tag.attrib['k'].startswith(SOURCE_PREFIX):
+                    source = tag.get('v')
+            if place is not None or popul is not None:
+                yield Candidate(element.tag, element.get('id'), element.get('user'),
+                                element.get('uid'), element.get('timestamp'),
+                                name, place, popul, source, element.get('lat'), element.get('lon'))
+
     def get_file_size(self):
         # Print opened file size
         size = os.stat(self.file_name).st_size        
         print("Opened OSM file size = {} megabytes".format(round(size/float(1000000), 2)))
+        return size
     
-    def get_osm_stats(self):
-        # Prints counts for element tags in set(node, way, relation)
-        print("Counting element tags in file...")
-        counts = {'node':0, 'way':0, 'relation':0}
-        
-        for element in self.get_element():
-            counts[element.tag] += 1
-        
-        for key in counts:
-            print("{}s in {} = {}".format(key, self.file_name, counts[key]))
+    def get_osm_stats(self, workers=None):
+        # Prints counts for element tags in set(node, way, relation), the
+        # most used tag keys, the most active users and edits per year
+        stats = self.load_osm_stats(workers)
+        counts = stats.elements
+        for key in ('node', 'way', 'relation'):
+            print("{}s in {} = {}".format(key, self.file_name, counts.get(key, 0)))
+        print("Top tag keys: " + ", ".join("{} {}".format(key, n) for key, n in stats.top(stats.tag_keys)))
+        print("Top users: " + ", ".join("{} {}".format(user, n) for user, n in stats.top(stats.users)))
+        print("Elements by year: " + ", ".join("{} {}".format(year or '?', stats.years[year])
+                                                for year in sorted(stats.years)))
+        return stats
+
+    def load_osm_stats(self, workers=None):
+        # Whole-file stats cached next to the input by process_data or an
+        # earlier call while the file's size and mtime are unchanged,
+        # otherwise collected in one streaming pass and cached
+        self.osm_stats = OSMStats.load(self.file_name)
+        if self.osm_stats is None:
+            print("Counting element tags in file...")
+            stats = OSMStats()
+            for __ in self.iter_candidates(workers, stats=stats):
+                pass
+            stats.save(self.file_name)
+            self.osm_stats = stats
+        return self.osm_stats
         
     def reset_data_files(self):
         # Deletes and re-initializes csv files
-        for each in ['node_attribs.csv', 'place_data.csv', 'popul_data.csv']:
+        for each in [self.node_file_name, self.place_file_name, self.popul_file_name]:
             try:
                 os.remove(each)
             except:
@@ -78,11 +218,31 @@ class Popul(object):
         
         self.initialize_csvs()
             
+    def open_writer(self, batch_size=1000):
+        # Buffered writer keeping all three csv files open for a whole run
+        return SettlementWriter(self.node_file_name, self.place_file_name,
+                                self.popul_file_name, batch_size=batch_size)
+
+    def write_settlement(self, node_row, place_row, popul_row):
+        # Send one settlement's rows to every sink opened by process_data,
+        # or append them to the csv files when no run is in progress
+        if not self.sinks:
+            self.write_node_data(node_row)
+            self.write_place_data(place_row)
+            self.write_popul_data(popul_row)
+            return
+        assert len(node_row) == 7 and len(place_row) == 5 and len(popul_row) == 4
+        for sink in self.sinks:
+            sink.write(node_row, place_row, popul_row)
+
     def write_node_data(self, data):
         # Write function for appending new data to existing csv file
         # 'node_attribs.csv'
-        assert len(data) == 4
-        node_csv = open('node_attribs.csv', 'a')
+        assert len(data) == 7
+        if self.writer is not None:
+            self.writer.node.writerow(data)
+            return
+        node_csv = open(self.node_file_name, 'a')
         writer = csv.writer(node_csv)
         writer.writerow(data)
         node_csv.close()
@@ -90,8 +250,11 @@ class Popul(object):
     def write_place_data(self, data):
         # Write function for appending new data to existing csv file
         # 'place_data.csv'
-        assert len(data) == 4
-        place_csv = open('place_data.csv', 'a')
+        assert len(data) == 5
+        if self.writer is not None:
+            self.writer.place.writerow(data)
+            return
+        place_csv = open(self.place_file_name, 'a')
         writer = csv.writer(place_csv)
         writer.writerow(data)
         place_csv.close()
@@ -100,18 +263,48 @@ class Popul(object):
         # Write function for appending new data to existing csv file
         # 'popul_data.csv'
         assert len(data) == 4
-        popul_csv = open('popul_data.csv', 'a')
+        if self.writer is not None:
+            self.writer.popul.writerow(data)
+            return
+        popul_csv = open(self.popul_file_name, 'a')
         writer = csv.writer(popul_csv)
         writer.writerow(data)
         popul_csv.close()
     
         
     def get_popul_est(self, f=r"C:\users\user\OSM_Project_Repository\2015_txpopest_place.csv"):
-        # Read csv file of Texas gov population estimates into city keyed dict
-        reader = csv.reader(open(f))
-        for row in reader:
-            #row[2] = 2010 US Census figure, row[4] = Texas estimate for 1-1-2016
-            self.pop_est[row[1]] = [row[2], row[4]] 
+        # Read csv file of Texas gov population estimates into city keyed
+        # dict, and its normalized (name, county) index cached in binary
+        # next to the csv
+        self.use_estimates(*load_estimates(f))
+
+    def get_popul_series(self, vintages, year=None, workers=None):
+        # Read yearly estimates files into self.est_series, an
+        # EstimateSeries, on up to workers processes. vintages are file
+        # names like 2015_txpopest_place.csv or (year, file name) pairs.
+        # Settlements are then cleaned against each place's most recent
+        # estimate, or against estimates interpolated to year.
+        self.est_series = EstimateSeries.from_vintages(vintages, workers)
+        self.use_estimates(self.est_series.pop_est(year), self.est_series.estimate_index(year))
+        return self.est_series
+
+    def use_estimates(self, pop_est, est_index):
+        # Use estimates loaded elsewhere, as by load_estimates
+        self.pop_est = pop_est
+        self.est_index = est_index
+
+    def lookup_estimate(self, name):
+        # Returns (matched place name, [2010 census, 2016 estimate]) for an
+        # OSM settlement name, or (None, None). Uses the normalized index with
+        # fuzzy fallback when loaded, otherwise the exact pop_est dict.
+        if self.est_index is None:
+            if name in self.pop_est:
+                return name, self.pop_est[name]
+            return None, None
+        entry = self.est_index.lookup(name)
+        if entry is None:
+            return None, None
+        return entry[0], entry[1:]
             
     def shape_source_helper(self):
         if self.node_data[5] == 'US Census' and self.node_data[4] == self.pop_est[1]:
@@ -120,174 +313,488 @@ class Popul(object):
             self.node_data[5] = 'US Census 2010'
             
                 
-    def shape_data(self):
+    def shape_data(self, est=None):
         # Update population figures to most recent gov estimates
         # Update OSM settlement type based on revised population figures
         # Input: list of len = 7, 
         #        [OSM node id, city name, OSM settlement type, T/F for settlement type change,
         #         OSM population, revised population (init None), OSM pop source]
+        #        est, the matched [census, estimate] pair (default pop_est[name])
         # Output: None
-        osm_pop = int(self.tag_data[3])
         name = self.tag_data[0]
-        pop_2016 = int(self.pop_est[name][1])
-        if pop_2016 != osm_pop:
-            self.tag_data[4] = int(pop_2016)
-            place = None
-            if pop_2016 < 100:
-                place = 'hamlet'
-            elif pop_2016 <10000:
-                place = 'village'
-            elif pop_2016 <100000:
-                place = 'town'
-            else:
-                place = 'city'
-                
-            if place != self.tag_data[1]:
-                self.tag_data[1] = place
-                self.tag_data[2] = True
-        else:
-            self.tag_data[4] = osm_pop
+        if est is None:
+            est = self.pop_est[name]
+        place, place_change, population = self.revise_settlement(self.tag_data[1], self.tag_data[3], est)
+        self.tag_data[1] = place
+        self.tag_data[2] = self.tag_data[2] or place_change
+        self.tag_data[4] = population
         self.shape_source_helper
+        return self.tag_data
+
+    def revise_settlement(self, place, popul, est):
+        # Cleaning rules for one settlement: returns (place, place_change,
+        # population) from its OSM place and population tags and the
+        # matched [census, estimate] pair
+        osm_pop = int(popul)
+        pop_2016 = int(est[1])
+        if pop_2016 == osm_pop:
+            return place, False, osm_pop
+        if pop_2016 < 100:
+            revised = 'hamlet'
+        elif pop_2016 <10000:
+            revised = 'village'
+        elif pop_2016 <100000:
+            revised = 'town'
+        else:
+            revised = 'city'
+        if revised != place:
+            return revised, True, pop_2016
+        return place, False, pop_2016
 
         
-    def process_data(self):
+    def process_data(self, batch_size=1000, workers=None, prefilter=False, output=('csv',),
+                     vectorized=False, progress_every=10.0, metrics_file=None, profile=None,
+                     use_cache=False, resolve_areas=False):
         # Parse, audit and update OSM population data
-        # Extracted and cleaned data written to csv files
-        count = 0
+        # Extracted and cleaned data written to csv files, buffered and
+        # flushed every batch_size rows, and/or streamed into the SQLite
+        # tables at self.db_path when output includes 'sqlite', and/or as
+        # Parquet files in self.parquet_dir for 'parquet'. workers > 1
+        # parses the file in parallel chunks with identical output.
+        # prefilter=True only parses elements found by a byte-level scan for
+        # population tags. vectorized=True cleans candidates in columnar
+        # chunks of batch_size settlements instead of one at a time.
+        # Progress is printed every progress_every secs (None for quiet) and
+        # stage metrics are left in self.metrics, and rewritten to
+        # metrics_file in Prometheus text format as the run goes.
+        # profile='cprofile' or 'tracemalloc' captures a profile into
+        # self.profile_stats. Unless prefiltering, the whole-file stats
+        # behind get_osm_stats are collected in the same pass and cached.
+        # The cleaned settlements are kept in self.settlements, a
+        # SettlementTable that can be queried without reading the csvs,
+        # and by location through get_spatial_index().
+        # With use_cache the parsed candidates are kept in a sidecar cache
+        # keyed by the file's content hash and prefilter, and later runs
+        # over the same file clean the cached candidates instead of
+        # parsing it again. Hashing costs one extra read of a new or
+        # changed file, so caching is off unless asked for.
+        # resolve_areas=True locates way and relation settlements at their
+        # centroid in extra passes before the main one (see resolve_areas);
+        # otherwise only node settlements have coordinates.
+        if not output or set(output) - set(('csv', 'sqlite', 'parquet')):
+            raise ValueError("output must name 'csv', 'sqlite' and/or 'parquet', got {}".format(output))
+        if profile not in (None, 'cprofile', 'tracemalloc'):
+            raise ValueError("profile must be 'cprofile' or 'tracemalloc', got {}".format(profile))
         time_start = time.time()
         print("Processing OSM file...")
-        # Reset data files to avoid data duplication
-        self.reset_data_files()
-        settlements = set([])
-        for element in self.get_element():
-            # Gather element data for later OSM correction
-            elem_id = element.get('id')
-            time_stamp_year = element.get('timestamp')[:4]
-            user = element.get('user')
-            user_id = element.get('uid')
-            self.node_data = [elem_id, user, user_id, time_stamp_year]
-            # Define and reset tag variables
-            name = None
-            place = None
-            popul = None
-            source = None
-            # Gather tag data
-            for tag in element.iter('tag'):
-                if tag.attrib['k'] == 'name':
-                    name = tag.get('v')
-                if tag.attrib['k'] == 'place':
-                    place = tag.get('v')
-                if tag.attrib['k'] == 'population':
-                    popul = tag.get('v') 
-                if tag.attrib['k'].startswith('source:population'):
-                    source = tag.get('v')
-            # Write element and tag data to respective csv files
-            if (name in self.pop_est and name not in settlements and popul):
-                settlements.add(name)
-                count += 1
-                self.tag_data = [name, place, False, popul, None, source] 
-                self.tag_data = [elem_id] + self.shape_data()
-                self.write_node_data(self.node_data)
-                self.write_place_data(self.tag_data[:4])
-                self.write_popul_data([name] + self.tag_data[4:])
+        self.metrics = Metrics(os.path.getsize(self.file_name), progress_every, metrics_file)
+        profiler = self.start_profile(profile)
+        self.settlements = SettlementTable()
+        self.write_stats = {}
+        self.scanner = None
+        self.area_locations = None
+        if self.report is not None:
+            # Readers of the old tables would keep the load's WAL journal
+            self.report.close()
+            self.report = None
+        if resolve_areas:
+            with self.metrics.timer('resolve_areas'):
+                self.area_locations = self.resolve_areas()
+        with ExitStack() as stack:
+            cache = cached = None
+            if use_cache:
+                cache = stack.enter_context(CandidateCache(self.file_name,
+                                                           'prefilter' if prefilter else 'full'))
+                cached = cache.load()
+            if cached is not None:
+                print("Reading candidates from {}".format(cache.cache_name))
+            stats = None
+            if cached is None and not prefilter and OSMStats.load(self.file_name) is None:
+                stats = OSMStats()
+            # Sinks are only published on self once all of them opened, so
+            # a sink failing to open leaves no closed writer behind
+            sinks = []
+            writer = None
+            if 'csv' in output:
+                # Reset data files to avoid data duplication
+                self.reset_data_files()
+                writer = stack.enter_context(self.open_writer(batch_size))
+                sinks.append(writer)
+            if 'sqlite' in output:
+                sinks.append(stack.enter_context(SQLiteSink(self.db_path)))
+            if 'parquet' in output:
+                sinks.append(stack.enter_context(ParquetSink(self.parquet_dir)))
+            try:
+                self.sinks = sinks
+                self.writer = writer
+                count = self.process_elements(self.settlements, workers, prefilter, vectorized,
+                                              stats, batch_size, cached, cache)
+            finally:
+                self.sinks = []
+                self.writer = None
+                self.stop_profile(profile, profiler)
+        for sink in sinks:
+            self.write_stats.update(sink.stats())
+        self.report_source = 'parquet' if 'parquet' in output and 'sqlite' not in output else 'sqlite'
+        if stats is not None:
+            stats.save(self.file_name)
+            self.osm_stats = stats
+        if self.scanner is not None:
+            self.scan_stats = self.scanner.stats()
         time_end = time.time()
         total_time = round(time_end - time_start, 4)
-        print("Data processed in {} secs. \n{} population tags found and cleaned.\n\n".format(total_time, count))
-
-    def write_sql(self):
-        # Writes csv data to sql files
-        nodes_df = pd.read_csv(self.node_file_name)
-        places_df = pd.read_csv(self.place_file_name)
-        popul_df = pd.read_csv(self.popul_file_name)
-        connect = sqlite3.connect(r'C:\Users\User\sqlite_windows\p3_osm2')
-        cur = connect.cursor()
-        cur.execute('DROP TABLE IF EXISTS settlement_nodes;')
-        cur.execute('DROP TABLE IF EXISTS settlement_places;')
-        cur.execute('DROP TABLE IF EXISTS settlement_popul;')
-        nodes_df.to_sql('settlement_nodes', connect)
-        places_df.to_sql('settlement_places', connect)
-        popul_df.to_sql('settlement_popul', connect)
-        connect.commit()
+        print("Data processed in {} secs. \n{} population tags found and cleaned.".format(total_time, count))
+        stats = self.match_stats
+        print("Estimate matches: {} exact, {} normalized/fuzzy of {} population tags".format(
+            stats['exact'], stats['matched'], stats['population_tags']))
+        for key in ('node', 'place', 'popul'):
+            if key in self.write_stats:
+                stats = self.write_stats[key]
+                print("{}: {} rows written, {} bytes flushed".format(stats['file'], stats['rows_written'], stats['bytes_flushed']))
+        for key in ('settlement_nodes', 'settlement_places', 'settlement_popul'):
+            if key in self.write_stats:
+                print("{}: {} rows loaded into {}".format(key, self.write_stats[key]['rows_written'], self.db_path))
+            if 'parquet:' + key in self.write_stats:
+                stats = self.write_stats['parquet:' + key]
+                print("{}: {} rows written".format(stats['file'], stats['rows_written']))
+        if self.area_locations is not None:
+            stats = self.area_stats
+            print("Located {} of {} way and relation settlements from {} stored nodes in {} passes".format(
+                stats['located'], stats['areas'], stats['nodes_stored'], stats['passes']))
+        if self.scanner is not None:
+            stats = self.scan_stats
+            print("Pre-filter parsed {} of {} bytes ({} skipped) in {} elements".format(
+                stats['bytes_parsed'], stats['bytes_total'], stats['bytes_skipped'], stats['elements_parsed']))
+        stages = self.metrics.as_dict()['stages']
+        print("Stage times: " + ", ".join("{} {} secs".format(name, stages[name]['secs'])
+                                          for name in sorted(stages)))
+        if metrics_file:
+            self.metrics.write_prometheus(metrics_file)
+        print("\n")
+
+    def start_profile(self, profile):
+        if profile == 'cprofile':
+            profiler = cProfile.Profile()
+            profiler.enable()
+            return profiler
+        if profile == 'tracemalloc':
+            tracemalloc.start()
+        return None
+
+    def stop_profile(self, profile, profiler):
+        # Keep the captured profile in self.profile_stats and print its top
+        if profile == 'cprofile':
+            profiler.disable()
+            self.profile_stats = pstats.Stats(profiler)
+            self.profile_stats.sort_stats('cumulative').print_stats(15)
+        elif profile == 'tracemalloc':
+            snapshot = tracemalloc.take_snapshot()
+            __, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            self.profile_stats = snapshot
+            print("Peak traced memory = {} megabytes".format(round(peak / 1e6, 2)))
+            for stat in snapshot.statistics('lineno')[:10]:
+                print(stat)
+
+    def bytes_consumed(self):
+        # Bytes of the input consumed so far by a serial XML or pre-filter
+        # parse, for the progress readout
+        if self.compression is not None:
+            return self.osm_file.compressed_tell()
+        if self.scanner is not None:
+            return self.scanner.position
+        return self.osm_file.tell()
+
+    def process_elements(self, table, workers=None, prefilter=False, vectorized=False,
+                         stats=None, batch_size=1000, candidates=None, cache=None):
+        # Audit every settlement candidate into table, skipping places the
+        # table already holds (first occurrence in file order wins), and
+        # write the new settlements in batches of batch_size. Returns the
+        # number written. Candidates are parsed from the file unless given,
+        # and recorded into cache (a CandidateCache) when parsed.
+        position = None
+        if candidates is None:
+            self.scanner = None
+            candidates = self.iter_candidates(workers, prefilter=prefilter, stats=stats)
+            if cache is not None:
+                candidates = cache.record(candidates)
+            if self.file_format == 'xml' and (prefilter or self.compression or not workers or workers < 2):
+                position = self.bytes_consumed
+        if self.area_locations:
+            candidates = self.locate_areas(candidates, self.area_locations)
+        metrics = self.metrics
+        candidates = metrics.wrap('parse', candidates, position)
+        start = written = len(table)
+        if vectorized:
+            for added in self.shape_batch(candidates, table, batch_size):
+                metrics.count('settlements', added)
+                written = self.write_records(table, written)
+        else:
+            for __ in self.shape_rows(candidates, table):
+                metrics.count('settlements')
+                if len(table) - written >= batch_size:
+                    written = self.write_records(table, written)
+        self.write_records(table, written)
+        return len(table) - start
+
+    def resolve_areas(self):
+        # {(kind, element id): (lat, lon)} for the way and relation
+        # settlements of the file. Node locations are kept in a file-backed
+        # NodeLocationStore next to the input, reused while the file's
+        # size and mtime are unchanged.
+        resolver = AreaResolver(self.file_name)
+        locations = resolver.resolve()
+        self.area_stats = resolver.stats
+        return locations
+
+    def locate_areas(self, candidates, locations):
+        # Fill in the coordinates of way and relation candidates
+        for candidate in candidates:
+            if candidate.lat is None:
+                location = locations.get((candidate.kind, candidate.elem_id))
+                if location is not None:
+                    candidate = candidate._replace(lat='{:.7f}'.format(location[0]),
+                                                   lon='{:.7f}'.format(location[1]))
+            yield candidate
+
+    def write_records(self, table, start, stop=None):
+        # Write table rows start:stop to the open sinks. Returns stop.
+        if stop is None:
+            stop = len(table)
+        with self.metrics.timer('write'):
+            for sink in self.sinks:
+                sink.write_records(table, start, stop)
+        return stop
+
+    def shape_rows(self, candidates, table):
+        # Per-row cleaning: adds each new settlement among candidates to
+        # table, yielding its row number
+        # Estimate match counts over population tagged candidates
+        stats = self.match_stats = {'population_tags': 0, 'exact': 0, 'matched': 0}
+        timer = self.metrics.timer
+        for candidate in candidates:
+            name = candidate.name
+            if not candidate.popul:
+                continue
+            stats['population_tags'] += 1
+            if name in self.pop_est:
+                stats['exact'] += 1
+            with timer('lookup'):
+                matched, est = self.lookup_estimate(name)
+            if est is None:
+                continue
+            stats['matched'] += 1
+            if not table.has_match(matched):
+                with timer('shape'):
+                    place, place_change, population = self.revise_settlement(
+                        candidate.place, candidate.popul, est)
+                    table.append(candidate.elem_id, candidate.user, candidate.uid,
+                                 (candidate.timestamp or '')[:4], name, place, place_change,
+                                 candidate.popul, population, candidate.source, matched,
+                                 candidate.lat, candidate.lon, candidate.kind)
+                yield len(table) - 1
+
+    def shape_batch(self, candidates, table, chunk_size=1000):
+        # Columnar cleaning of candidates into table, chunk_size settlements
+        # at a time, yielding the number added per chunk; same settlements
+        # as shape_rows
+        self.match_stats = {'population_tags': 0, 'exact': 0, 'matched': 0}
+        return shape_batch(candidates, table, self.lookup_estimate, self.pop_est,
+                           self.match_stats, chunk_size)
+
+    def clean_candidate(self, candidate, est=None, matched=None):
+        # Node, place and population rows for one settlement candidate;
+        # matched is the estimates place of est, by default its name
+        name = candidate.name
+        elem_id = candidate.elem_id
+        if est is None:
+            est = self.pop_est[name]
+        if matched is None:
+            matched = name
+        place, place_change, population = self.revise_settlement(candidate.place, candidate.popul, est)
+        # Gather element data for later OSM correction
+        return ((elem_id, candidate.user, candidate.uid, (candidate.timestamp or '')[:4],
+                 candidate.lat, candidate.lon, candidate.kind),
+                (elem_id, name, place, place_change, matched),
+                (name, candidate.popul, population, candidate.source))
+
+    def apply_diff(self, osc_name, sequence=None):
+        # Apply an OsmChange (.osc or .osc.gz) diff to the settlement tables
+        # at self.db_path instead of re-processing the whole extract. Only
+        # changed elements with population tags are cleaned and upserted;
+        # deletes, and modifies that drop the tags, remove the element's
+        # rows if it is a stored settlement. Rows are keyed on element kind
+        # and id, so a way never replaces the node sharing its id. Ways and
+        # relations in a diff carry no location and keep the one stored
+        # for them, if any. As in process_data, an estimates place is held
+        # by the first settlement matched to it. sequence defaults to the
+        # one in the diff's .state.txt, and diffs at or below the last
+        # applied sequence are skipped. Returns False if the diff was
+        # skipped.
+        if sequence is None:
+            sequence = read_sequence(osc_name)
+        time_start = time.time()
+        counts = {'create': 0, 'modify': 0, 'delete': 0}
+        with SQLiteUpdater(self.db_path) as updater:
+            last = updater.last_sequence()
+            if sequence is not None and last is not None and sequence <= last:
+                print("Diff {} already applied, last sequence = {}".format(sequence, last))
+                return False
+            with open_osc(osc_name) as osc_file:
+                for action, candidate in iter_changes(osc_file):
+                    counts[action] += 1
+                    name = candidate.name
+                    matched = est = None
+                    if action != 'delete' and candidate.popul:
+                        matched, est = self.lookup_estimate(name)
+                    element = (candidate.kind, candidate.elem_id)
+                    if est is None:
+                        updater.delete(*element)
+                        continue
+                    owner = updater.name_owner(matched)
+                    if owner is not None and (owner[0], str(owner[1])) != element:
+                        # Another spelling of a place already held
+                        updater.delete(*element)
+                        continue
+                    updater.upsert(*self.clean_candidate(candidate, est, matched))
+            if sequence is not None:
+                updater.set_sequence(sequence)
+        total_time = round(time.time() - time_start, 4)
+        print("Diff applied in {} secs: {} created, {} modified, {} deleted elements.".format(
+            total_time, counts['create'], counts['modify'], counts['delete']))
+        print("{} settlements upserted, {} removed.\n".format(updater.upserted, updater.deleted))
+        return True
+
+    def write_sql(self, db_path=None):
+        # Writes csv data from an earlier process_data run to sql tables.
+        # process_data(output=('sqlite',)) loads the tables directly instead.
+        files = [open(name, encoding='utf8', newline='') for name in
+                 (self.node_file_name, self.place_file_name, self.popul_file_name)]
+        try:
+            readers = [csv.reader(f) for f in files]
+            for reader in readers:
+                next(reader)
+            with SQLiteSink(db_path or self.db_path) as sink:
+                for node_row, place_row, popul_row in zip(*readers):
+                    # Empty csv fields were None, place_change was a bool
+                    place_row[3] = place_row[3] == 'True'
+                    sink.write([value or None for value in node_row], place_row,
+                               [value or None for value in popul_row])
+        finally:
+            for f in files:
+                f.close()
+
+    def get_spatial_index(self, cell_degrees=0.1):
+        # SettlementGrid over the settlements of the last process_data run,
+        # for bbox, radius and nearest settlement lookups. The SQLite
+        # tables answer the same through get_report().in_bbox() and
+        # within_radius().
+        grid = self.spatial_index
+        if grid is None or grid.table is not self.settlements or grid.cell_degrees != cell_degrees:
+            grid = self.spatial_index = SettlementGrid(self.settlements, cell_degrees)
+        return grid
+
+    def get_report(self):
+        # Shared reporting layer over self.db_path, or the Parquet tables
+        # in self.parquet_dir, opened on first use
+        if self.report is None:
+            if self.report_source == 'parquet':
+                self.report = ArrowReport(self.parquet_dir)
+            else:
+                self.report = SettlementReport(self.db_path)
+        return self.report
 
     def get_pop_edits(self):
-        p3_db = sqlite3.connect(r'C:\Users\User\sqlite_windows\p3_osm2')
-        curs = p3_db.cursor()
-        curs.execute("SELECT COUNT(name) FROM settlement_places;")
-        n = curs.fetchone()[0]
+        n = self.get_report().summary().revised
         print("Number of revised populations = {}".format(n))
         print()
+        return n
     
     def get_pop_change_list(self):
-        p3_db = sqlite3.connect(r'C:\Users\User\sqlite_windows\p3_osm2')
-        curs = p3_db.cursor()
-        curs.execute("SELECT name, pop_2016 - osm_population,\
-                             round(((pop_2016 - osm_population)/(osm_population*1.0)), 3) AS proportion\
-                             FROM settlement_popul \
-                             ORDER BY proportion;")
-        settlements = curs.fetchall()
-        # Convert back to Pandas df to print cleanly
+        settlements = self.get_report().pop_changes()
+        # Convert to Pandas df to print cleanly
         settlements_df = pd.DataFrame(settlements, columns=('Settlement', 'Increase', 'Proportion'))
         print(settlements_df)
         print()
+        return settlements
         
     def get_averages(self):
-        p3_db = sqlite3.connect(r'C:\Users\User\sqlite_windows\p3_osm2')
-        curs = p3_db.cursor()
-        curs.execute("SELECT round(avg(pop_2016 - osm_population), 2) AS average_increase,\
-                             avg(1.0 * round(((pop_2016 - osm_population)/(1.0 * osm_population)), 4)) AS proportion\
-                             FROM settlement_popul;")
-        incr_avg, prop_avg = curs.fetchone()
-        print("Mean population increase = {}  \nMean proportional increase = {}".format(incr_avg, prop_avg))
+        summary = self.get_report().summary()
+        print("Mean population increase = {}  \nMean proportional increase = {}".format(
+            summary.mean_increase, summary.mean_proportion))
         print()
+        return summary
         
     def get_designation_changes(self):
-        p3_db = sqlite3.connect(r'C:\Users\User\sqlite_windows\p3_osm2')
-        curs = p3_db.cursor()
-        curs.execute("SELECT sum(place_change) AS Place_Changes FROM settlement_places;")
-        n_place_change = curs.fetchone()[0]
-        
+        report = self.get_report()
+        n_place_change = report.summary().place_changes
         print("Number of place designations changed = {}".format(n_place_change))
         print()
-        curs.execute("SELECT name, place FROM settlement_places WHERE place_change == 1")
-        place_change = curs.fetchall()
-        # Convert back to Pandas df to print cleanly
+        place_change = report.designation_changes()
+        # Convert to Pandas df to print cleanly
         place_change_df = pd.DataFrame(place_change, columns=('Settlement', 'New Designation'))
         print(place_change_df)
         print()
+        return place_change
         
     def get_sources(self):
-        p3_db = sqlite3.connect(r'C:\Users\User\sqlite_windows\p3_osm2')
-        curs = p3_db.cursor()
-        curs.execute("SELECT source, COUNT(*) AS Count FROM settlement_popul GROUP BY source ORDER BY Count DESC;")
-        source_count = curs.fetchall()
-        print(source_count)
+        source_count = self.get_report().sources()
         source_df = pd.DataFrame(source_count, columns=('Data Source', 'Count'))
         print(source_df)
         print()
+        return source_count
 
     def get_timestamp(self):
-        p3_db = sqlite3.connect(r'C:\Users\User\sqlite_windows\p3_osm2')
-        curs = p3_db.cursor()
-        curs.execute("SELECT timestamp, COUNT(timestamp) FROM settlement_nodes ORDER BY Count DESC;")
-        timestamp = curs.fetchall()
-        timestamp_df = pd.DataFrame([timestamp], columns=('Year of Data', 'Count'))
+        timestamp = self.get_report().timestamps()
+        timestamp_df = pd.DataFrame(timestamp, columns=('Year of Data', 'Count'))
         print(timestamp_df)
         print()
+        return timestamp
+
+    def export_changes(self, changeset_size=1000, source=DEFAULT_SOURCE, comment=DEFAULT_COMMENT,
+                       from_db=False):
+        # Write the population, place and source:population edits of the
+        # last process_data run (or of the SQLite tables at self.db_path
+        # with from_db) as OsmChange files in self.changes_dir, one per
+        # changeset of up to changeset_size elements, in one pass over the
+        # file. The extract must carry element versions (a PBF written with
+        # metadata, or XML with version attributes); elements without one
+        # are left out and counted as unversioned. Returns the export
+        # summary also saved as settlements.json.
+        time_start = time.time()
+        edits = edits_from_sqlite(self.db_path) if from_db else edits_from_table(self.settlements)
+        exporter = ChangeExporter(self.file_name, edits, source)
+        with ChangesetWriter(self.changes_dir, changeset_size,
+                             tags={'comment': comment, 'source': source}) as writer:
+            exporter.export(writer)
+        stats = writer.stats()
+        stats['settlements'] = len(edits)
+        stats['modified'] = exporter.modified
+        stats['skipped'] = exporter.skipped
+        stats['unversioned'] = exporter.unversioned
+        print("Exported {} edits of {} settlements in {} changesets to {} in {} secs".format(
+            exporter.modified, len(edits), len(stats['changesets']), self.changes_dir,
+            round(time.time() - time_start, 4)))
+        if exporter.unversioned:
+            print("{} settlements left out: {} has no element versions, export from an extract "
+                  "with metadata".format(exporter.unversioned, self.file_name))
+        return stats
 
 
-houston = Popul(file_name=r'C:\users\user\OSM_Project_Repository\dallas_texas.osm')
-#houston.get_file_size()
-#houston.get_osm_stats()
-houston.get_popul_est()
-houston.process_data()
-houston.write_sql()
-houston.get_designation_changes()
-houston.get_sources()
-#houston.get_timestamp()
-#aust = Popul(r'C:\users\user\OSM_Project_Repository\austin_texas.osm')
-##aust.get_file_size()
-##aust.get_osm_stats()
-#aust.get_popul_est()
-#aust.process_data()
-#aust.write_sql()
-#aust.get_data_stats()
\ No newline at end of file
+if __name__ == '__main__':
+    houston = Popul(file_name=r'C:\users\user\OSM_Project_Repository\dallas_texas.osm')
+    #houston.get_file_size()
+    #houston.get_osm_stats()
+    houston.get_popul_est()
+    houston.process_data()
+    houston.write_sql()
+    houston.get_designation_changes()
+    houston.get_sources()
+    #houston.get_timestamp()
+    #aust = Popul(r'C:\users\user\OSM_Project_Repository\austin_texas.osm')
+    ##aust.get_file_size()
+    ##aust.get_osm_stats()
+    #aust.get_popul_est()
+    #aust.process_data()
+    #aust.write_sql()
+    #aust.get_data_stats()
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+Buffered csv writers for the node, place and population output files
+produced by Popul.process_data.
+"""
+
+import csv
+import io
+
+
+class BatchWriter(object):
+    # Single csv output stream kept open for the length of a run. Rows are
+    # buffered in memory and flushed to disk every batch_size rows.
+
+    def __init__(self, file_name, batch_size=1000, mode='a'):
+        self.file_name = file_name
+        self.batch_size = batch_size
+        self.rows_written = 0
+        self.bytes_flushed = 0
+        self.flushes = 0
+        self.out_file = open(file_name, mode, encoding='utf8', newline='')
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer)
+        self.pending = 0
+
+    def writerow(self, row):
+        self.writer.writerow(row)
+        self.pending += 1
+        self.rows_written += 1
+        if self.pending >= self.batch_size:
+            self.flush()
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def flush(self):
+        # Move buffered rows to the open file
+        if not self.pending:
+            return
+        data = self.buffer.getvalue()
+        self.out_file.write(data)
+        self.bytes_flushed += len(data.encode('utf8'))
+        self.flushes += 1
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        self.pending = 0
+
+    def close(self):
+        if self.out_file.closed:
+            return
+        try:
+            self.flush()
+        finally:
+            self.out_file.close()
+
+    def stats(self):
+        return {'file': self.file_name,
+                'rows_written': self.rows_written,
+                'bytes_flushed': self.bytes_flushed,
+                'flushes': self.flushes}
+
+
+class SettlementWriter(object):
+    # Context manager holding the three settlement output streams. Buffered
+    # rows are flushed and the files closed on exit, including when the run
+    # is interrupted by an exception.
+
+    def __init__(self, node_file_name, place_file_name, popul_file_name,
+                 batch_size=1000, mode='a'):
+        self.node = BatchWriter(node_file_name, batch_size, mode)
+        self.place = BatchWriter(place_file_name, batch_size, mode)
+        self.popul = BatchWriter(popul_file_name, batch_size, mode)
+
+    def write(self, node_row, place_row, popul_row):
+        # One settlement's rows
+        self.node.writerow(node_row)
+        self.place.writerow(place_row)
+        self.popul.writerow(popul_row)
+
+    def write_records(self, table, start=0, stop=None):
+        # Rows start:stop of a SettlementTable
+        self.node.writerows(table.node_rows(start, stop))
+        self.place.writerows(table.place_rows(start, stop))
+        self.popul.writerows(table.popul_rows(start, stop))
+
+    def streams(self):
+        return (('node', self.node), ('place', self.place), ('popul', self.popul))
+
+    def flush(self):
+        for __, stream in self.streams():
+            stream.flush()
+
+    def close(self):
+        # Close every stream even if one of them fails
+        error = None
+        for __, stream in self.streams():
+            try:
+                stream.close()
+            except Exception as e:
+                error = error or e
+        if error is not None:
+            raise error
+
+    def stats(self):
+        return dict((key, stream.stats()) for key, stream in self.streams())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+"""
+Shared fixtures: a small synthetic extract and estimates csv written once
+per test session with the benchmark generators.
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from osm_popul_bench import write_synthetic_estimates, write_synthetic_osm
+
+
+@pytest.fixture(scope='session')
+def synthetic_osm(tmp_path_factory):
+    file_name = str(tmp_path_factory.mktemp('osm') / 'synthetic.osm')
+    write_synthetic_osm(file_name, elements=20000, settlement_density=0.05)
+    return file_name
+
+
+@pytest.fixture(scope='session')
+def synthetic_estimates(tmp_path_factory):
+    file_name = str(tmp_path_factory.mktemp('estimates') / 'synthetic_est.csv')
+    write_synthetic_estimates(file_name)
+    return file_name
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+"""
+Multi-region batch runs merged into one database.
+"""
+
+import sqlite3
+
+from osm_popul_batch import run_batch
+
+
+def test_overlapping_regions_merge_once(synthetic_osm, synthetic_estimates, tmp_path):
+    out_dir = str(tmp_path / 'batch')
+    results = run_batch([('east', synthetic_osm), ('west', synthetic_osm)], synthetic_estimates,
+                        out_dir, workers=1)
+    east, west = results
+    assert east['settlements'] == west['settlements'] > 0
+    assert (east['merged'], east['duplicates']) == (east['settlements'], 0)
+    assert (west['merged'], west['duplicates']) == (0, west['settlements'])
+    connect = sqlite3.connect(str(tmp_path / 'batch' / 'merged.db'))
+    try:
+        regions = connect.execute('SELECT region, COUNT(*) FROM settlement_places GROUP BY region').fetchall()
+    finally:
+        connect.close()
+    assert regions == [('east', east['settlements'])]
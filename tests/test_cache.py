@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+The sidecar candidate cache and its use by process_data.
+"""
+
+import contextlib
+import io
+import os
+import shutil
+
+import pytest
+
+from osm_popul_cache import CandidateCache, cache_file_name
+from osm_popul_extract import PopulationScanner, TagExtractor
+from osm_popul_wrangler import Popul
+
+
+@pytest.fixture
+def osm_name(synthetic_osm, tmp_path):
+    # Own copy, so cache files do not leak between tests
+    file_name = str(tmp_path / 'extract.osm')
+    shutil.copyfile(synthetic_osm, file_name)
+    return file_name
+
+
+def full_candidates(file_name):
+    with open(file_name, 'rb') as f:
+        return list(TagExtractor().iter_file(f))
+
+
+def test_cache_is_kept_per_mode(osm_name):
+    scanned = list(PopulationScanner().iter_file(osm_name))
+    with CandidateCache(osm_name, 'prefilter') as cache:
+        assert cache.load() is None
+        assert list(cache.record(iter(scanned))) == scanned
+    with CandidateCache(osm_name) as cache:
+        # The pre-filter's candidates lack the place-only ones
+        assert cache.load() is None
+        full = full_candidates(osm_name)
+        assert len(full) > len(scanned)
+        for __ in cache.record(iter(full)):
+            pass
+    with CandidateCache(osm_name) as cache:
+        assert list(cache.load()) == full
+    with CandidateCache(osm_name, 'prefilter') as cache:
+        assert cache.load() is None
+
+
+def test_abandoned_stream_leaves_no_cache(osm_name):
+    full = full_candidates(osm_name)
+    with CandidateCache(osm_name) as cache:
+        stream = cache.record(iter(full))
+        next(stream)
+        stream.close()
+    with CandidateCache(osm_name) as cache:
+        assert cache.load() is None
+
+
+def run(popul, **options):
+    with contextlib.redirect_stdout(io.StringIO()):
+        popul.process_data(output=('csv',), progress_every=None, **options)
+    return list(popul.settlements)
+
+
+def test_process_data_cache_is_opt_in(osm_name, synthetic_estimates, tmp_path):
+    popul = Popul(osm_name, out_dir=str(tmp_path / 'out'))
+    popul.get_popul_est(synthetic_estimates)
+    try:
+        expected = run(popul)
+        assert not os.path.exists(cache_file_name(osm_name))
+        assert run(popul, prefilter=True, use_cache=True) == expected
+        assert os.path.exists(cache_file_name(osm_name))
+        # A full run does not pick up the pre-filter's cache
+        assert run(popul, use_cache=True) == expected
+        assert run(popul, use_cache=True) == expected
+    finally:
+        popul.osm_file.close()
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+Compressed extracts parse to the same candidates as the plain file.
+"""
+
+import bz2
+import gzip
+import lzma
+
+import pytest
+
+import osm_popul_compress
+from osm_popul_compress import DecompressingReader, open_osm, split_bz2_streams
+from osm_popul_extract import TagExtractor
+
+# Small ranges, so the synthetic extract splits into several
+CHUNK_BYTES = 16 << 10
+
+
+def candidates(osm_file):
+    with osm_file:
+        return list(TagExtractor().iter_file(osm_file))
+
+
+@pytest.fixture(scope='module')
+def plain(synthetic_osm):
+    with open(synthetic_osm, 'rb') as f:
+        data = f.read()
+    return data, candidates(open(synthetic_osm, 'rb'))
+
+
+def write_bz2_streams(file_name, data, stream_bytes):
+    # Multi-stream bz2 as written by pbzip2: each block of stream_bytes
+    # compressed on its own
+    with open(file_name, 'wb') as f:
+        for start in range(0, len(data), stream_bytes):
+            f.write(bz2.compress(data[start:start + stream_bytes]))
+
+
+@pytest.mark.parametrize('suffix, compress', [('.gz', gzip.compress), ('.xz', lzma.compress),
+                                              ('.bz2', bz2.compress)])
+def test_streamed_formats(tmp_path, plain, suffix, compress):
+    data, expected = plain
+    file_name = tmp_path / ('extract.osm' + suffix)
+    file_name.write_bytes(compress(data))
+    reader = open_osm(str(file_name))
+    assert candidates(reader) == expected
+    assert reader.closed
+
+
+def test_multi_stream_bz2_in_parallel(tmp_path, plain):
+    data, expected = plain
+    file_name = str(tmp_path / 'extract.osm.bz2')
+    write_bz2_streams(file_name, data, 64 << 10)
+    assert len(split_bz2_streams(file_name, CHUNK_BYTES)) > 2
+    reader = DecompressingReader(file_name, workers=2, chunk_bytes=CHUNK_BYTES)
+    assert reader.chunks is not None
+    assert candidates(reader) == expected
+
+
+def test_single_stream_bz2_is_streamed(tmp_path, plain):
+    # One range would hold the whole uncompressed file in memory
+    data, expected = plain
+    file_name = str(tmp_path / 'extract.osm.bz2')
+    with open(file_name, 'wb') as f:
+        f.write(bz2.compress(data))
+    assert len(split_bz2_streams(file_name, CHUNK_BYTES)) == 1
+    reader = DecompressingReader(file_name, workers=2, chunk_bytes=CHUNK_BYTES)
+    assert reader.chunks is None
+    assert candidates(reader) == expected
+
+
+def test_oversized_streams_are_streamed(tmp_path, plain):
+    data, expected = plain
+    file_name = str(tmp_path / 'extract.osm.bz2')
+    write_bz2_streams(file_name, data, len(data) // 2 + 1)
+    reader = DecompressingReader(file_name, workers=2, chunk_bytes=CHUNK_BYTES)
+    assert reader.chunks is None
+    assert candidates(reader) == expected
+
+
+def test_false_stream_header_is_retried(tmp_path, plain, monkeypatch):
+    data, expected = plain
+    file_name = str(tmp_path / 'extract.osm.bz2')
+    write_bz2_streams(file_name, data, 64 << 10)
+    split = osm_popul_compress.split_bz2_streams
+
+    def split_inside_stream(file_name, chunk_bytes):
+        # As if the header pattern turned up inside the first stream's
+        # compressed data
+        ranges = split(file_name, chunk_bytes)
+        start, end = ranges[0]
+        middle = (start + end) // 2
+        return [(start, middle), (middle, end)] + ranges[1:]
+
+    monkeypatch.setattr(osm_popul_compress, 'split_bz2_streams', split_inside_stream)
+    reader = DecompressingReader(file_name, workers=2, chunk_bytes=CHUNK_BYTES)
+    assert candidates(reader) == expected
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+Replication diffs applied to the settlement tables of a processed extract.
+"""
+
+import contextlib
+import io
+import sqlite3
+
+import pytest
+
+from osm_popul_wrangler import Popul
+
+EXTRACT = """<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6">
+ <node id="1" version="1" timestamp="2015-01-01T00:00:00Z" uid="7" user="a" lat="30.1" lon="-97.2">
+  <tag k="name" v="Alpha"/>
+  <tag k="place" v="village"/>
+  <tag k="population" v="1200"/>
+ </node>
+ <node id="2" version="1" timestamp="2015-01-01T00:00:00Z" uid="7" user="a" lat="30.2" lon="-97.3">
+  <tag k="name" v="Beta"/>
+  <tag k="place" v="village"/>
+  <tag k="population" v="800"/>
+ </node>
+ <node id="3" version="1" lat="30.3" lon="-97.4"/>
+ <node id="4" version="1" timestamp="2015-01-01T00:00:00Z" uid="7" user="a" lat="29.4" lon="-98.2">
+  <tag k="name" v="St. Hedwig"/>
+  <tag k="place" v="town"/>
+  <tag k="population" v="2094"/>
+ </node>
+ <way id="1" version="1">
+  <nd ref="3"/>
+  <tag k="highway" v="residential"/>
+ </way>
+</osm>
+"""
+
+ESTIMATES = """county,place,census_2010,estimate_2015,estimate_2016
+Travis,Alpha,1100,1150,1250
+Travis,Beta,700,750,820
+Travis,Gamma,300,310,330
+Bexar,Saint Hedwig,2094,2200,2250
+"""
+
+DIFF = """<?xml version="1.0" encoding="UTF-8"?>
+<osmChange version="0.6">
+ <modify>
+  <way id="1" version="2">
+   <nd ref="3"/>
+   <tag k="highway" v="service"/>
+  </way>
+  <relation id="1" version="2">
+   <member type="way" ref="1" role="outer"/>
+   <tag k="type" v="multipolygon"/>
+  </relation>
+  <node id="3" version="2" lat="30.3" lon="-97.4"/>
+ </modify>
+ <delete>
+  <node id="2" version="2" lat="30.2" lon="-97.3"/>
+ </delete>
+</osmChange>
+"""
+
+
+def quietly(method, *args, **kwargs):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return method(*args, **kwargs)
+
+
+@pytest.fixture
+def processed(tmp_path):
+    osm_name = tmp_path / 'extract.osm'
+    osm_name.write_text(EXTRACT, encoding='utf8')
+    est_name = tmp_path / 'estimates.csv'
+    est_name.write_text(ESTIMATES, encoding='utf8')
+    popul = Popul(str(osm_name), out_dir=str(tmp_path / 'out'))
+    popul.get_popul_est(str(est_name))
+    quietly(popul.process_data, output=('sqlite',), progress_every=None)
+    yield popul
+    popul.osm_file.close()
+
+
+# Way 1 becomes a settlement next to node 1
+WAY_DIFF = """<?xml version="1.0" encoding="UTF-8"?>
+<osmChange version="0.6">
+ <modify>
+  <way id="1" version="2">
+   <nd ref="3"/>
+   <tag k="name" v="Gamma"/>
+   <tag k="place" v="hamlet"/>
+   <tag k="population" v="300"/>
+  </way>
+ </modify>
+</osmChange>
+"""
+
+
+# Another spelling of node 4's place
+SPELLING_DIFF = """<?xml version="1.0" encoding="UTF-8"?>
+<osmChange version="0.6">
+ <modify>
+  <node id="5" version="2" lat="29.4" lon="-98.2">
+   <tag k="name" v="Saint Hedwig"/>
+   <tag k="place" v="town"/>
+   <tag k="population" v="2100"/>
+  </node>
+ </modify>
+</osmChange>
+"""
+
+
+def stored_elements(db_path):
+    connect = sqlite3.connect(db_path)
+    try:
+        return connect.execute('SELECT kind, node_id, name FROM settlement_places ORDER BY kind, node_id').fetchall()
+    finally:
+        connect.close()
+
+
+def stored_ids(db_path):
+    connect = sqlite3.connect(db_path)
+    try:
+        return [row[0] for row in connect.execute('SELECT node_id FROM settlement_places ORDER BY node_id')]
+    finally:
+        connect.close()
+
+
+def test_diff_only_touches_stored_settlements(processed, tmp_path):
+    assert stored_ids(processed.db_path) == [1, 2, 4]
+    osc_name = tmp_path / '1.osc'
+    osc_name.write_text(DIFF, encoding='utf8')
+    assert quietly(processed.apply_diff, str(osc_name), 1)
+    # The way and relation sharing node 1's id leave it alone,
+    # and node 3 never was a settlement
+    assert stored_ids(processed.db_path) == [1, 4]
+    # Applied diffs are skipped
+    assert not quietly(processed.apply_diff, str(osc_name), 1)
+
+
+def test_diff_keys_settlements_on_kind_and_id(processed, tmp_path):
+    osc_name = tmp_path / '1.osc'
+    osc_name.write_text(WAY_DIFF, encoding='utf8')
+    assert quietly(processed.apply_diff, str(osc_name), 1)
+    assert stored_elements(processed.db_path) == [('node', 1, 'Alpha'), ('node', 2, 'Beta'),
+                                                  ('node', 4, 'St. Hedwig'), ('way', 1, 'Gamma')]
+    osc_name.write_text(WAY_DIFF.replace('modify', 'delete'), encoding='utf8')
+    assert quietly(processed.apply_diff, str(osc_name), 2)
+    assert stored_elements(processed.db_path) == [('node', 1, 'Alpha'), ('node', 2, 'Beta'),
+                                                  ('node', 4, 'St. Hedwig')]
+
+
+def test_diff_keeps_first_settlement_of_an_estimates_place(processed, tmp_path):
+    osc_name = tmp_path / '1.osc'
+    osc_name.write_text(SPELLING_DIFF, encoding='utf8')
+    assert quietly(processed.apply_diff, str(osc_name), 1)
+    assert stored_ids(processed.db_path) == [1, 2, 4]
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Estimate lookups by csv, normalized and fuzzy name, and the vintage series.
+"""
+
+import pytest
+
+from osm_popul_estimates import EstimateIndex, EstimateSeries, load_estimates, normalize_name
+
+ESTIMATES = """county,place,census_2010,estimate_2015,estimate_2016
+Tarrant,Lakeside,1307,1400,1420
+Archer,Lakeside City,997,1000,1010
+Travis,St. Elmo,50,55,60
+Bexar,Saint Hedwig,2094,2200,2250
+Harris,Cove,510,515,520
+Chambers,Cove,510,520,530
+"""
+
+
+@pytest.fixture
+def estimates(tmp_path):
+    file_name = tmp_path / '2015_txpopest_place.csv'
+    file_name.write_text(ESTIMATES, encoding='utf8')
+    return str(file_name)
+
+
+def test_normalize_name():
+    assert normalize_name('St. Elmo') == 'saint elmo'
+    assert normalize_name('Lakeside City') == 'lakeside'
+    assert normalize_name('City') == 'city'
+
+
+def test_csv_name_wins_over_normalized_collision(estimates):
+    index = EstimateIndex.from_csv(estimates)
+    assert index.lookup('Lakeside') == ('Lakeside', 1307, 1420)
+    assert index.lookup('Lakeside City') == ('Lakeside City', 997, 1010)
+    # Same canonical spelling as one of the colliding places
+    assert index.lookup('lakeside city') == ('Lakeside City', 997, 1010)
+    # Could be either place
+    assert index.lookup('Lakeside Village') is None
+    assert index.lookup('Lakeside Village', fuzzy=False) is None
+    assert index.is_ambiguous('Lakeside Village')
+    assert not index.is_ambiguous('Lakeside')
+
+
+def test_normalized_and_fuzzy_matches(estimates):
+    index = EstimateIndex.from_csv(estimates)
+    assert index.lookup('Saint Elmo') == ('St. Elmo', 50, 60)
+    assert index.lookup('St Hedwig') == ('Saint Hedwig', 2094, 2250)
+    assert index.lookup('Saint Hedwigg') == ('Saint Hedwig', 2094, 2250)
+    assert index.lookup('Saint Hedwigg', fuzzy=False) is None
+    assert index.lookup('Nowhere') is None
+
+
+def test_same_name_in_two_counties(estimates):
+    index = EstimateIndex.from_csv(estimates)
+    assert index.lookup('Cove') is None
+    assert index.lookup('Cove', county='Chambers') == ('Cove', 510, 530)
+    rates = index.match_rates(['Cove', 'Lakeside', 'Saint Elmo', 'Nowhere'])
+    assert rates == {'names': 4, 'exact': 2, 'normalized': 2, 'fuzzy': 2, 'ambiguous': 1}
+
+
+def test_cached_index_matches_csv(estimates):
+    built = EstimateIndex.load(estimates)
+    cached = EstimateIndex.load(estimates)
+    assert cached.entries == built.entries
+    assert cached.by_name == built.by_name
+    assert cached.lookup('Lakeside') == ('Lakeside', 1307, 1420)
+
+
+def test_series_index_keeps_collisions_apart(estimates, tmp_path):
+    later = tmp_path / '2016_txpopest_place.csv'
+    later.write_text(ESTIMATES.replace('1420', '1500'), encoding='utf8')
+    series = EstimateSeries.from_vintages([estimates, str(later)], workers=1)
+    index = series.estimate_index()
+    assert index.lookup('Lakeside') == ('Lakeside', 1307, 1500)
+    assert index.lookup('Lakeside City') == ('Lakeside City', 997, 1010)
+    assert index.lookup('Lakeside Village') is None
+    assert series.pop_est()['Lakeside'] == [1307, 1500]
+
+
+def test_load_estimates(estimates, tmp_path):
+    pop_est, index = load_estimates(estimates)
+    assert pop_est['Lakeside City'] == ['997', '1010']
+    assert index.lookup('Lakeside') == ('Lakeside', 1307, 1420)
+    later = tmp_path / '2016_txpopest_place.csv'
+    later.write_text(ESTIMATES.replace('1420', '1500'), encoding='utf8')
+    pop_est, index = load_estimates([estimates, str(later)], workers=1)
+    assert pop_est['Lakeside'] == [1307, 1500]
+    assert index.lookup('Lakeside') == ('Lakeside', 1307, 1500)
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+OsmChange export of cleaned settlements.
+"""
+
+from osm_popul_export import ChangeExporter, ChangesetWriter, Edit
+
+EXTRACT = """<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6">
+ <node id="1" version="3" lat="30.1" lon="-97.2">
+  <tag k="name" v="Alpha"/>
+  <tag k="place" v="village"/>
+  <tag k="population" v="1200"/>
+ </node>
+ <node id="3" version="1" lat="30.3" lon="-97.4"/>
+ <way id="1" version="2">
+  <nd ref="3"/>
+  <tag k="name" v="Alpha"/>
+  <tag k="place" v="village"/>
+  <tag k="population" v="1200"/>
+ </way>
+</osm>
+"""
+
+
+def export(tmp_path, edits, extract=EXTRACT):
+    osm_name = tmp_path / 'extract.osm'
+    osm_name.write_text(extract, encoding='utf8')
+    exporter = ChangeExporter(str(osm_name), edits)
+    with ChangesetWriter(str(tmp_path / 'changes')) as writer:
+        exporter.export(writer)
+    return exporter, writer
+
+
+def test_edits_are_keyed_on_kind_and_id(tmp_path):
+    # Same id, name and population on a node and a way; only the way is
+    # the settlement
+    edits = {('way', '1'): Edit('1', 'Alpha', '1200', 1300, None, 'way')}
+    exporter, writer = export(tmp_path, edits)
+    assert writer.stats()['elements'] == {'node': 0, 'way': 1, 'relation': 0}
+    assert (exporter.modified, exporter.skipped) == (1, 0)
+    text = (tmp_path / 'changes' / 'settlements_0001.osc').read_text(encoding='utf8')
+    assert '<way id="1" version="2">' in text
+    assert '<tag k="population" v="1300"/>' in text
+
+
+def test_elements_without_version_are_left_out(tmp_path):
+    # An extract written without metadata
+    extract = EXTRACT.replace(' version="2"', '').replace(' version="3"', '')
+    edits = {('node', '1'): Edit('1', 'Alpha', '1200', 1300, None, 'node'),
+             ('way', '1'): Edit('1', 'Alpha', '1200', 1300, None, 'way')}
+    exporter, writer = export(tmp_path, edits, extract)
+    assert (exporter.modified, exporter.skipped, exporter.unversioned) == (0, 0, 2)
+    assert writer.stats()['changesets'] == []
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+The streaming extractor against the element tree loop it replaced, and
+the parallel and pre-filter parses against the serial one.
+"""
+
+import pytest
+
+from osm_popul_extract import (Candidate, PopulationScanner, TagExtractor, iter_parallel,
+                               split_ranges)
+from osm_popul_stats import OSMStats
+from osm_popul_wrangler import Popul
+
+SAMPLE = b"""<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6">
+ <node id="1" version="2" timestamp="2015-01-01T00:00:00Z" uid="7" user="a" lat="30.1" lon="-97.2">
+  <tag k="name" v="Town"/>
+  <tag k="place" v="town"/>
+  <tag k="population" v="1200"/>
+  <tag k="source:population:date" v="census"/>
+ </node>
+ <node id="2" version="1" lat="30.2" lon="-97.3"/>
+ <node id="3" version="1" lat="30.3" lon="-97.4"><tag k="highway" v="stop"/></node>
+ <way id="4" version="1" user="b" uid="8">
+  <nd ref="1"/>
+  <tag k="place" v="hamlet"/>
+ </way>
+</osm>
+"""
+
+
+@pytest.fixture
+def popul(synthetic_osm):
+    popul = Popul(synthetic_osm)
+    yield popul
+    popul.osm_file.close()
+
+
+def test_tag_extractor_fields():
+    found = TagExtractor(chunk_size=64).parse_bytes(SAMPLE)
+    assert found == [Candidate('node', '1', 'a', '7', '2015-01-01T00:00:00Z', 'Town', 'town',
+                               '1200', 'census', '30.1', '-97.2'),
+                     Candidate('way', '4', 'b', '8', None, None, 'hamlet', None, None, None, None)]
+
+
+def test_tag_extractor_matches_element_tree(popul):
+    expected = list(popul.iter_element_candidates())
+    assert expected
+    assert list(popul.iter_candidates()) == expected
+
+
+def serial_parse(file_name):
+    stats = OSMStats()
+    with open(file_name, 'rb') as f:
+        found = TagExtractor(stats=stats).parse_bytes(f.read())
+    return found, stats
+
+
+@pytest.mark.parametrize('chunk_bytes', [4096, 1 << 20])
+def test_parallel_matches_serial(synthetic_osm, chunk_bytes):
+    serial, serial_stats = serial_parse(synthetic_osm)
+    parallel_stats = OSMStats()
+    parallel = list(iter_parallel(synthetic_osm, 2, chunk_bytes, parallel_stats))
+    assert parallel == serial
+    assert parallel_stats.elements == serial_stats.elements
+    assert parallel_stats.tag_keys == serial_stats.tag_keys
+
+
+def test_split_ranges_cover_file(synthetic_osm):
+    ranges = split_ranges(synthetic_osm, 4096)
+    assert len(ranges) > 1
+    assert all(end == start for (__, end), (start, __) in zip(ranges, ranges[1:]))
+    with open(synthetic_osm, 'rb') as f:
+        data = f.read()
+    for start, __ in ranges:
+        assert data[start:start + 5] in (b'<node', b'<way ', b'<rela')
+
+
+def test_parallel_through_popul(popul):
+    assert list(popul.iter_candidates(workers=2, chunk_bytes=8192)) == list(popul.iter_candidates())
+
+
+def test_prefilter_matches_full_parse(synthetic_osm):
+    serial, __ = serial_parse(synthetic_osm)
+    expected = [candidate for candidate in serial if candidate.popul is not None]
+    scanner = PopulationScanner(window=256)
+    assert list(scanner.iter_file(synthetic_osm)) == expected
+    stats = scanner.stats()
+    assert stats['candidates'] == len(expected)
+    assert 0 < stats['bytes_parsed'] < stats['bytes_total']
+    assert stats['bytes_skipped'] == stats['bytes_total'] - stats['bytes_parsed']
+
+
+def test_prefilter_multiple_population_tags(tmp_path):
+    file_name = str(tmp_path / 'sample.osm')
+    with open(file_name, 'wb') as f:
+        f.write(SAMPLE.replace(b'<tag k="place" v="town"/>', b'<tag k="population" v="9"/>'))
+    found = list(PopulationScanner().iter_file(file_name))
+    assert [(candidate.elem_id, candidate.popul) for candidate in found] == [('1', '1200')]
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+Node location store and the location of way and relation settlements.
+"""
+
+import numpy as np
+import pytest
+
+from osm_popul_locations import (AreaResolver, NodeLocationStore, NodeLocationWriter,
+                                 relation_location, ring_centroid)
+
+
+def square(lat, lon, size):
+    # Closed ring of (lat, lon) points
+    return [(lat, lon), (lat, lon + size), (lat + size, lon + size), (lat + size, lon), (lat, lon)]
+
+
+# A 4 degree outer ring and a 1 degree inner ring, as node ids 1-4 and
+# 11-14 in unsorted file order; way 100 is a settlement, relation 200 is
+# a multipolygon settlement made of untagged ways 101 and 102
+OUTER = dict(zip((1, 2, 3, 4), square(30.0, -98.0, 4.0)))
+INNER = dict(zip((11, 12, 13, 14), square(30.5, -97.5, 1.0)))
+NODES = [(node_id,) + OUTER.get(node_id, INNER.get(node_id)) for node_id in (13, 2, 11, 4, 1, 14, 3, 12)]
+
+
+def extract_xml(tail='', filler=0):
+    # filler extra nodes with descending ids go first
+    nodes = [(node_id, 10.0, 20.0) for node_id in range(100000 + filler, 100000, -1)] + NODES
+    nodes = ''.join(' <node id="{}" lat="{:.7f}" lon="{:.7f}"/>\n'.format(*node) for node in nodes)
+    return """<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6">
+{} <way id="101">
+  <nd ref="1"/><nd ref="2"/><nd ref="3"/><nd ref="4"/><nd ref="1"/>
+ </way>
+ <way id="102">
+  <nd ref="11"/><nd ref="12"/><nd ref="13"/><nd ref="14"/><nd ref="11"/>
+ </way>
+ <way id="100">
+  <nd ref="11"/><nd ref="12"/><nd ref="13"/><nd ref="14"/><nd ref="11"/>
+  <tag k="place" v="hamlet"/>
+ </way>
+ <relation id="200">
+  <member type="way" ref="101" role="outer"/>
+  <member type="way" ref="102" role="inner"/>
+  <tag k="type" v="multipolygon"/>
+  <tag k="population" v="900"/>
+ </relation>
+{}</osm>
+""".format(nodes, tail)
+
+
+def test_writer_merges_unsorted_runs(tmp_path):
+    rng = np.random.RandomState(7)
+    ids = rng.permutation(np.arange(1, 5001, dtype=np.int64) * 3)
+    lats = ids % 900
+    lons = -(ids % 1800)
+    base_name = str(tmp_path / 'nodes')
+    with NodeLocationWriter(base_name, chunk_nodes=700) as writer:
+        for start in range(0, len(ids), 250):
+            writer.add(ids[start:start + 250], lats[start:start + 250], lons[start:start + 250])
+    assert len(writer.runs) > 2 and not writer.in_order
+    store = NodeLocationStore(base_name)
+    try:
+        assert len(store) == len(ids)
+        assert np.all(store.ids[1:] > store.ids[:-1])
+        found = store.lookup(ids[:50].tolist() + [1, 2])
+        assert sorted(found) == sorted(ids[:50].tolist())
+        node_id = int(ids[0])
+        assert found[node_id] == ((node_id % 900) / 1e7, -(node_id % 1800) / 1e7)
+    finally:
+        store.close()
+
+
+def test_ring_centroid():
+    area, centroid = ring_centroid(square(30.0, -98.0, 4.0))
+    assert abs(area) == pytest.approx(16.0)
+    assert centroid == pytest.approx((32.0, -96.0))
+    assert ring_centroid([(1.0, 1.0), (2.0, 2.0), (1.0, 1.0)]) == (0.0, None)
+
+
+def test_relation_location_subtracts_inner_rings():
+    locations = dict(OUTER)
+    locations.update(INNER)
+    way_refs = {101: [1, 2, 3, 4, 1], 102: [11, 12, 13, 14, 11]}
+    members = [('way', 101, 'outer'), ('way', 102, 'inner')]
+    # (16 * outer centroid - 1 * inner centroid) / 15
+    assert relation_location(members, way_refs, locations) == pytest.approx(
+        ((16 * 32.0 - 31.0) / 15, (16 * -96.0 - -97.0) / 15))
+    # A label node wins
+    assert relation_location(members + [('node', 2, 'label')], way_refs, locations) == OUTER[2]
+
+
+def test_resolver_locates_areas(tmp_path):
+    file_name = tmp_path / 'extract.osm'
+    # Several parse chunks of nodes, written as several unsorted runs
+    file_name.write_text(extract_xml(filler=6000), encoding='utf8')
+    resolver = AreaResolver(str(file_name), chunk_nodes=1000)
+    found = resolver.resolve()
+    assert set(found) == set([('way', '100'), ('relation', '200')])
+    assert found[('way', '100')] == pytest.approx((31.0, -97.0))
+    assert found[('relation', '200')] == pytest.approx(((16 * 32.0 - 31.0) / 15, (16 * -96.0 - -97.0) / 15))
+    assert resolver.stats['passes'] == 2
+    assert resolver.stats['nodes_stored'] == len(NODES) + 6000
+    # The saved store is used by the next run
+    again = AreaResolver(str(file_name))
+    assert again.resolve() == found
+    assert again.stats['store_reused']
+
+
+def test_way_pass_stops_at_first_relation(tmp_path):
+    # Anything after the relations is never read
+    file_name = tmp_path / 'extract.osm'
+    file_name.write_text(extract_xml(' <way id="101" <<< not xml\n'), encoding='utf8')
+    resolver = AreaResolver(str(file_name))
+    resolver.scan_ways(set([101, 102]))
+    assert resolver.member_way_refs == {101: [1, 2, 3, 4, 1], 102: [11, 12, 13, 14, 11]}
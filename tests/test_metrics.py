@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+"""
+Run metrics of process_data.
+"""
+
+import contextlib
+import io
+import os
+
+import pytest
+
+from osm_popul_wrangler import Popul
+
+
+@pytest.mark.parametrize('workers', [None, 2])
+def test_finished_run_reports_whole_file(tmp_path, synthetic_osm, synthetic_estimates, workers):
+    metrics_file = str(tmp_path / 'metrics.prom')
+    popul = Popul(synthetic_osm, out_dir=str(tmp_path))
+    popul.get_popul_est(synthetic_estimates)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            popul.process_data(workers=workers, progress_every=None, metrics_file=metrics_file)
+    finally:
+        popul.osm_file.close()
+    size = os.path.getsize(synthetic_osm)
+    metrics = popul.metrics.as_dict()
+    assert metrics['bytes_done'] == metrics['total_bytes'] == size
+    with open(metrics_file, encoding='utf8') as f:
+        lines = f.read().splitlines()
+    assert 'osm_popul_bytes_read {}'.format(size) in lines
+    assert 'osm_popul_bytes_total {}'.format(size) in lines
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""
+Parquet output read back through ArrowReport against the SQLite report.
+"""
+
+import contextlib
+import io
+import os
+import subprocess
+import sys
+
+import pytest
+
+from osm_popul_wrangler import Popul
+
+pytest.importorskip('pyarrow')
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_pyarrow_is_imported_on_first_use():
+    code = ("import sys, osm_popul_parquet\n"
+            "assert 'pyarrow.parquet' not in sys.modules\n"
+            "osm_popul_parquet.require_pyarrow()\n"
+            "assert osm_popul_parquet.pq is sys.modules['pyarrow.parquet']\n")
+    subprocess.check_call([sys.executable, '-c', code], cwd=REPO)
+
+
+def test_arrow_report_matches_sqlite(synthetic_osm, synthetic_estimates, tmp_path):
+    popul = Popul(synthetic_osm, out_dir=str(tmp_path))
+    popul.get_popul_est(synthetic_estimates)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            popul.process_data(output=('sqlite', 'parquet'), progress_every=None)
+    finally:
+        popul.osm_file.close()
+    sqlite = popul.get_report().dashboard()
+    popul.report_source = 'parquet'
+    popul.report = None
+    arrow = popul.get_report().dashboard()
+    # Means are summed in a different order
+    assert arrow['summary'][:4] == sqlite['summary'][:4]
+    assert arrow['summary'].mean_proportion == pytest.approx(sqlite['summary'].mean_proportion)
+    assert sorted(arrow['designation_changes']) == sorted(sqlite['designation_changes'])
+    assert sorted(arrow['sources'], key=repr) == sorted(sqlite['sources'], key=repr)
+    assert sorted(arrow['timestamps'], key=repr) == sorted(sqlite['timestamps'], key=repr)
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""
+PBF decoding checked against the expat extractor on the same data as XML.
+A small PBF writer below encodes the elements of XML.
+"""
+
+import calendar
+import struct
+import time
+import xml.etree.ElementTree as ET
+import zlib
+
+import pytest
+
+from osm_popul_extract import TagExtractor
+from osm_popul_pbf import PBFReader
+from osm_popul_stats import OSMStats
+
+XML = """<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6">
+ <node id="1" version="2" timestamp="2015-03-01T12:00:00Z" uid="7" user="alice" lat="30.1000000" lon="-97.2000000">
+  <tag k="name" v="Alpha"/>
+  <tag k="place" v="village"/>
+  <tag k="population" v="1200"/>
+  <tag k="source:population" v="census"/>
+ </node>
+ <node id="2" version="1" timestamp="2009-07-04T08:30:00Z" uid="0" lat="30.2000000" lon="-97.3000000"/>
+ <node id="5" version="4" timestamp="2016-01-02T00:00:00Z" uid="9" user="bob" lat="-0.0000100" lon="179.9999999">
+  <tag k="name" v="Gamma"/>
+  <tag k="place" v="hamlet"/>
+ </node>
+ <node id="10" version="3" timestamp="2014-05-06T07:08:09Z" uid="7" user="alice" lat="29.5000000" lon="-98.5000000">
+  <tag k="name" v="Delta"/>
+  <tag k="population" v="50"/>
+ </node>
+ <way id="20" version="5" timestamp="2017-02-03T04:05:06Z" uid="9" user="bob">
+  <nd ref="1"/>
+  <nd ref="2"/>
+  <nd ref="5"/>
+  <nd ref="1"/>
+  <tag k="name" v="Beta"/>
+  <tag k="place" v="town"/>
+  <tag k="population" v="5000"/>
+ </way>
+ <relation id="30" version="1" timestamp="2012-12-12T12:12:12Z" uid="7" user="alice">
+  <member type="way" ref="20" role="outer"/>
+  <member type="node" ref="1" role="admin_centre"/>
+  <tag k="type" v="multipolygon"/>
+  <tag k="name" v="Epsilon"/>
+  <tag k="population" v="700"/>
+ </relation>
+</osm>
+"""
+
+
+def varint(value):
+    if value < 0:
+        value += 1 << 64
+    out = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+
+def number_field(number, value):
+    return varint(number << 3) + varint(value)
+
+
+def bytes_field(number, payload):
+    return varint(number << 3 | 2) + varint(len(payload)) + payload
+
+
+def packed(values):
+    return b''.join(varint(value) for value in values)
+
+
+def deltas(values):
+    # sint64 deltas as stored in packed delta fields
+    found = []
+    last = 0
+    for value in values:
+        found.append(zigzag(value - last))
+        last = value
+    return found
+
+
+class BlockWriter(object):
+    # PrimitiveBlock for a list of XML elements; nodes go in a DenseNodes
+    # group, or in plain Node messages with dense=False
+
+    def __init__(self):
+        self.strings = ['']
+        self.ids = {'': 0}
+
+    def sid(self, string):
+        if string not in self.ids:
+            self.ids[string] = len(self.strings)
+            self.strings.append(string)
+        return self.ids[string]
+
+    def tag_ids(self, element):
+        tags = element.findall('tag')
+        return [self.sid(tag.get('k')) for tag in tags], [self.sid(tag.get('v')) for tag in tags]
+
+    def info(self, element):
+        # Info message; user sid 0 stands for no user
+        return (number_field(1, int(element.get('version'))) +
+                number_field(2, seconds(element.get('timestamp'))) +
+                number_field(4, int(element.get('uid'))) +
+                number_field(5, self.sid(element.get('user', ''))))
+
+    def node(self, element):
+        keys, vals = self.tag_ids(element)
+        return bytes_field(1, number_field(1, zigzag(int(element.get('id')))) +
+                           bytes_field(2, packed(keys)) + bytes_field(3, packed(vals)) +
+                           bytes_field(4, self.info(element)) +
+                           number_field(8, zigzag(coord(element.get('lat')))) +
+                           number_field(9, zigzag(coord(element.get('lon')))))
+
+    def dense(self, nodes):
+        keys_vals = []
+        for element in nodes:
+            keys, vals = self.tag_ids(element)
+            for key, val in zip(keys, vals):
+                keys_vals.extend((key, val))
+            keys_vals.append(0)
+        info = (bytes_field(1, packed([int(node.get('version')) for node in nodes])) +
+                bytes_field(2, packed(deltas([seconds(node.get('timestamp')) for node in nodes]))) +
+                bytes_field(4, packed(deltas([int(node.get('uid')) for node in nodes]))) +
+                bytes_field(5, packed(deltas([self.sid(node.get('user', '')) for node in nodes]))))
+        return bytes_field(2, bytes_field(1, packed(deltas([int(node.get('id')) for node in nodes]))) +
+                           bytes_field(5, info) +
+                           bytes_field(8, packed(deltas([coord(node.get('lat')) for node in nodes]))) +
+                           bytes_field(9, packed(deltas([coord(node.get('lon')) for node in nodes]))) +
+                           bytes_field(10, packed(keys_vals)))
+
+    def way(self, element):
+        keys, vals = self.tag_ids(element)
+        refs = [int(nd.get('ref')) for nd in element.findall('nd')]
+        return bytes_field(3, number_field(1, int(element.get('id'))) +
+                           bytes_field(2, packed(keys)) + bytes_field(3, packed(vals)) +
+                           bytes_field(4, self.info(element)) + bytes_field(8, packed(deltas(refs))))
+
+    def relation(self, element):
+        keys, vals = self.tag_ids(element)
+        members = element.findall('member')
+        types = ('node', 'way', 'relation')
+        return bytes_field(4, number_field(1, int(element.get('id'))) +
+                           bytes_field(2, packed(keys)) + bytes_field(3, packed(vals)) +
+                           bytes_field(4, self.info(element)) +
+                           bytes_field(8, packed([self.sid(member.get('role')) for member in members])) +
+                           bytes_field(9, packed(deltas([int(member.get('ref')) for member in members]))) +
+                           bytes_field(10, packed([types.index(member.get('type')) for member in members])))
+
+    def block(self, elements, dense=True):
+        nodes = [element for element in elements if element.tag == 'node']
+        groups = []
+        if nodes and dense:
+            groups.append(self.dense(nodes))
+        elif nodes:
+            groups.append(b''.join(self.node(node) for node in nodes))
+        for element in elements:
+            if element.tag == 'way':
+                groups.append(self.way(element))
+            elif element.tag == 'relation':
+                groups.append(self.relation(element))
+        table = b''.join(bytes_field(1, string.encode('utf8')) for string in self.strings)
+        return (bytes_field(1, table) + b''.join(bytes_field(2, group) for group in groups) +
+                number_field(17, 100) + number_field(18, 1000))
+
+
+def seconds(timestamp):
+    return calendar.timegm(time.strptime(timestamp, '%Y-%m-%dT%H:%M:%SZ'))
+
+
+def coord(value):
+    # Degrees in units of the default 100 nanodegree granularity
+    return int(round(float(value) * 1e7))
+
+
+def blob(blob_type, data, compress):
+    if compress:
+        body = number_field(2, len(data)) + bytes_field(3, zlib.compress(data))
+    else:
+        body = bytes_field(1, data)
+    header = bytes_field(1, blob_type.encode('utf8')) + number_field(3, len(body))
+    return struct.pack('>I', len(header)) + header + body
+
+
+def write_pbf(file_name):
+    # Header blob, then the first three nodes dense in a zlib blob, the
+    # fourth as a plain node in a raw blob, and the way and relation in a
+    # zlib blob
+    elements = list(ET.fromstring(XML))
+    header = bytes_field(4, b'OsmSchema-V0.6') + bytes_field(4, b'DenseNodes')
+    with open(file_name, 'wb') as f:
+        f.write(blob('OSMHeader', header, True))
+        f.write(blob('OSMData', BlockWriter().block(elements[:3]), True))
+        f.write(blob('OSMData', BlockWriter().block(elements[3:4], dense=False), False))
+        f.write(blob('OSMData', BlockWriter().block(elements[4:]), True))
+
+
+@pytest.fixture(scope='module')
+def pbf_name(tmp_path_factory):
+    file_name = str(tmp_path_factory.mktemp('pbf') / 'extract.osm.pbf')
+    write_pbf(file_name)
+    return file_name
+
+
+def xml_candidates(stats=None):
+    return TagExtractor(stats=stats).parse_bytes(XML.encode('utf8'))
+
+
+def element_shape(element):
+    return (element.tag, dict(element.attrib),
+            [(child.tag, dict(child.attrib)) for child in element])
+
+
+@pytest.mark.parametrize('workers', [None, 2])
+def test_candidates_match_xml(pbf_name, workers):
+    expected = xml_candidates()
+    assert [candidate.elem_id for candidate in expected] == ['1', '5', '10', '20', '30']
+    assert list(PBFReader(pbf_name, workers).iter_candidates()) == expected
+
+
+def test_elements_match_xml(pbf_name):
+    expected = [element_shape(element) for element in ET.fromstring(XML)]
+    assert [element_shape(element) for element in PBFReader(pbf_name).iter_elements()] == expected
+
+
+@pytest.mark.parametrize('workers', [None, 2])
+def test_stats_match_xml(pbf_name, workers):
+    expected = OSMStats()
+    xml_candidates(expected)
+    stats = OSMStats()
+    reader = PBFReader(pbf_name, workers)
+    list(reader.iter_candidates(stats))
+    assert reader.blobs == 3
+    assert stats.elements == expected.elements == {'node': 4, 'way': 1, 'relation': 1}
+    assert stats.tag_keys == expected.tag_keys
+    assert stats.users == expected.users
+    assert None in stats.users
+    assert stats.years == expected.years
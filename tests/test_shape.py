@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+The columnar shape_batch engine against per-row cleaning.
+"""
+
+import pytest
+
+from osm_popul_records import SettlementTable
+from osm_popul_shape import classify_places
+from osm_popul_wrangler import Popul
+
+
+@pytest.fixture
+def popul(synthetic_osm, synthetic_estimates):
+    popul = Popul(synthetic_osm)
+    popul.get_popul_est(synthetic_estimates)
+    yield popul
+    popul.osm_file.close()
+
+
+def shape_rows(popul, candidates):
+    table = SettlementTable()
+    for __ in popul.shape_rows(candidates, table):
+        pass
+    return table, popul.match_stats
+
+
+def test_classify_places():
+    assert classify_places([0, 99, 100, 9999, 10000, 99999, 100000]).tolist() == [
+        'hamlet', 'hamlet', 'village', 'village', 'town', 'town', 'city']
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 1000])
+def test_batch_matches_rows(popul, chunk_size):
+    candidates = list(popul.iter_candidates())
+    expected, expected_stats = shape_rows(popul, candidates)
+    assert len(expected)
+    table = SettlementTable()
+    added = list(popul.shape_batch(candidates, table, chunk_size))
+    assert list(table) == list(expected)
+    assert popul.match_stats == expected_stats
+    assert sum(added) == len(table)
+    assert max(added) <= chunk_size
+
+
+def test_batch_skips_places_already_held(popul):
+    candidates = list(popul.iter_candidates())
+    expected, __ = shape_rows(popul, candidates)
+    half = len(candidates) // 2
+    table = SettlementTable()
+    for __ in popul.shape_batch(candidates[:half], table):
+        pass
+    for __ in popul.shape_batch(candidates[half:], table):
+        pass
+    assert list(table) == list(expected)
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Bounding box, radius and nearest settlement queries, answered by the
+in-memory grid and by the R*Tree of the SQLite tables alike.
+"""
+
+import pytest
+
+from osm_popul_records import SettlementTable
+from osm_popul_report import SettlementReport
+from osm_popul_spatial import SettlementGrid, bbox_around, haversine_km, split_bbox
+from osm_popul_sql import SQLiteSink
+
+# name: (lat, lon); None for a settlement without a location
+PLACES = [
+    ('Center', (30.0, -97.0)),
+    ('North5', (30.05, -97.0)),
+    ('North10', (30.1, -97.0)),
+    ('North20', (30.2, -97.0)),
+    ('East', (0.0, 179.95)),
+    ('West', (0.0, -179.99)),
+    ('Far East', (0.0, 179.5)),
+    ('Polar', (89.9, 10.0)),
+    ('Area', None),
+]
+
+
+@pytest.fixture(scope='module')
+def indexes(tmp_path_factory):
+    table = SettlementTable()
+    for node_id, (name, location) in enumerate(PLACES, 1):
+        lat, lon = location or (None, None)
+        table.append(node_id, 'user', 1, '2016', name, 'town', False, '100', 110, None, name,
+                     lat, lon, 'node' if location else 'way')
+    db_path = str(tmp_path_factory.mktemp('spatial') / 'settlements.db')
+    with SQLiteSink(db_path) as sink:
+        sink.write_records(table)
+    report = SettlementReport(db_path)
+    yield SettlementGrid(table, cell_degrees=0.5), report
+    report.close()
+
+
+def names(settlements):
+    return [settlement.name for settlement in settlements]
+
+
+def nearby(found):
+    return [(item.settlement.name, item.distance_km) for item in found]
+
+
+def assert_same(found, expected):
+    # Same settlements in the same order at the same distances
+    assert [name for name, __ in found] == [name for name, __ in expected]
+    assert [km for __, km in found] == pytest.approx([km for __, km in expected])
+
+
+def test_bbox_helpers():
+    assert split_bbox(-1.0, 179.0, 1.0, -179.0) == [(-1.0, 179.0, 1.0, 180.0), (-1.0, -180.0, 1.0, -179.0)]
+    min_lat, min_lon, max_lat, max_lon = bbox_around(0.0, 179.9, 50.0)
+    assert min_lon > max_lon
+    assert haversine_km(0.0, 179.9, 0.0, min_lon) == pytest.approx(50.0, rel=1e-3)
+    # Near a pole every longitude is in range
+    assert bbox_around(89.9, 10.0, 50.0)[1::2] == (-180.0, 180.0)
+
+
+def test_bbox_across_antimeridian(indexes):
+    grid, report = indexes
+    assert len(grid) == len(PLACES) - 1
+    expected = ['East', 'West', 'Far East']
+    assert sorted(names(grid.bbox(-1.0, 179.0, 1.0, -179.0))) == sorted(expected)
+    assert sorted(names(report.in_bbox(-1.0, 179.0, 1.0, -179.0))) == sorted(expected)
+    # The same box the other way round misses them
+    assert names(grid.bbox(-1.0, -179.0, 1.0, 179.0)) == names(report.in_bbox(-1.0, -179.0, 1.0, 179.0)) == []
+
+
+def test_radius_cut_off(indexes):
+    grid, report = indexes
+    found = nearby(grid.radius(30.0, -97.0, 12.0))
+    assert [name for name, __ in found] == ['Center', 'North5', 'North10']
+    assert found[2][1] == pytest.approx(11.12, abs=0.01)
+    assert_same(nearby(report.within_radius(30.0, -97.0, 12.0)), found)
+    assert [name for name, __ in nearby(grid.radius(30.0, -97.0, 11.0))] == ['Center', 'North5']
+
+
+def test_nearest_k_ordering(indexes):
+    grid, report = indexes
+    found = nearby(grid.nearest(30.14, -97.0, k=3))
+    assert [name for name, __ in found] == ['North10', 'North20', 'North5']
+    assert_same(nearby(report.nearest(30.14, -97.0, k=3)), found)
+    # Nearest across the antimeridian
+    found = nearby(grid.nearest(0.0, -179.9, k=2))
+    assert [name for name, __ in found] == ['West', 'East']
+    assert_same(nearby(report.nearest(0.0, -179.9, k=2)), found)
+    # Searches end at max_km
+    assert grid.nearest(45.0, 0.0, max_km=100.0) == report.nearest(45.0, 0.0, max_km=100.0) == []
+    assert names(item.settlement for item in grid.nearest(89.0, -170.0)) == ['Polar']
+    assert names(item.settlement for item in report.nearest(89.0, -170.0)) == ['Polar']
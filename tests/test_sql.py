@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+SQLite sink and updater behaviour on the settlement tables.
+"""
+
+import contextlib
+import csv
+import io
+import os
+import sqlite3
+
+import pytest
+
+import osm_popul_sql
+from osm_popul_report import SettlementReport
+from osm_popul_sql import RegionMerger, SQLiteSink, SQLiteUpdater
+from osm_popul_wrangler import Popul
+
+NODE_ROW = (1, 'user', 2, '2015', 30.0, -97.0, 'node')
+PLACE_ROW = (1, 'Town', 'town', False, 'Town')
+POPUL_ROW = ('Town', '1200', 1300, None)
+# A way sharing the node's id
+WAY_ROWS = ((1, 'user', 2, '2016', 30.001, -97.001, 'way'), (1, 'Lake', 'village', False, 'Lake'),
+            ('Lake', '300', 320, None))
+
+
+def journal_mode(db_path):
+    connect = sqlite3.connect(db_path)
+    try:
+        return connect.execute('PRAGMA journal_mode').fetchone()[0]
+    finally:
+        connect.close()
+
+
+def test_sink_restores_journal_mode(tmp_path):
+    db_path = str(tmp_path / 'settlements.db')
+    with SQLiteSink(db_path) as sink:
+        sink.write(NODE_ROW, PLACE_ROW, POPUL_ROW)
+    assert journal_mode(db_path) == 'delete'
+    assert os.listdir(str(tmp_path)) == ['settlements.db']
+
+
+def test_sink_abort_rolls_back(tmp_path):
+    db_path = str(tmp_path / 'settlements.db')
+    with SQLiteSink(db_path) as sink:
+        sink.write(NODE_ROW, PLACE_ROW, POPUL_ROW)
+    with pytest.raises(RuntimeError):
+        with SQLiteSink(db_path) as sink:
+            raise RuntimeError
+    connect = sqlite3.connect(db_path)
+    assert connect.execute('SELECT COUNT(*) FROM settlement_nodes').fetchone()[0] == 1
+    connect.close()
+    assert journal_mode(db_path) == 'delete'
+
+
+def test_sink_closes_connection_when_setup_fails(tmp_path, monkeypatch):
+    db_path = str(tmp_path / 'settlements.db')
+
+    def fail(connect):
+        raise sqlite3.OperationalError('disk I/O error')
+
+    monkeypatch.setattr(osm_popul_sql, 'create_tables', fail)
+    with pytest.raises(sqlite3.OperationalError):
+        SQLiteSink(db_path)
+    assert journal_mode(db_path) == 'delete'
+    assert os.listdir(str(tmp_path)) == ['settlements.db']
+
+
+def test_failed_sink_leaves_no_writer_behind(tmp_path, synthetic_osm, synthetic_estimates):
+    popul = Popul(synthetic_osm, out_dir=str(tmp_path))
+    popul.get_popul_est(synthetic_estimates)
+    try:
+        db_path = popul.db_path
+        popul.db_path = str(tmp_path / 'missing' / 'settlements.db')
+        with pytest.raises(sqlite3.OperationalError):
+            popul.process_data(output=('csv', 'sqlite'), progress_every=None)
+        assert popul.sinks == [] and popul.writer is None
+        popul.db_path = db_path
+        # Small batches flush through the writer while the run goes on
+        with contextlib.redirect_stdout(io.StringIO()):
+            popul.process_data(batch_size=10, progress_every=None)
+    finally:
+        popul.osm_file.close()
+    with open(popul.node_file_name, encoding='utf8', newline='') as f:
+        assert sum(1 for __ in csv.reader(f)) == len(popul.settlements) + 1
+
+
+def stored(db_path):
+    connect = sqlite3.connect(db_path)
+    try:
+        return connect.execute("""SELECT n.kind, n.node_id, p.name, q.pop_2016
+                                  FROM settlement_nodes AS n
+                                  JOIN settlement_places AS p ON p.node_id = n.node_id AND p.kind = n.kind
+                                  JOIN settlement_popul AS q ON q.node_id = n.node_id AND q.kind = n.kind
+                                  ORDER BY n.kind""").fetchall()
+    finally:
+        connect.close()
+
+
+def test_elements_sharing_an_id_are_kept_apart(tmp_path):
+    db_path = str(tmp_path / 'settlements.db')
+    with SQLiteSink(db_path) as sink:
+        sink.write(NODE_ROW, PLACE_ROW, POPUL_ROW)
+        sink.write(*WAY_ROWS)
+    assert stored(db_path) == [('node', 1, 'Town', 1300), ('way', 1, 'Lake', 320)]
+    report = SettlementReport(db_path)
+    found = report.in_bbox(29.9, -97.1, 30.1, -96.9)
+    report.close()
+    assert [(settlement.kind, settlement.name) for settlement in found] == [('node', 'Town'), ('way', 'Lake')]
+
+    with SQLiteUpdater(db_path) as updater:
+        assert updater.delete('relation', 1) == 0
+        assert updater.delete('way', 1) == 1
+    assert stored(db_path) == [('node', 1, 'Town', 1300)]
+    report = SettlementReport(db_path)
+    assert [settlement.kind for settlement in report.in_bbox(29.9, -97.1, 30.1, -96.9)] == ['node']
+    report.close()
+
+
+def test_merge_keys_on_kind_and_id(tmp_path):
+    paths = [str(tmp_path / name) for name in ('north.db', 'south.db', 'merged.db')]
+    with SQLiteSink(paths[0]) as sink:
+        sink.write(NODE_ROW, PLACE_ROW, POPUL_ROW)
+    with SQLiteSink(paths[1]) as sink:
+        sink.write(NODE_ROW, PLACE_ROW, POPUL_ROW)
+        sink.write(*WAY_ROWS)
+    with RegionMerger(paths[2]) as merger:
+        assert merger.merge('north', paths[0]) == (1, 0)
+        assert merger.merge('south', paths[1]) == (1, 1)
+    assert stored(paths[2]) == [('node', 1, 'Town', 1300), ('way', 1, 'Lake', 320)]
+    report = SettlementReport(paths[2])
+    assert len(report.in_bbox(29.9, -97.1, 30.1, -96.9)) == 2
+    report.close()
+
+
+def test_merge_keys_on_estimates_place(tmp_path):
+    # Two spellings of the place matched to the same estimate
+    paths = [str(tmp_path / name) for name in ('north.db', 'south.db', 'merged.db')]
+    with SQLiteSink(paths[0]) as sink:
+        sink.write(NODE_ROW, (1, 'St. Town', 'town', False, 'Town'), ('St. Town', '1200', 1300, None))
+    with SQLiteSink(paths[1]) as sink:
+        sink.write((2,) + NODE_ROW[1:], (2, 'Saint Town', 'town', False, 'Town'),
+                   ('Saint Town', '1200', 1300, None))
+    with RegionMerger(paths[2]) as merger:
+        merger.merge('north', paths[0])
+        assert merger.merge('south', paths[1]) == (0, 1)
+    assert stored(paths[2]) == [('node', 1, 'St. Town', 1300)]
+
+
+def test_upgrade_rebuilds_node_id_rtree(tmp_path):
+    db_path = str(tmp_path / 'settlements.db')
+    connect = sqlite3.connect(db_path)
+    connect.execute('CREATE TABLE settlement_nodes (node_id INTEGER NOT NULL, user TEXT, uid INTEGER, '
+                    'timestamp INTEGER, lat REAL, lon REAL)')
+    connect.execute("INSERT INTO settlement_nodes VALUES (5, 'user', 2, 2015, 30.0, -97.0)")
+    connect.execute('CREATE TABLE settlement_places (node_id INTEGER NOT NULL, name TEXT NOT NULL, '
+                    'place TEXT, place_change INTEGER NOT NULL DEFAULT 0)')
+    connect.execute("INSERT INTO settlement_places VALUES (5, 'Town', 'town', 0)")
+    connect.execute('CREATE VIRTUAL TABLE settlement_rtree USING rtree(node_id, min_lat, max_lat, min_lon, max_lon)')
+    connect.execute('INSERT INTO settlement_rtree VALUES (5, 30.0, 30.0, -97.0, -97.0)')
+    connect.commit()
+    osm_popul_sql.create_tables(connect)
+    assert connect.execute('SELECT element_key FROM settlement_rtree').fetchall() == [(20,)]
+    assert connect.execute('SELECT kind FROM settlement_nodes').fetchall() == [('node',)]
+    assert connect.execute('SELECT est_name, kind FROM settlement_places').fetchall() == [('Town', 'node')]
+    connect.close()
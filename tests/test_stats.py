@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Whole-file stats cached next to the input by process_data.
+"""
+
+import contextlib
+import io
+import os
+import shutil
+
+import pytest
+
+from osm_popul_stats import OSMStats, stats_file_name
+from osm_popul_wrangler import Popul
+
+
+def quietly(method, *args, **kwargs):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return method(*args, **kwargs)
+
+
+@pytest.fixture
+def popul(tmp_path, synthetic_osm, synthetic_estimates):
+    # A copy, as the stats are saved next to the file
+    osm_name = str(tmp_path / 'extract.osm')
+    shutil.copyfile(synthetic_osm, osm_name)
+    popul = Popul(osm_name, out_dir=str(tmp_path / 'out'))
+    popul.get_popul_est(synthetic_estimates)
+    yield popul
+    popul.osm_file.close()
+
+
+def counting_parses(popul, monkeypatch):
+    parses = []
+    iter_candidates = popul.iter_candidates
+
+    def counted(*args, **kwargs):
+        parses.append(args)
+        return iter_candidates(*args, **kwargs)
+
+    monkeypatch.setattr(popul, 'iter_candidates', counted)
+    return parses
+
+
+def same_stats(stats, other):
+    return (stats.elements, stats.tag_keys, stats.users, stats.years, stats.size) == \
+        (other.elements, other.tag_keys, other.users, other.years, other.size)
+
+
+def test_stats_saved_by_process_data_are_reused(popul, monkeypatch):
+    quietly(popul.process_data, progress_every=None)
+    collected = popul.osm_stats
+    assert os.path.exists(stats_file_name(popul.file_name))
+    parses = counting_parses(popul, monkeypatch)
+    stats = quietly(popul.get_osm_stats)
+    assert parses == []
+    assert same_stats(stats, collected)
+    assert stats.size == os.path.getsize(popul.file_name)
+
+
+@pytest.mark.parametrize('change', ['mtime', 'size'])
+def test_changed_file_invalidates_stats(popul, monkeypatch, change):
+    collected = quietly(popul.get_osm_stats)
+    assert OSMStats.load(popul.file_name) is not None
+    if change == 'mtime':
+        stat = os.stat(popul.file_name)
+        os.utime(popul.file_name, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    else:
+        with open(popul.file_name, 'ab') as f:
+            f.write(b'\n')
+    assert OSMStats.load(popul.file_name) is None
+    parses = counting_parses(popul, monkeypatch)
+    stats = quietly(popul.get_osm_stats)
+    assert len(parses) == 1
+    assert stats.elements == collected.elements
+    # Saved again for the file as it is now
+    assert OSMStats.load(popul.file_name) is not None
+
+
+def test_save_and_load_round_trip(tmp_path):
+    file_name = tmp_path / 'extract.osm'
+    file_name.write_text('<osm/>', encoding='utf8')
+    stats = OSMStats()
+    stats.add_element('node', 'alice', '2015-01-01T00:00:00Z', ('name', 'place'))
+    # Anonymous edit without a user attribute
+    stats.add_element('way', None, None, ('name',))
+    stats.save(str(file_name))
+    loaded = OSMStats.load(str(file_name))
+    assert same_stats(loaded, stats)
+    assert loaded.users == {'alice': 1, None: 1}